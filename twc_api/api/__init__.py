@@ -1,17 +1,30 @@
 import os
 import shutil
+import time
+from contextlib import closing
 from time import sleep
 
-from flask import Flask, redirect, url_for
+import click
+from flask import Flask, Response, redirect, url_for, stream_with_context
 from flask import request
 from flask_restplus import Api, Resource, abort
 
-from api.model.train import train_model_from_json
-from api.utils.aws import (get_models, set_model, get_status, load_train_file_into_memory,
-                           get_current_model_key, load_model_into_memory, next_model_name, save_model,
-                           sync_log_to_s3, clear_log_file_from_s3, get_training_log_json, download_log_from_s3)
+from api.model.train import train_model_from_json, incremental_retrain, load_tables, table_names
+from api.model.ingest import stream_full_tables
+from api.model.feature_store import ClientFeatureStore, HistoryRequired
+from api.utils.aws import (get_models, set_model, get_status, open_train_file,
+                           get_current_model_key, load_model_into_memory, load_pickled_model, next_model_name, save_model,
+                           sync_log_to_s3, clear_log_file_from_s3, get_training_log_json, download_log_from_s3,
+                           model_version_cache, train_file_etag, s3_log_handler, stop_log_shipping,
+                           model_key_of_version)
+from api.utils.model_cache import ModelCache
+from api.utils.shadow import ShadowScorer, shadow_report
+from api.utils.cache import DiskCache
+from api.utils.profiling import Profiler, REPORT_SUFFIX
 from api.model.models import TWCModel
-from api.model.transformers import ParseJSONToTablesTransformer
+from api.model.artifact import ARTIFACT_SUFFIX, save_artifact, load_artifact, check_equivalence
+from api.model.transformers import ParseJSONToTablesTransformer, model_input
+from api.model.schema import SchemaJSONToTablesTransformer
 import json
 import logging
 import pickle
@@ -25,17 +38,88 @@ api = Api(app, title='The Welcome Centre - DataKind API', default='Endpoints', d
 logging.getLogger('s3transfer').setLevel(logging.CRITICAL)
 
 class ModelContainer(object):
-    current_model = None
-    current_version = None
-
-def update_model():
-    current_model_key = get_current_model_key()
-    if ModelContainer.current_version != current_model_key:
-        app.logger.info('Model state changed, loading model')
-        model = load_model_into_memory(current_model_key)
-        # model = TWCModel()
-        # model.load_from_object(model_dict['model'])
-        ModelContainer.current_model, ModelContainer.current_version = model, current_model_key
+    cache = None
+
+def load_model(model_key):
+    app.logger.info('Loading model {}'.format(model_key))
+    model = load_model_into_memory(model_key)
+    model.set_engine(app.config['PREDICT_ENGINE'])
+    return model
+
+def get_model_cache():
+    if ModelContainer.cache is None:
+        ModelContainer.cache = ModelCache(load_model, app.config['MODEL_MEMORY_BUDGET'])
+    return ModelContainer.cache
+
+def get_model(version=None):
+    """Returns the key and loaded model of a model version, by default the live one. Recently used versions are kept
+    loaded, so switching between them doesn't reload them"""
+    cache = get_model_cache()
+    if version is None:
+        model_key = get_current_model_key()
+    else:
+        try:
+            model_key = model_key_of_version(version)
+        except ValueError:
+            abort(400, message='Model version must be a number, got {}'.format(version))
+        if model_key not in cache and int(version) not in get_models():
+            abort(404, message='Model version {} not found'.format(version))
+    return model_key, cache.get(model_key)
+
+class ShadowContainer(object):
+    scorer = None
+    started = False
+
+def start_shadow(version):
+    """Starts shadow scoring the live requests with a model version, replacing any earlier candidate"""
+    candidate_key = model_key_of_version(version)
+    if ShadowContainer.scorer is not None:
+        ShadowContainer.scorer.close()
+
+    def get_candidate():
+        # Loaded by the shadow scoring thread, which runs outside any request
+        with app.app_context():
+            return get_model_cache().get(candidate_key)
+
+    os.makedirs(app.config['SHADOW_LOG_DIR'], exist_ok=True)
+    log_path = os.path.join(app.config['SHADOW_LOG_DIR'], 'shadow_{}.bin'.format(candidate_key))
+    ShadowContainer.scorer = ShadowScorer(get_candidate, candidate_key, log_path, app.config['SHADOW_QUEUE_BYTES'])
+    ShadowContainer.started = True
+    return ShadowContainer.scorer
+
+def get_shadow_scorer():
+    """The shadow scorer of the configured candidate version, None if nothing is shadow scored"""
+    if not ShadowContainer.started and app.config['SHADOW_MODEL_VERSION']:
+        start_shadow(app.config['SHADOW_MODEL_VERSION'])
+    ShadowContainer.started = True
+    return ShadowContainer.scorer
+
+def payload_parser():
+    if app.config['SCHEMA_PARSER']:
+        return SchemaJSONToTablesTransformer()
+    return ParseJSONToTablesTransformer()
+
+class FeatureStoreContainer(object):
+    feature_store = None
+
+def get_feature_store():
+    if FeatureStoreContainer.feature_store is None:
+        FeatureStoreContainer.feature_store = ClientFeatureStore(app.config['FEATURE_STORE_PATH'])
+    return FeatureStoreContainer.feature_store
+
+@app.cli.command('build-feature-store')
+@click.argument('source_filename')
+@click.option('--local', is_flag=True, help='Read the json dump from a local file instead of the twc-input bucket')
+def build_feature_store(source_filename, local):
+    """Bulk builds the incremental scoring feature store for the current model from a training json dump"""
+    model_key, model = get_model()
+    source = open(source_filename, 'rb') if local else open_train_file(source_filename)
+    # The S3 StreamingBody isn't a context manager
+    with closing(source):
+        tables = stream_full_tables(source, table_names)
+    get_feature_store().build(model.transformer, tables, model_key)
+    click.echo('Feature store built for model {} at {}'.format(model_key,
+                                                               app.config['FEATURE_STORE_PATH']))
 
 @api.route('/set-model')
 @api.doc(description='Sets the live model version in the API',
@@ -43,8 +127,10 @@ def update_model():
 class SetModel(Resource):
     def get(self):
         version = request.args.get('version')
+        # set_model also invalidates the cached live model version, so the switch is picked up immediately. The model
+        # is loaded before returning unless it's still in the model cache, as after a recent rollback
         set_model(version)
-        update_model()
+        get_model()
         return get_status()
 
 @api.route('/models')
@@ -64,31 +150,134 @@ class CurrentModel(Resource):
     def get(self):
         return get_current_model_key()
 
+@api.route('/metrics')
+@api.doc(description='In-process cache statistics of this API instance')
+class Metrics(Resource):
+    def get(self):
+        return {
+            'model_version_cache': model_version_cache.stats(),
+            'model_cache': get_model_cache().stats()
+        }
+
 @api.route('/score')
+@api.doc(params={'incremental': 'If true, the payload only needs the new referrals, the client histories are '
+                                'taken from the feature store built with flask build-feature-store',
+                 'version': 'Version number of the model to score with, by default the live model'})
 class Score(Resource):
     def __init__(self, api, *args, **kwargs):
-        self.parser = ParseJSONToTablesTransformer()
+        self.parser = payload_parser()
 
     def post(self):
         json_data = request.get_json(force=True)
         if type(json_data) == str:
             json_data = json.loads(json_data)
         tables = self.parser.transform(json_data)
-        update_model()
+        model_key, model = get_model(request.args.get('version'))
+        shadow = get_shadow_scorer()
+        if request.args.get('incremental', '').lower() == 'true':
+            scores = self.score_incremental(tables, model_key, model)
+        elif shadow is not None and request.args.get('version') is None:
+            scores = self.score_shadowed(tables, model_key, model, shadow)
+        else:
+            scores = model.predict(tables)
         return {
-            'model_name': get_current_model_key(),
-            'scores': ModelContainer.current_model.predict(tables)
+            'model_name': model_key,
+            'scores': scores
         }
 
+    def score_shadowed(self, tables, model_key, model, shadow):
+        """Scores with the live model, then queues the request for the candidate, which scores it in the background"""
+        # Transforming modifies the tables, so the candidate is given a copy if it transforms them itself
+        raw_tables = ({name: table.copy() for name, table in tables.items()}
+                      if shadow.needs_tables(model_key, model) else None)
+        X, referral_table, scores = model.score_tables(tables)
+        shadow.submit(X, referral_table, scores, raw_tables)
+        return scores.to_dict()
+
+    def score_incremental(self, tables, model_key, model):
+        feature_store = get_feature_store()
+        if feature_store.model_key != model_key:
+            abort(409, message='The feature store was built for model {}, rebuild it for model {} with '
+                               'flask build-feature-store'.format(feature_store.model_key, model_key))
+        try:
+            return model.predict_incremental(tables, feature_store)
+        except HistoryRequired as ex:
+            abort(409, message='{}, score with the full history instead'.format(ex))
+
+@api.route('/shadow')
+@api.doc(description='Shadow scoring of the live /score requests with a candidate model, which scores them in the '
+                     'background. Reports the correlation of its scores with the live ones and the overlap of their '
+                     'top clients, over the referrals scored so far and averaged by week',
+         params={'version': 'Version number of a model to start shadow scoring with, replacing the current candidate',
+                 'threshold': 'Proportion of clients counted as the top cases, 0.2 by default'})
+class Shadow(Resource):
+    def get(self):
+        version = request.args.get('version')
+        if version is not None:
+            try:
+                start_shadow(version)
+            except ValueError:
+                abort(400, message='Model version must be a number, got {}'.format(version))
+        scorer = get_shadow_scorer()
+        if scorer is None:
+            abort(404, message='No model is being shadow scored, start one with /shadow?version=<version>')
+        return {
+            'stats': scorer.stats(),
+            'report': shadow_report(scorer.log_path, float(request.args.get('threshold', 0.2)))
+        }
+
+@api.route('/score-batch')
+@api.doc(description='Scores a list of payloads, each in the /score format, with one transform and model call. '
+                     'Streams newline delimited json, a line per referral with its client, referral and score, '
+                     'then a summary line with the model name and throughput in rows per second',
+         params={'version': 'Version number of the model to score with, by default the live model'})
+class ScoreBatch(Resource):
+    def __init__(self, api, *args, **kwargs):
+        self.parser = payload_parser()
+
+    def post(self):
+        start = time.perf_counter()
+        json_data = request.get_json(force=True)
+        if type(json_data) == str:
+            json_data = json.loads(json_data)
+        if type(json_data) != list:
+            abort(400, message='Expected a list of payloads')
+        tables_list = [self.parser.transform(payload) for payload in json_data]
+        model_name, model = get_model(request.args.get('version'))
+        scores = model.predict_batch(tables_list)
+        seconds = time.perf_counter() - start
+        app.logger.info('Scored {} referrals from {} payloads in {:.2f}s'.format(len(scores), len(json_data), seconds))
+
+        def generate():
+            for client_id, referral_id, score in scores.itertuples(index=False):
+                yield json.dumps({'clientid': json_id(client_id), 'referralinstanceid': json_id(referral_id),
+                                  'score': float(score)}) + '\n'
+            yield json.dumps({'model_name': model_name, 'payloads': len(json_data), 'rows': len(scores),
+                              'seconds': seconds, 'rows_per_second': len(scores) / seconds if seconds else None}) + '\n'
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+def json_id(value):
+    """Ids come out of the tables as numpy ints, or floats when the column had nulls"""
+    if value is None or isinstance(value, str):
+        return value
+    if value != value:
+        return None
+    return int(value) if float(value).is_integer() else float(value)
+
 def get_logger(append_previous=False):
+    logger = logging.getLogger('twc_logger')
+    # Closing the previous run's log shipper uploads the last of its log before this run appends to it
+    for handler in logger.handlers:
+        handler.close()
+    logger.handlers = []
+
     if append_previous:
         download_log_from_s3()
     else:
         if os.path.exists('retrain_output.log'):
             os.remove('retrain_output.log')
 
-    logger = logging.getLogger('twc_logger')
-    logger.handlers = []
     logger.setLevel(logging.DEBUG)
     fh = logging.FileHandler('retrain_output.log')
     fh.setLevel(logging.DEBUG)
@@ -99,55 +288,106 @@ def get_logger(append_previous=False):
     sh.setFormatter(standard_formatter)
     logger.addHandler(fh)
     logger.addHandler(sh)
+    shipper = s3_log_handler(append_previous, app.config['LOG_SHIP_INTERVAL'], app.config['LOG_SHIP_BYTES'])
+    shipper.setLevel(logging.DEBUG)
+    shipper.setFormatter(standard_formatter)
+    logger.addHandler(shipper)
     return logger
 
+def write_model_artifact(model, X, path, logger, n_check_rows=1000):
+    """Writes the model artifact and checks it predicts as the pickled model does on a sample of the training rows.
+    Returns the artifact path, or None if it doesn't match, in which case the model is served from the pickle"""
+    save_artifact(model, path)
+    try:
+        check_equivalence(model, load_artifact(path), model_input(X.iloc[:n_check_rows]))
+    except Exception as ex:
+        logger.warning('Not publishing model artifact: {}'.format(ex))
+        return None
+    return path
+
 @task
-def run_retrain(source_filename, hyperparams=None, test=False):
+def run_retrain(source_filename, hyperparams=None, test=False, incremental=False):
+    """Trains a model on a json dump in the twc-input bucket and publishes it as the live model
+
+    :param test: First fit a model on the earliest referrals and evaluate it on the latest, the published model is
+    then fitted on all of them with the same features
+    :param incremental: Extend the live model with trees fitted on the referrals matured since it was trained, rather
+    than fitting a new one on the whole dump
+    """
     with app.app_context():  # This is used since the run_retrain requires app context 
 
         target, version_number = next_model_name()
 
-        logger = get_logger(not test)
+        logger = get_logger()
 
-        if test:
-            logger.info('Starting test evaluation from source json dump {}'.format(source_filename, target))
+        if incremental:
+            logger.info('Starting incremental retrain from source json dump {} to model file {}'
+                        .format(source_filename, target))
+        elif test:
+            logger.info('Starting test evaluation and retrain from source json dump {} to model file {}'
+                        .format(source_filename, target))
         else:
             logger.info('Starting full retrain from source json dump {} to model file {}'.format(source_filename, target))
 
         sync_log_to_s3(logger)
         try:
-            source = load_train_file_into_memory(source_filename)
+            source_key = train_file_etag(source_filename)
         except Exception as ex:
-            if ex.response['Error']['Code'] == '404':
+            if ex.response['Error']['Code'] in ('404', 'NoSuchKey'):
                 logger.error(ex)
-                sync_log_to_s3(logger)
+                sync_log_to_s3(logger, wait=True)
                 abort(message='Retrain file not found in twc-input s3 bucket')
         try:
-            _, _, _, model = train_model_from_json(source, hyperparams=hyperparams, test=test)
-            if test:
-                run_retrain(source_filename, hyperparams, False)
+            cache = DiskCache(app.config['TRAINING_CACHE_DIR'], app.config['TRAINING_CACHE_MAX_BYTES'])
+            profiler = Profiler(profile_dir=app.config['RETRAIN_CPROFILE_DIR'])
+            if incremental:
+                X, _, _, model = incremental_retrain(
+                    lambda: load_tables(lambda: open_train_file(source_filename), cache=cache, source_key=source_key),
+                    load_pickled_model(get_current_model_key()), new_trees=app.config['INCREMENTAL_NEW_TREES'],
+                    max_trees=app.config['INCREMENTAL_MAX_TREES'], test=test, profiler=profiler)
+                if X is None:
+                    stop_log_shipping(logger)
+                    log_file = open('retrain_output.log', 'r').read()
+                    # Nothing is published, but the run is over, so /retrain-log mustn't show it in progress
+                    clear_log_file_from_s3()
+                    return log_file
             else:
-                pickle.dump(model, open(target, 'wb'))
+                X, _, _, model = train_model_from_json(lambda: open_train_file(source_filename),
+                                                       hyperparams=hyperparams, test=test, cache=cache,
+                                                       source_key=source_key, sparse=app.config['SPARSE_FEATURES'],
+                                                       compact=app.config['COMPACT_DTYPES'], profiler=profiler,
+                                                       publish=True, cv_folds=app.config['CV_FOLDS'],
+                                                       cv_workers=app.config['CV_WORKERS'],
+                                                       memoize_steps=app.config['TRAINING_CACHE_STEPS'])
+            pickle.dump(model, open(target, 'wb'))
+            artifact = write_model_artifact(model, X, target + ARTIFACT_SUFFIX, logger)
+            report = profiler.save(target + REPORT_SUFFIX)
+            summary = profiler.report()
+            logger.info('Retrain took {:.1f}s with a peak RSS of {:.0f}MB'.format(summary['total_wall_seconds'],
+                                                                                   summary['peak_rss_mb']))
 
-                log_filename = '{}_retrain_{}.log'.format(source_filename, target)
+            log_filename = '{}_retrain_{}.log'.format(source_filename, target)
 
-                logger.info('Uploading model file [{}] and log receipt [{}] to s3'.format(target, log_filename))
-                sync_log_to_s3(logger)
-                log_file = open('retrain_output.log', 'r').read()
-                save_model(target, 'retrain_output.log', log_filename)
-                set_model(version_number)
-                clear_log_file_from_s3()
-                return log_file
+            logger.info('Uploading model file [{}] and log receipt [{}] to s3'.format(target, log_filename))
+            stop_log_shipping(logger)
+            log_file = open('retrain_output.log', 'r').read()
+            save_model(target, 'retrain_output.log', log_filename, source=source_filename, artifact=artifact,
+                       report=report)
+            set_model(version_number)
+            clear_log_file_from_s3()
+            return log_file
 
         except Exception as ex:
             logger.error(ex)
+            sync_log_to_s3(logger, wait=True)
             log_file = open('retrain_output.log', 'r').read()
             abort(message=log_file)
 
 @api.route('/retrain/<string:input_file>')
 class Retrain(Resource):
+    @api.doc(params={'incremental': 'true to extend the live model with the referrals matured since it was trained'})
     def get(self, input_file):
-        run_retrain(input_file, test=True)
+        run_retrain(input_file, test=True, incremental=request.args.get('incremental', '').lower() == 'true')
         sleep(5)
         return redirect(url_for('retrain_log'))
 
@@ -1,7 +1,56 @@
 import os
+import tempfile
 
 class Config(object):
     SECRET_KEY = os.environ.get('SECRET_KEY')
+    FEATURE_STORE_PATH = os.path.join(tempfile.gettempdir(), 'twc_feature_store.sqlite')
+    # Seconds the live model version is cached for before it is revalidated against the registry manifest
+    MODEL_VERSION_TTL = int(os.environ.get('TWC_MODEL_VERSION_TTL', 60))
+    # Where models and the registry manifest are kept, 's3' for the TWC_BUCKET_NAME bucket or 'local' for the
+    # TWC_REGISTRY_PATH directory
+    TWC_REGISTRY_BACKEND = os.environ.get('TWC_REGISTRY_BACKEND', 's3')
+    TWC_REGISTRY_PATH = os.environ.get('TWC_REGISTRY_PATH', 'twc_models')
+    # Load models from their memory mapped artifact, kept in MODEL_CACHE_DIR, rather than unpickling them
+    USE_MODEL_ARTIFACTS = os.environ.get('TWC_USE_MODEL_ARTIFACTS', 'true').lower() == 'true'
+    # TWCModel prediction engine for pickled models, 'sklearn' or 'flat'. Models loaded from artifacts are always flat
+    PREDICT_ENGINE = os.environ.get('TWC_PREDICT_ENGINE', 'flat')
+    # Parsed tables and feature matrices of retrains, reused by retrains of the same training file
+    TRAINING_CACHE_DIR = os.environ.get('TWC_TRAINING_CACHE_DIR',
+                                        os.path.join(tempfile.gettempdir(), 'twc_training_cache'))
+    TRAINING_CACHE_MAX_BYTES = int(os.environ.get('TWC_TRAINING_CACHE_MAX_BYTES', 400 * 2 ** 20))
+    # Also cache the output of every transformer step, off by default on AWS Lambda whose 512MB /tmp can't hold them
+    TRAINING_CACHE_STEPS = os.environ.get('TWC_TRAINING_CACHE_STEPS',
+                                          str('AWS_LAMBDA_FUNCTION_NAME' not in os.environ)).lower() == 'true'
+    # Build retrain features as sparse columns and fit on a CSR matrix, needs pandas >= 0.25
+    SPARSE_FEATURES = os.environ.get('TWC_SPARSE_FEATURES', 'false').lower() == 'true'
+    # Small integer, categorical and float32 feature dtypes, the trees compare features as float32 so predictions
+    # are unchanged
+    COMPACT_DTYPES = os.environ.get('TWC_COMPACT_DTYPES', 'true').lower() == 'true'
+    # Directory for a cProfile dump of each retrain stage, none are written if unset
+    RETRAIN_CPROFILE_DIR = os.environ.get('TWC_RETRAIN_CPROFILE_DIR')
+    # The retrain log is uploaded to s3 by a background thread once this many seconds or bytes of it are buffered
+    LOG_SHIP_INTERVAL = float(os.environ.get('TWC_LOG_SHIP_INTERVAL', 5))
+    LOG_SHIP_BYTES = int(os.environ.get('TWC_LOG_SHIP_BYTES', 64 * 2 ** 10))
+    # Evaluate test retrains with this many walk-forward folds rather than one 75/25 split, 0 for the single split.
+    # The folds are fitted in TWC_CV_WORKERS processes, by default one per core, 1 fits them in the retrain process
+    # which is needed where process pools aren't available, as on AWS Lambda
+    CV_FOLDS = int(os.environ.get('TWC_CV_FOLDS', 0))
+    CV_WORKERS = int(os.environ['TWC_CV_WORKERS']) if os.environ.get('TWC_CV_WORKERS') else None
+    # Incremental retrains add this many trees fitted on the newly matured referrals, retiring the oldest trees past the
+    # maximum so the model's size stays bounded
+    INCREMENTAL_NEW_TREES = int(os.environ.get('TWC_INCREMENTAL_NEW_TREES', 20))
+    INCREMENTAL_MAX_TREES = int(os.environ.get('TWC_INCREMENTAL_MAX_TREES', 120))
+    MODEL_CACHE_DIR = os.environ.get('TWC_MODEL_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'twc_model_cache'))
+    # Loaded models are kept in memory up to this many bytes, so recently used versions are served without reloading
+    MODEL_MEMORY_BUDGET = int(os.environ.get('TWC_MODEL_MEMORY_BUDGET', 1024 * 2 ** 20))
+    # Parse /score payloads with the declared columns of api.model.schema rather than inferring them. Undeclared columns
+    # are logged and typed by inference, so declare the columns the models use there to keep them fast
+    SCHEMA_PARSER = os.environ.get('TWC_SCHEMA_PARSER', 'true').lower() == 'true'
+    # Shadow score the live requests with this model version from startup, see /shadow. The candidate scores them in a
+    # background thread from a queue of up to SHADOW_QUEUE_BYTES, which needs a long running server rather than Lambda
+    SHADOW_MODEL_VERSION = os.environ.get('TWC_SHADOW_MODEL_VERSION')
+    SHADOW_LOG_DIR = os.environ.get('TWC_SHADOW_LOG_DIR', os.path.join(tempfile.gettempdir(), 'twc_shadow'))
+    SHADOW_QUEUE_BYTES = int(os.environ.get('TWC_SHADOW_QUEUE_BYTES', 64 * 2 ** 20))
 
 class DevConfig(Config):
     ENV = 'dev'
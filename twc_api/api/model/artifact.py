@@ -0,0 +1,223 @@
+import datetime
+import json
+import pickle
+import struct
+
+import numpy as np
+import pandas as pd
+
+MAGIC = b'TWCMODEL'
+FORMAT_VERSION = 1
+SUPPORTED_FORMAT_VERSIONS = [1]
+ARTIFACT_SUFFIX = '.twcm'
+ALIGNMENT = 64
+PREAMBLE = struct.Struct('<8sII')
+
+NODE_ARRAYS = [('children_left', np.int32), ('children_right', np.int32), ('feature', np.int32),
+               ('threshold', np.float64), ('value', np.float64)]
+
+
+class ArtifactFormatError(Exception):
+    pass
+
+
+class ArtifactMismatch(Exception):
+    pass
+
+
+class FlatForest(object):
+    """A fitted tree ensemble regressor held as flat node arrays, with the nodes of every tree concatenated and child
+    pointers offset to index the concatenated arrays. Leaves have a left child of -1. The arrays can be memory mapped
+    straight out of a model artifact.
+
+    Predictions follow sklearn's forest regressors: features are cast to float32 before being compared with the float64
+    thresholds, and the tree predictions are summed in tree order and divided by the number of trees. It is used as
+    the 'flat' prediction engine of TWCModel.
+    """
+    def __init__(self, children_left, children_right, feature, threshold, value, roots, n_features):
+        self.children_left = children_left
+        self.children_right = children_right
+        self.feature = feature
+        self.threshold = threshold
+        self.value = value
+        self.roots = roots
+        self.n_features = n_features
+
+    @classmethod
+    def from_sklearn(cls, forest):
+        """
+
+        :param forest: A fitted single output sklearn forest regressor, e.g. ExtraTreesRegressor
+        """
+        arrays = {name: [] for name, _ in NODE_ARRAYS}
+        roots = []
+        offset = 0
+        for estimator in forest.estimators_:
+            tree = estimator.tree_
+            roots.append(offset)
+            is_leaf = tree.children_left == -1
+            arrays['children_left'].append(np.where(is_leaf, -1, tree.children_left + offset))
+            arrays['children_right'].append(np.where(is_leaf, -1, tree.children_right + offset))
+            arrays['feature'].append(tree.feature)
+            arrays['threshold'].append(tree.threshold)
+            arrays['value'].append(tree.value[:, 0, 0])
+            offset += tree.node_count
+        flat = {name: np.ascontiguousarray(np.concatenate(arrays[name]), dtype=dtype) for name, dtype in NODE_ARRAYS}
+        n_features = forest.n_features_ if hasattr(forest, 'n_features_') else forest.n_features_in_
+        return cls(roots=np.array(roots, dtype=np.int64), n_features=n_features, **flat)
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    def check_X(self, X):
+        if hasattr(X, 'toarray'):
+            X = X.toarray()
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError('Expected {} features, got array of shape {}'.format(self.n_features, X.shape))
+        return X
+
+    def apply(self, X, chunk_size=4096):
+        """Returns the leaf reached by every row of X in every tree, as an (n rows, n trees) array of node indices.
+
+        All trees are walked together a level at a time: each step advances every (row, tree) pair which hasn't yet
+        reached a leaf by one node, so the per step numpy overhead is shared by the whole forest rather than paid per
+        tree, which is what dominates for the few rows of a typical payload. Rows are taken chunk_size at a time to
+        bound the (row, tree) working arrays on large batches
+        """
+        X = self.check_X(X)
+        leaves = np.empty((len(X), self.n_trees), dtype=np.int64)
+        for start in range(0, len(X), chunk_size):
+            leaves[start:start + chunk_size] = self._apply_chunk(X[start:start + chunk_size])
+        return leaves
+
+    def _apply_chunk(self, X):
+        n_trees = self.n_trees
+        nodes = np.tile(np.asarray(self.roots, dtype=np.int64), len(X))
+        active = np.arange(len(nodes))
+        while active.size:
+            active_nodes = nodes[active]
+            left = self.children_left[active_nodes]
+            internal = left != -1
+            active, active_nodes, left = active[internal], active_nodes[internal], left[internal]
+            go_left = X[active // n_trees, self.feature[active_nodes]] <= self.threshold[active_nodes]
+            nodes[active] = np.where(go_left, left, self.children_right[active_nodes])
+        return nodes.reshape(len(X), n_trees)
+
+    def predict(self, X):
+        leaf_values = self.value[self.apply(X)]
+        # cumsum adds the trees one after the other in tree order, which is how sklearn accumulates them when
+        # predicting in a single thread, so the results agree bit for bit
+        y = leaf_values.cumsum(axis=1)[:, -1]
+        y /= self.n_trees
+        return y
+
+
+def _aligned(position):
+    return (position + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_artifact(twc_model, path):
+    """Writes a TWCModel as a model artifact, laid out as
+
+        preamble: magic bytes, format version, header length
+        header: json describing the forest, the model's training cutoff and where each section starts
+        node arrays: each aligned to 64 bytes so they can be memory mapped in place
+        transformer: the pickled TransformerPipeline
+
+    :param twc_model: TWCModel whose model is a fitted sklearn forest regressor or a FlatForest
+    :param path: File path to write to
+    """
+    forest = twc_model.model
+    if not isinstance(forest, FlatForest):
+        forest = FlatForest.from_sklearn(forest)
+    transformer_bytes = pickle.dumps(twc_model.transformer, protocol=pickle.HIGHEST_PROTOCOL)
+
+    sections, position = {}, 0
+    for name, dtype in NODE_ARRAYS + [('roots', np.int64)]:
+        array = getattr(forest, name)
+        sections[name] = {'offset': position, 'dtype': np.dtype(dtype).str, 'shape': list(array.shape)}
+        position = _aligned(position + array.nbytes)
+    sections['transformer'] = {'offset': position, 'length': len(transformer_bytes)}
+
+    header = json.dumps({
+        'format_version': FORMAT_VERSION,
+        'created': str(datetime.datetime.now()),
+        'n_trees': forest.n_trees,
+        'n_features': int(forest.n_features),
+        'n_nodes': len(forest.children_left),
+        'training_cutoff': None if twc_model.training_cutoff is None else str(twc_model.training_cutoff),
+        'sections': sections
+    }).encode('utf-8')
+    data_start = _aligned(PREAMBLE.size + len(header))
+
+    with open(path, 'wb') as fh:
+        fh.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+        fh.write(header)
+        for name, dtype in NODE_ARRAYS + [('roots', np.int64)]:
+            fh.seek(data_start + sections[name]['offset'])
+            fh.write(np.ascontiguousarray(getattr(forest, name), dtype=dtype).tobytes())
+        fh.seek(data_start + sections['transformer']['offset'])
+        fh.write(transformer_bytes)
+
+
+def read_artifact_header(path):
+    with open(path, 'rb') as fh:
+        magic, format_version, header_length = PREAMBLE.unpack(fh.read(PREAMBLE.size))
+        if magic != MAGIC:
+            raise ArtifactFormatError('{} is not a model artifact'.format(path))
+        if format_version not in SUPPORTED_FORMAT_VERSIONS:
+            raise ArtifactFormatError('Model artifact format version {} is not supported, supported versions are {}'
+                                      .format(format_version, SUPPORTED_FORMAT_VERSIONS))
+        header = json.loads(fh.read(header_length).decode('utf-8'))
+    header['data_start'] = _aligned(PREAMBLE.size + header_length)
+    return header
+
+
+def load_artifact(path, mmap=True):
+    """Loads a TWCModel from a model artifact. With mmap the node arrays are read only views of a memory map of the
+    file, so loading only reads the header and the transformer, and tree nodes are paged in as predictions touch them
+
+    :param path: File path of the artifact
+    :param mmap: Memory map the node arrays rather than reading them into memory
+    """
+    from api.model.models import TWCModel
+
+    header = read_artifact_header(path)
+    if mmap:
+        data = np.memmap(path, dtype=np.uint8, mode='r')
+    else:
+        data = np.fromfile(path, dtype=np.uint8)
+
+    def section(name):
+        start = header['data_start'] + header['sections'][name]['offset']
+        dtype = np.dtype(header['sections'][name]['dtype'])
+        shape = header['sections'][name]['shape']
+        return data[start:start + dtype.itemsize * int(np.prod(shape))].view(dtype).reshape(shape)
+
+    forest = FlatForest(roots=section('roots'), n_features=header['n_features'],
+                        **{name: section(name) for name, _ in NODE_ARRAYS})
+    transformer_start = header['data_start'] + header['sections']['transformer']['offset']
+    transformer = pickle.loads(data[transformer_start:transformer_start
+                                    + header['sections']['transformer']['length']].tobytes())
+    # Artifacts saved before the training cutoff was recorded have none, as pickles of models trained before it was
+    training_cutoff = header.get('training_cutoff')
+    if training_cutoff is not None:
+        training_cutoff = pd.Timestamp(training_cutoff)
+    return TWCModel(transformer, forest, training_cutoff=training_cutoff)
+
+
+def check_equivalence(model, artifact_model, X, rtol=1e-9, atol=1e-12):
+    """Raises ArtifactMismatch unless the artifact model predicts the same as the pickled model on X. The tree leaves
+    reached are identical, the tolerance only allows for sklearn summing tree predictions across threads in any order
+
+    :param model: The TWCModel as trained
+    :param artifact_model: The TWCModel loaded from its artifact
+    :param X: Feature matrix to compare predictions on
+    """
+    expected = model.model.predict(X)
+    actual = artifact_model.model.predict(X)
+    if not np.allclose(expected, actual, rtol=rtol, atol=atol):
+        worst = np.abs(expected - actual).max()
+        raise ArtifactMismatch('Model artifact predictions differ from the pickled model by up to {}'.format(worst))
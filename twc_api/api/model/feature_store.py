@@ -0,0 +1,242 @@
+import json
+import sqlite3
+import threading
+
+import numpy as np
+import pandas as pd
+
+from api.model.transformers import (TimeFeatureTransformer, TimeWindowFeatures, dense_frame, week_ending,
+                                    week_number)
+
+
+class HistoryRequired(Exception):
+    """The referrals can't be featurized from the stored aggregates, either because they are earlier than the
+    client's last stored referral or because they have already been added to the store"""
+    pass
+
+
+class ClientFeatureStore(object):
+    """Persistent store of the per client running aggregates that the history dependent features are built from, so
+    that a payload carrying only a client's new referrals can be featurized exactly as TransformerPipeline.transform
+    would featurize them with the client's full history.
+
+    The payload is run through the pipeline on its own, which gets every feature that depends only on the payload
+    right, and the history dependent features are then corrected by combining the payload-only values with the stored
+    aggregates:
+
+    - timefeature_dayssincelastreferral / startofburst of the client's first new referral are measured from the last
+      stored referral date, and the burst number and index in burst continue the stored burst
+    - timefeature_referralnumber and totalreferralsforclient are offset by the stored referral counts, with same day
+      ties against the last stored date averaged the way rank() averages them
+    - window_count_{n} adds the stored weekly counts of the n weeks ending with the referral's week
+    - *_ever flags are OR-ed with the stored set of ever flags
+
+    The stored aggregates depend on the fitted transformer, so the store records the model it was built for.
+    """
+    def __init__(self, path):
+        """
+
+        :param path: Path of the sqlite database file, created if it doesn't exist
+        """
+        self.path = path
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+        with self.con:
+            self.con.execute("""CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)""")
+            self.con.execute("""CREATE TABLE IF NOT EXISTS client_state (
+                                    clientid TEXT PRIMARY KEY,
+                                    referral_count INTEGER,
+                                    valid_referral_count INTEGER,
+                                    last_date TEXT,
+                                    last_date_count INTEGER,
+                                    burst_number INTEGER,
+                                    burst_size INTEGER,
+                                    weekly_counts TEXT,
+                                    ever TEXT)""")
+            self.con.execute("""CREATE TABLE IF NOT EXISTS referral (referralinstanceid TEXT PRIMARY KEY)""")
+
+    @property
+    def model_key(self):
+        """Key of the model the store was built for, or None if it has never been built"""
+        row = self.con.execute("""SELECT value FROM meta WHERE key = 'model_key'""").fetchone()
+        return row[0] if row else None
+
+    def build(self, transformer, tables, model_key):
+        """Replaces the contents of the store with the aggregates of a full history of referrals, e.g. the training
+        dump of the model
+
+        :param transformer: The fitted TransformerPipeline of the model
+        :param tables: Dictionary of tables as produced by construct_full_tables
+        :param model_key: Key of the model the transformer belongs to
+        """
+        time_features, windows = self.get_pipeline_steps(transformer)
+        X, _, referral_table = transformer.transform(tables)
+        ever_columns = [c for c in X.columns if c.endswith('_ever')]
+        referrals = referral_table[['referral_clientid', 'referral_referraltakendate', 'timefeature_burstnumber']]
+        client_ids = referrals['referral_clientid']
+        dates = referrals['referral_referraltakendate']
+        grouped = referrals.groupby(client_ids)
+
+        last_date = grouped['referral_referraltakendate'].transform('max')
+        last_burst = grouped['timefeature_burstnumber'].transform('max')
+        states = pd.DataFrame({
+            'referral_count': grouped.size(),
+            'valid_referral_count': (dates >= time_features.dataset_start_date).groupby(client_ids).sum(),
+            'last_date': grouped['referral_referraltakendate'].max(),
+            'last_date_count': (dates == last_date).groupby(client_ids).sum(),
+            'burst_number': grouped['timefeature_burstnumber'].max(),
+            'burst_size': (referrals['timefeature_burstnumber'] == last_burst).groupby(client_ids).sum(),
+        })
+
+        weeks = pd.Series(week_number(week_ending(dates)), index=referrals.index)
+        recent = weeks > weeks.groupby(client_ids).transform('max') - max(windows)
+        weekly_counts = weeks[recent].groupby([client_ids[recent], weeks[recent]]).size()
+        weekly_counts = {client_id: dict(zip(counts.index.get_level_values(1).tolist(), counts.tolist()))
+                         for client_id, counts in weekly_counts.groupby(level=0)}
+        ever = (dense_frame(X[ever_columns]) > 0).groupby(client_ids.loc[X.index]).max()
+
+        with self.lock, self.con:
+            self.con.execute("""DELETE FROM client_state""")
+            self.con.execute("""DELETE FROM referral""")
+            self.con.executemany("""INSERT INTO client_state VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                                 (self.state_to_row(client_id, {
+                                     'referral_count': state.referral_count,
+                                     'valid_referral_count': state.valid_referral_count,
+                                     'last_date': state.last_date,
+                                     'last_date_count': state.last_date_count,
+                                     'burst_number': state.burst_number,
+                                     'burst_size': state.burst_size,
+                                     'weekly_counts': weekly_counts[client_id],
+                                     'ever': set(ever.columns[ever.loc[client_id].values])
+                                 }) for client_id, state in states.iterrows()))
+            self.con.executemany("""INSERT INTO referral VALUES (?)""",
+                                 ((self.key(i),) for i in referral_table.index))
+            self.con.execute("""INSERT OR REPLACE INTO meta VALUES ('model_key', ?)""", (model_key,))
+
+    def transform(self, transformer, tables):
+        """Featurizes a payload of new referrals against the stored client histories. Returns the feature matrix and
+        remaining referral table, as TransformerPipeline.transform does, and the updated client states which are
+        written with save_states once the referrals have been scored
+
+        :param transformer: The fitted TransformerPipeline the store was built with
+        :param tables: Dictionary of tables containing only the clients' new referrals
+        """
+        time_features, windows = self.get_pipeline_steps(transformer)
+        X, _, referral_table = transformer.transform(tables)
+        # The history dependent features are corrected cell by cell, which the columns of a sparse pipeline don't allow
+        X = dense_frame(X).astype(float)
+        ever_columns = [c for c in X.columns if c.endswith('_ever')]
+
+        seen = self.con.execute("""SELECT COUNT(*) FROM referral WHERE referralinstanceid IN ({})"""
+                                .format(','.join('?' * len(X))), [self.key(i) for i in X.index]).fetchone()[0]
+        if seen:
+            raise HistoryRequired('{} of the referrals have already been added to the feature store'.format(seen))
+
+        states = {}
+        for client_id, rows in referral_table.groupby('referral_clientid').groups.items():
+            # X is sorted by date, so keep that order within the client
+            rows = X.index[X.index.isin(rows)]
+            states[client_id] = self.update_client(X, referral_table, rows, self.get_state(client_id),
+                                                   time_features, windows, ever_columns)
+        return X, referral_table, states
+
+    def update_client(self, X, referral_table, rows, state, time_features, windows, ever_columns):
+        """Corrects the history dependent features of one client's new referrals in place and returns the client's
+        new state"""
+        dates = referral_table.loc[rows, 'referral_referraltakendate']
+        weeks = week_number(week_ending(dates))
+        burst_numbers = referral_table.loc[rows, 'timefeature_burstnumber'].values
+        valid = (dates >= time_features.dataset_start_date).values
+
+        if state is not None:
+            if dates.iloc[0] < state['last_date']:
+                raise HistoryRequired('Referral dated {} is earlier than the last stored referral of client {}'
+                                      .format(dates.iloc[0], self.key(referral_table.loc[rows[0], 'referral_clientid'])))
+            days = (dates.iloc[0] - state['last_date']).days
+            starts_burst = days > time_features.break_length
+            X.loc[rows[0], 'timefeature_dayssincelastreferral'] = days
+            X.loc[rows[0], 'timefeature_startofburst'] = float(starts_burst)
+
+            # Same day ties with the last stored referrals share their average rank
+            ties = np.where((dates == state['last_date']).values, state['last_date_count'] / 2, 0)
+            in_stored_burst = (burst_numbers == 1) & (not starts_burst)
+            X.loc[rows, 'timefeature_indexinburst'] += np.where(in_stored_burst, state['burst_size'] - ties, 0)
+            burst_numbers = burst_numbers + state['burst_number'] - 1 + int(starts_burst)
+            referral_table.loc[rows, 'timefeature_burstnumber'] = burst_numbers
+            referral_table.loc[rows, 'timefeature_referralnumber'] += state['valid_referral_count'] - ties
+            referral_table.loc[rows, 'timefeature_totalreferralsforclient'] += state['referral_count']
+
+            for window in windows:
+                column = 'window_count_{}'.format(window)
+                X.loc[rows, column] += [sum(state['weekly_counts'].get(w, 0) for w in range(week - window + 1, week + 1))
+                                        for week in weeks]
+            stored_ever = [c for c in ever_columns if c in state['ever']]
+            X.loc[rows, stored_ever] = 1.0
+        else:
+            state = {'referral_count': 0, 'valid_referral_count': 0, 'last_date': None, 'last_date_count': 0,
+                     'burst_number': 0, 'burst_size': 0, 'weekly_counts': {}, 'ever': set()}
+
+        last_date = dates.iloc[-1]
+        weekly_counts = dict(state['weekly_counts'])
+        for week in weeks:
+            weekly_counts[week] = weekly_counts.get(week, 0) + 1
+        last_burst_size = int((burst_numbers == burst_numbers[-1]).sum())
+        last_row = X.loc[rows[-1], ever_columns]
+        return {
+            'referral_count': state['referral_count'] + len(rows),
+            'valid_referral_count': state['valid_referral_count'] + int(valid.sum()),
+            'last_date': last_date,
+            'last_date_count': int((dates == last_date).sum()) + (state['last_date_count']
+                                                                  if last_date == state['last_date'] else 0),
+            'burst_number': int(burst_numbers[-1]),
+            'burst_size': last_burst_size + (state['burst_size'] if burst_numbers[-1] == state['burst_number'] else 0),
+            'weekly_counts': {w: c for w, c in weekly_counts.items() if w > weeks[-1] - max(windows)},
+            'ever': state['ever'] | set(last_row.index[last_row.values > 0])
+        }
+
+    def save_states(self, states, referral_ids):
+        """Writes the client states returned by transform and marks the referrals as added
+
+        :param states: Dictionary of client id: state
+        :param referral_ids: Ids of the referrals which were featurized
+        """
+        with self.lock, self.con:
+            self.con.executemany("""INSERT OR REPLACE INTO client_state VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                                 (self.state_to_row(client_id, state) for client_id, state in states.items()))
+            self.con.executemany("""INSERT INTO referral VALUES (?)""", ((self.key(i),) for i in referral_ids))
+
+    def get_state(self, client_id):
+        row = self.con.execute("""SELECT * FROM client_state WHERE clientid = ?""", (self.key(client_id),)).fetchone()
+        if row is None:
+            return None
+        return {
+            'referral_count': row[1],
+            'valid_referral_count': row[2],
+            'last_date': pd.Timestamp(row[3]),
+            'last_date_count': row[4],
+            'burst_number': row[5],
+            'burst_size': row[6],
+            'weekly_counts': {int(w): c for w, c in json.loads(row[7]).items()},
+            'ever': set(json.loads(row[8]))
+        }
+
+    @classmethod
+    def state_to_row(cls, client_id, state):
+        return (cls.key(client_id), int(state['referral_count']), int(state['valid_referral_count']),
+                pd.Timestamp(state['last_date']).isoformat(), int(state['last_date_count']),
+                int(state['burst_number']), int(state['burst_size']),
+                json.dumps({str(w): int(c) for w, c in state['weekly_counts'].items()}),
+                json.dumps(sorted(state['ever'])))
+
+    @staticmethod
+    def key(value):
+        """Ids arrive as ints or, when the column has nulls, floats, so store them in one canonical form"""
+        if isinstance(value, (float, np.floating)) and float(value).is_integer():
+            value = int(value)
+        return str(value)
+
+    @staticmethod
+    def get_pipeline_steps(transformer):
+        time_features = [t for t in transformer.pipeline if isinstance(t, TimeFeatureTransformer)][0]
+        windows = [t for t in transformer.pipeline if isinstance(t, TimeWindowFeatures)][0].windows
+        return time_features, windows
@@ -0,0 +1,112 @@
+import codecs
+import json
+
+import pandas as pd
+
+MISSING = float('nan')
+NUMBER_CHARACTERS = set('0123456789.eE+-')
+
+
+class ColumnarTableBuilder(object):
+    """Accumulates the rows of a table as one list per column, so rows are kept as column values rather than as a dict
+    per row. Builds the same DataFrame as pd.DataFrame(rows) would from the list of row dicts"""
+    def __init__(self):
+        self.columns = {}
+        self.n_rows = 0
+
+    def append(self, row):
+        for column, value in row.items():
+            if column not in self.columns:
+                # Rows before the column first appeared lack it, which pandas fills with NaN
+                self.columns[column] = [MISSING] * self.n_rows
+            self.columns[column].append(value)
+        self.n_rows += 1
+        if len(row) < len(self.columns):
+            for values in self.columns.values():
+                if len(values) < self.n_rows:
+                    values.append(MISSING)
+
+    def to_frame(self):
+        if not self.columns:
+            return pd.DataFrame()
+        # Let pandas order the columns as it would for a list of dicts, which differs between pandas versions
+        columns = pd.DataFrame([dict.fromkeys(self.columns)]).columns
+        frame = pd.DataFrame({c: self.columns[c] for c in columns}, columns=columns)
+        self.columns = {}
+        return frame
+
+
+def iter_json_array(fileobj, chunk_size=1 << 20):
+    """Yields the elements of a json array one at a time, reading the array from a file-like object in chunks so that
+    only the element being decoded is held as raw text
+
+    :param fileobj: File-like object open in binary (utf-8) or text mode, e.g. an open file or an S3 streaming body
+    :param chunk_size: Number of bytes or characters read at a time
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buffer, position, eof = '', 0, False
+
+    def read_more():
+        nonlocal buffer, position, eof
+        chunk = fileobj.read(chunk_size)
+        eof = not chunk
+        if isinstance(chunk, bytes):
+            chunk = utf8.decode(chunk, final=eof)
+        buffer, position = buffer[position:] + chunk, 0
+
+    def next_token():
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if position < len(buffer):
+                return buffer[position]
+            if eof:
+                raise ValueError('Unexpected end of json array')
+            read_more()
+
+    if next_token() != '[':
+        raise ValueError('Expected a json array')
+    position += 1
+    if next_token() == ']':
+        return
+    while True:
+        next_token()
+        while True:
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+                # A number cut off by the end of the buffer may continue in the next chunk
+                if eof or (end < len(buffer) and buffer[end] not in NUMBER_CHARACTERS):
+                    break
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            read_more()
+        position = end
+        yield element
+        separator = next_token()
+        position += 1
+        if separator == ']':
+            return
+        if separator != ',':
+            raise ValueError('Expected , or ] after array element, found {}'.format(separator))
+
+
+def stream_full_tables(fileobj, table_names, limit=None, chunk_size=1 << 20):
+    """Builds the same dictionary of tables as construct_full_tables from a json dump read from a file-like object, in
+    a single pass over the records and without holding the parsed dump
+
+    :param fileobj: File-like object of the json dump, a list of records each holding lists of rows by table name
+    :param table_names: Tables to build, every one is returned, empty if no record holds it
+    :param limit: Only read the first limit records
+    :param chunk_size: Number of bytes or characters read at a time
+    """
+    builders = {table_name: ColumnarTableBuilder() for table_name in table_names}
+    for i, record in enumerate(iter_json_array(fileobj, chunk_size)):
+        if limit is not None and i >= limit:
+            break
+        for table_name, builder in builders.items():
+            for row in record.get(table_name) or []:
+                builder.append(row)
+    return {table_name: builder.to_frame() for table_name, builder in builders.items()}
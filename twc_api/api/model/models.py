@@ -1,22 +1,146 @@
 from sklearn.ensemble import RandomForestRegressor
 from api.model.transformers import *
+from api.model.artifact import FlatForest
 import pickle
+from itertools import chain
 import numpy as np
 
+ENGINES = ['sklearn', 'flat']
+TABLE_KEYS = {'referral': 'referralinstanceid', 'client': 'clientid'}
+
+def concat_tables(tables_list):
+    """Concatenates the tables of many payloads into one dictionary of tables, dropping the rows which appear in more
+    than one payload. A referral or client sent with different values in two payloads keeps the last values sent, and
+    the item rows of a referral or client take those of the last payload which sent any. Items repeated within a
+    payload are counted by consolidation, so they're kept
+
+    :param tables_list: List of dictionaries of tables, one per payload
+    """
+    tables = {}
+    for table_name in set(chain.from_iterable(tables_list)):
+        parts = [t[table_name] for t in tables_list if table_name in t]
+        payloads = np.repeat(np.arange(len(parts)), [len(part) for part in parts])
+        table = pd.concat(parts, ignore_index=True, sort=False)
+        owner = [c for c in [TABLE_KEYS.get(table_name), 'referralinstanceid', 'clientid'] if c in table.columns]
+        if table_name in TABLE_KEYS and owner:
+            table = table.drop_duplicates(owner[0], keep='last')
+        elif owner:
+            last_payload = pd.Series(payloads).groupby(table[owner[0]].values).transform('max').values
+            table = table[payloads == last_payload]
+        tables[table_name] = table.reset_index(drop=True)
+    return tables
+
+def select_clients(tables, client_ids):
+    """The rows of a dictionary of tables which belong to the given clients, those of the tables keyed by referral
+    through the clients' referrals
+
+    :param tables: Dictionary of tables as produced by construct_full_tables
+    :param client_ids: Ids of the clients to keep
+    """
+    referral = tables['referral'][tables['referral']['clientid'].isin(client_ids)]
+    selected = {}
+    for table_name, table in tables.items():
+        if table_name == 'referral':
+            table = referral
+        elif 'clientid' in table.columns:
+            table = table[table['clientid'].isin(client_ids)]
+        elif 'referralinstanceid' in table.columns:
+            table = table[table['referralinstanceid'].isin(referral['referralinstanceid'])]
+        selected[table_name] = table.reset_index(drop=True)
+    return selected
+
 class TWCModel(object):
-    def __init__(self, transformer, model):
+    def __init__(self, transformer, model, engine='sklearn', training_cutoff=None):
+        """
+
+        :param transformer: Fitted TransformerPipeline
+        :param model: Fitted sklearn forest regressor, or a FlatForest
+        :param engine: 'sklearn' to predict with the sklearn model, or 'flat' to predict with it flattened into a
+        FlatForest, which has much less per call overhead on small payloads
+        :param training_cutoff: Date of the latest referral the model was trained on, whose look-ahead target had
+        matured. An incremental retrain trains on the referrals which have matured since
+        """
         self.transformer = transformer
         self.model = model
+        self.training_cutoff = training_cutoff
+        self.set_engine(engine)
+
+    def set_engine(self, engine):
+        if engine not in ENGINES:
+            raise ValueError('engine must be one of {}'.format(ENGINES))
+        self.engine = engine
+
+    def get_predictor(self):
+        # Models pickled before engines existed have no engine attribute
+        if isinstance(self.model, FlatForest) or getattr(self, 'engine', 'sklearn') == 'sklearn':
+            return self.model
+        if getattr(self, '_flat_forest', None) is None:
+            self._flat_forest = FlatForest.from_sklearn(self.model)
+        return self._flat_forest
+
+    def __getstate__(self):
+        # The flattened forest is rebuilt on demand rather than pickled a second time alongside the model
+        state = dict(self.__dict__)
+        state.pop('_flat_forest', None)
+        return state
 
     def get_model(self):
         return RandomForestRegressor(n_jobs=-1, n_estimators=150)
 
     def predict(self, tables):
-        X, _, _ = self.transformer.transform(tables)
-        pred = self.model.predict(X)
+        return self.score_tables(tables)[2].to_dict()
+
+    def score_tables(self, tables):
+        """Returns the features, referral table and Series of scores of a payload, indexed by referral"""
+        X, _, referral_table = self.transformer.transform(tables)
+        pred = self.get_predictor().predict(model_input(X))
+        return X, referral_table, pd.Series(pred, X.index)
+
+    def predict_incremental(self, tables, feature_store):
+        """Scores a payload containing only the clients' new referrals, taking their history from the feature store
+
+        :param tables: Dictionary of tables of the new referrals
+        :param feature_store: ClientFeatureStore built for this model
+        """
+        # Hold the store for the whole read-score-write so concurrent requests for a client can't interleave
+        with feature_store.lock:
+            X, _, states = feature_store.transform(self.transformer, tables)
+            pred = self.get_predictor().predict(model_input(X))
+            feature_store.save_states(states, X.index)
         pred_series = pd.Series(pred, X.index)
         return pred_series.to_dict()
 
+    def extend(self, X, y, new_trees, max_trees):
+        """Fits new_trees more trees on X and y alongside the existing ones, then retires the oldest trees so the forest
+        keeps at most max_trees
+
+        :param X: Features built with this model's transformer
+        """
+        if isinstance(self.model, FlatForest):
+            raise ValueError('A model loaded from its artifact has no sklearn forest to extend, load its pickle')
+        forest = self.model
+        forest.set_params(warm_start=True, n_estimators=len(forest.estimators_) + new_trees)
+        forest.fit(model_input(X), y)
+        # Warm started trees are appended, so the oldest come first
+        forest.estimators_ = forest.estimators_[-max_trees:]
+        forest.set_params(warm_start=False, n_estimators=len(forest.estimators_))
+        self._flat_forest = None
+
+    def predict_batch(self, tables_list):
+        """Scores many payloads with a single transform and model call. Clients are featurized independently of each
+        other, so this scores each referral as predict would on its own payload. Returns a DataFrame of clientid,
+        referralinstanceid and score
+
+        :param tables_list: List of dictionaries of tables, one per payload
+        """
+        tables = concat_tables(tables_list)
+        X, _, referral_table = self.transformer.transform(tables)
+        # The batches are large, where sklearn's compiled traversal is faster than the flat engine
+        pred = self.model.predict(model_input(X))
+        return pd.DataFrame({'clientid': referral_table.loc[X.index, 'referral_clientid'].values,
+                             'referralinstanceid': X.index.values,
+                             'score': pred}, columns=['clientid', 'referralinstanceid', 'score'])
+
     def save(self, file_name):
         with open(file_name, 'wb') as file:
             pickle.dump({'transformer': self.transformer,
@@ -0,0 +1,128 @@
+"""Declared columns of the nine TWC tables, and a parser building typed tables from a /score payload with them"""
+import json
+import logging
+
+import numpy as np
+import pandas as pd
+
+from api.model.transformers import BaseTransformer
+
+logger = logging.getLogger('twc_logger')
+
+# Column types: 'int' for ids which are never null, 'float' for numbers and ids which may be, 'bool', 'str' for text,
+# and ('date', unit) for ISO 8601 date strings with the precision of a numpy datetime unit
+ID = 'int'
+NUMBER = 'float'
+TEXT = 'str'
+DAY = ('date', 'D')
+TIMESTAMP = ('date', 's')
+
+
+def item_table(item_id):
+    return {'referralinstanceid': ID, item_id: ID}
+
+
+TABLE_SCHEMAS = {
+    'referral': {
+        'referralinstanceid': ID, 'clientid': ID, 'statusid': NUMBER, 'referraltakendate': TIMESTAMP,
+        'referralreadydate': TIMESTAMP, 'referralcollecteddate': TIMESTAMP, 'updatetimestamp': TIMESTAMP,
+        'referralonhold': 'bool', 'referralworkerid': NUMBER, 'referralpreparedWorkerid': NUMBER,
+        'referralhandedworkerid': NUMBER, 'referralagencyid': NUMBER, 'partnerid': NUMBER, 'ethnicityid': NUMBER,
+        'addresslocalityid': NUMBER, 'addresstypeid': NUMBER, 'numberofdependants': NUMBER, 'partnername': TEXT,
+        'dependantdetails': TEXT, 'referralagencyworkername': TEXT, 'referralagencytelephonenumber': TEXT,
+        'dietaryextranotes': TEXT, 'referralnotes': TEXT
+    },
+    'client': {
+        'clientid': ID, 'clientdateofbirth': DAY, 'addresssincedate': DAY, 'clientismale': 'bool',
+        'partnerid': NUMBER, 'clientcountryid': NUMBER, 'clientaddresstypeid': NUMBER, 'addresslocalityid': NUMBER,
+        'clientresidencyid': NUMBER
+    },
+    'clientissue': {'clientid': ID, 'clientissueid': ID},
+    'referralissue': item_table('clientissueid'),
+    'referralbenefit': item_table('benefittypeid'),
+    'referralreason': item_table('referralreasonid'),
+    'referraldocument': item_table('referraldocumentid'),
+    'referraldietaryrequirements': item_table('dietaryrequirementsid'),
+    'referraldomesticcircumstances': item_table('domesticcircumstancesid'),
+}
+
+# Stands in for a column a record doesn't have, which None can't as it's a null value of the column
+ABSENT = object()
+
+# (table, column) of the undeclared columns already logged, so each is logged once rather than on every request
+UNDECLARED_COLUMNS = set()
+
+
+def typed_column(values, column_type):
+    """A column of the declared type from a list of json values, None and absent values being nulls"""
+    if column_type in (ID, 'bool'):
+        try:
+            if not any(value is None or value is ABSENT for value in values):
+                return np.array(values, dtype=np.int64 if column_type == ID else bool)
+        except (TypeError, ValueError):
+            pass
+        # Holds the nulls as NaN, as pandas does for integers and booleans with nulls
+        column_type = NUMBER
+    if column_type == NUMBER:
+        try:
+            # numpy converts None to NaN for float arrays
+            return np.array([None if value is ABSENT else value for value in values], dtype=np.float64)
+        except (TypeError, ValueError):
+            column_type = TEXT
+    if column_type == TEXT:
+        return np.array([np.nan if value is None or value is ABSENT else value for value in values], dtype=object)
+    values = [None if value is ABSENT else value for value in values]
+    try:
+        # numpy parses ISO 8601 strings without pandas' per call overhead, and None as NaT
+        return np.array(values, dtype='datetime64[{}]'.format(column_type[1])).astype('datetime64[ns]')
+    except (TypeError, ValueError):
+        # Dates in another format, or more precise than the declared unit, are parsed as the consolidation step would
+        return pd.to_datetime(values).values
+
+
+class SchemaJSONToTablesTransformer(BaseTransformer):
+    """Builds the dictionary of tables of a /score payload as ParseJSONToTablesTransformer does, but with the declared
+    columns and types of TABLE_SCHEMAS. The records of each table are read in one pass, each column is built with its
+    type rather than inferred and dates are parsed once with their declared precision. Columns which aren't declared are
+    logged and typed by inference as ParseJSONToTablesTransformer types them, so features built from a column missing
+    from the schema don't silently become zeros, and tables which aren't declared are skipped. A declared column which
+    none of a table's records have is left out, as it would be by pandas"""
+    def __init__(self, schemas=None):
+        """
+
+        :param schemas: {table name: {column: type}}, by default TABLE_SCHEMAS
+        """
+        self.schemas = TABLE_SCHEMAS if schemas is None else schemas
+
+    def transform(self, req_json):
+        if type(req_json) == str:
+            req_json = json.loads(req_json)
+        tables_dict = {}
+        for table_name, schema in self.schemas.items():
+            records = req_json.get(table_name)
+            tables_dict[table_name] = self.build_table(records, schema, table_name) if records else pd.DataFrame()
+        return tables_dict
+
+    @staticmethod
+    def build_table(records, schema, table_name=None):
+        names = list(schema)
+        # Rows of the declared columns, transposed to columns
+        columns = zip(*[[record.get(name, ABSENT) for name in names] for record in records])
+        table = {}
+        for name, values in zip(names, columns):
+            if all(value is ABSENT for value in values):
+                continue
+            table[name] = typed_column(values, schema[name])
+        undeclared = set().union(*records).difference(schema)
+        if undeclared:
+            for name in sorted(undeclared):
+                if (table_name, name) not in UNDECLARED_COLUMNS:
+                    UNDECLARED_COLUMNS.add((table_name, name))
+                    logger.warning('Column {} of table {} is not declared in the schema, its type is inferred'
+                                   .format(name, table_name))
+            inferred = pd.DataFrame([{name: record[name] for name in undeclared if name in record}
+                                     for record in records]).replace({None: np.nan})
+            for name in sorted(undeclared):
+                table[name] = inferred[name].values
+        # Columns keep the declared order, followed by the undeclared ones, as the dictionary is ordered
+        return pd.DataFrame(table)
@@ -1,17 +1,27 @@
+import copy
 import json
+import os
 import pickle
+import tempfile
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
 from itertools import chain
 
-from api.model.models import TWCModel
+from api.model.models import TWCModel, select_clients
+from api.model.ingest import stream_full_tables
 from api.utils.evaluate import evaluate_average_weekly_rank_correlation
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 from api.model.transformers import (TransformerPipeline, ConsolidateTablesTransformer,
                                     AddFutureReferralTargetFeatures, TimeFeatureTransformer,
                                     SplitCurrentAndEverTransformer,
-                                    AlignFeaturesToColumnSchemaTransformer, TimeWindowFeatures)
+                                    AlignFeaturesToColumnSchemaTransformer, TimeWindowFeatures, model_input,
+                                    take_rows, sort_rows, frame_memory_mb)
 from sklearn.ensemble import ExtraTreesRegressor
 from api.utils.aws import sync_log_to_s3
+from api.utils.profiling import Profiler
 import logging
 
 table_names = ['referral', 'referralreason', 'client', 'referralbenefit', 'referralissue', 'referraldocument',
@@ -19,30 +29,165 @@ table_names = ['referral', 'referralreason', 'client', 'referralbenefit', 'refer
 
 logger = logging.getLogger('twc_logger')
 
-def train_model_from_json(json_data, hyperparams=None, limit=None, test=False):
+def train_model_from_json(json_data, hyperparams=None, limit=None, test=False, cache=None, source_key=None,
+                          sparse=False, compact=False, profiler=None, publish=False, cv_folds=None, cv_workers=None,
+                          memoize_steps=True):
+    """
+
+    :param json_data: The parsed json dump, a file-like object of it which is parsed a record at a time, or a function
+    returning either, which is only called if the tables aren't cached
+    :param test: Fit the model on the earliest referrals and evaluate it on the latest
+    :param cache: DiskCache of the parsed tables and feature matrices of previous retrains
+    :param source_key: Identifies the contents of the json dump, e.g. its ETag, required for caching
+    :param sparse: Build the features as sparse columns and fit the model on a CSR matrix
+    :param compact: Build the features with the compact dtype policy, see build_transformer_pipeline
+    :param profiler: Profiler recording the table parse, each transformer step, the model fit and the evaluation
+    :param publish: With test, then fit the returned model on all referrals, reusing the features and transformer of
+    the evaluation rather than building them again
+    :param cv_folds: With test, evaluate with this many walk-forward folds rather than a single split, see
+    walk_forward_validation. The returned model is then fitted on all referrals
+    :param cv_workers: Number of processes fitting the walk-forward folds
+    :param memoize_steps: Also cache the output of each transformer step, see generate_X_y
+    """
+    if profiler is None:
+        profiler = Profiler(enabled=False)
     logger.info('Beginning table parse')
     sync_log_to_s3(logger)
-    tables = construct_full_tables(json_data, limit)
-    # Generate feature matrix and target vector
-    X, y, referral_table, transformer = generate_X_y(tables)
+    # Generate feature matrix and target vector, the tables are only loaded if the features aren't cached
+    X, y, referral_table, transformer = generate_X_y(lambda: profiler.call('load_tables', load_tables, json_data,
+                                                                           limit, cache, source_key),
+                                                     cache, None if source_key is None else [source_key, limit],
+                                                     sparse, compact, profiler, memoize_steps)
+    if test and cv_folds:
+        profiler.call('walk_forward', walk_forward_validation, X, y, referral_table, cv_folds, hyperparams,
+                      workers=cv_workers)
+        new_model = profiler.call('final fit', train_model, X, y, hyperparams)
+        return X, y, referral_table, TWCModel(transformer, new_model,
+                                              training_cutoff=referral_table['referral_referraltakendate'].max())
     # Split train and test sets
     if test:
         X_train, X_test, y_train, y_test, referral_table_train, referral_table_test = \
             split_train_test(X, y, referral_table)
         # Evaluate  model
-        new_model = train_model(X_train, y_train, hyperparams)
+        new_model = profiler.call('fit', train_model, X_train, y_train, hyperparams)
+
+        profiler.call('evaluate', evaluate_model, new_model, X_test, y_test, referral_table_test, 0.2)
 
-        evaluate_model(new_model, X_test, y_test, referral_table_test, 0.2)
+        if publish:
+            # Drop the evaluation model before fitting the final one, so only one forest is held at a time
+            del new_model
+            new_model = profiler.call('final fit', train_model, X, y, hyperparams)
+            referral_table_train = referral_table
 
-        twc_model = TWCModel(transformer, new_model)
+        twc_model = TWCModel(transformer, new_model,
+                             training_cutoff=referral_table_train['referral_referraltakendate'].max())
 
         return X, y, referral_table, twc_model
     else:
-        new_model = train_model(X, y, hyperparams)
-        twc_model = TWCModel(transformer, new_model)
+        new_model = profiler.call('fit', train_model, X, y, hyperparams)
+        twc_model = TWCModel(transformer, new_model, training_cutoff=referral_table['referral_referraltakendate'].max())
         return X, y, referral_table, twc_model
 
 
+def generate_delta_X_y(tables, transformer, since, profiler=None):
+    """Features and targets of the referrals whose look-ahead target has matured after the date since, built from the
+    histories of only their clients with the steps and column schema of a fitted transformer. Returns X, y, the
+    referral table and the new matured cutoff, with X, y and the referral table None if no referrals have matured
+
+    :param tables: Dictionary of tables of the full dump
+    :param transformer: The fitted TransformerPipeline of the model being extended
+    :param since: Training cutoff of the model being extended
+    """
+    if profiler is None:
+        profiler = Profiler(enabled=False)
+    dates = pd.to_datetime(tables['referral']['referraltakendate'])
+    cutoff = matured_cutoff(dates)
+    clients = tables['referral'].loc[(dates > since) & (dates <= cutoff), 'clientid'].unique()
+    if not len(clients):
+        return None, None, None, cutoff
+    # Clients are featurized independently of each other, so their histories alone give their features
+    data = select_clients(tables, clients)
+    for step in copy.deepcopy(transformer.pipeline):
+        data = profiler.call(type(step).__name__, step.fit_transform, data)
+    referral_table = sort_rows(data, 'referral_referraltakendate')
+    referral_dates = referral_table['referral_referraltakendate']
+    rows = np.flatnonzero(((referral_dates > since) & (referral_dates <= cutoff)).values)
+    X = take_rows(profiler.call('align', transformer.aligner.align, referral_table), rows)
+    y = referral_table['futurereferraltargetfeature_futurereferralscore'].iloc[rows].fillna(0)
+    referral_table = referral_table.iloc[rows].drop(X.columns, axis=1, errors='ignore')
+    return X, y, referral_table, cutoff
+
+
+def incremental_retrain(tables, model, new_trees=20, max_trees=120, test=False, profiler=None):
+    """Extends a model with new_trees trees fitted on the referrals whose target has matured since its training cutoff,
+    retiring its oldest trees so that it keeps at most max_trees, rather than building the features of the whole
+    history and fitting a new forest. Returns X, y, the referral table and the extended model, with X, y and the
+    referral table None and the model unchanged if no referrals have matured
+
+    :param tables: Dictionary of tables of the full, updated dump, or a function returning it
+    :param model: TWCModel with a sklearn forest and a training cutoff, as pickled by a retrain
+    :param test: First extend a copy of the model with the earliest of the newly matured referrals, evaluating it
+    and the model on the latest
+    """
+    if profiler is None:
+        profiler = Profiler(enabled=False)
+    since = getattr(model, 'training_cutoff', None)
+    if since is None:
+        raise ValueError('The model has no training cutoff, it needs a full retrain')
+    if callable(tables):
+        tables = tables()
+    X, y, referral_table, cutoff = generate_delta_X_y(tables, model.transformer, since, profiler)
+    if X is None:
+        logger.info('No referrals have matured since {}, the model is unchanged'.format(since))
+        sync_log_to_s3(logger)
+        return None, None, None, model
+    logger.info('{} referrals matured between {} and {}'.format(len(X), since, cutoff))
+    sync_log_to_s3(logger)
+
+    if test:
+        X_train, X_test, y_train, y_test, _, referral_table_test = split_train_test(X, y, referral_table)
+        candidate = copy.deepcopy(model)
+        profiler.call('extend', candidate.extend, X_train, y_train, new_trees, max_trees)
+        logger.info('Current model:')
+        profiler.call('evaluate current', evaluate_model, model.model, X_test, y_test, referral_table_test, 0.2)
+        logger.info('Extended model:')
+        profiler.call('evaluate', evaluate_model, candidate.model, X_test, y_test, referral_table_test, 0.2)
+        del candidate
+
+    profiler.call('final extend' if test else 'extend', model.extend, X, y, new_trees, max_trees)
+    model.training_cutoff = referral_table['referral_referraltakendate'].max()
+    logger.info('Extended model to {} trees'.format(len(model.model.estimators_)))
+    sync_log_to_s3(logger)
+    return X, y, referral_table, model
+
+
+def load_tables(json_data, limit=None, cache=None, source_key=None):
+    """Builds the dictionary of tables of a json dump, or takes them from the cache
+
+    :param json_data: As for train_model_from_json
+    """
+    if cache is not None and source_key is not None:
+        key = cache.key('tables', source_key, limit, table_names)
+        tables = cache.get(key, 'tables')
+        if tables is not None:
+            return tables
+    opened = callable(json_data)
+    if opened:
+        json_data = json_data()
+    if hasattr(json_data, 'read'):
+        try:
+            tables = stream_full_tables(json_data, table_names, limit)
+        finally:
+            # A stream opened here, such as an S3 body, is closed here, one passed in is left to the caller
+            if opened:
+                json_data.close()
+    else:
+        tables = construct_full_tables(json_data, limit)
+    if cache is not None and source_key is not None:
+        cache.put(key, tables, 'tables')
+    return tables
+
+
 def construct_full_tables(json_data, limit=None):
     tables = {}
     if limit is not None:
@@ -53,22 +198,62 @@ def construct_full_tables(json_data, limit=None):
     return tables
 
 
-def generate_X_y(tables):
-    transformer = TransformerPipeline([
-        ConsolidateTablesTransformer(count_encode=False),
+def build_transformer_pipeline(memory=None, sparse=False, compact=False):
+    """
+
+    :param memory: DiskCache to memoize the pipeline steps in
+    :param sparse: Carry the one-hot and flattened table features as sparse columns from consolidation through to X
+    :param compact: Keep indicators and counts in small integer types, ids and repeated strings as categoricals and X
+    as float32
+    """
+    return TransformerPipeline([
+        ConsolidateTablesTransformer(count_encode=False, sparse=sparse, compact=compact),
         AddFutureReferralTargetFeatures(),
-        TimeFeatureTransformer(break_length=28),
-        TimeWindowFeatures([1, 4, 12]),
+        TimeFeatureTransformer(break_length=28, compact=compact),
+        TimeWindowFeatures([1, 4, 12], compact=compact),
         SplitCurrentAndEverTransformer(['referralissue_',
                                         'referraldomesticcircumstances_',
-                                        'referralreason_', 'referralbenefit_'])
-    ], aligner=AlignFeaturesToColumnSchemaTransformer())
-    X, y, referral_table = transformer.fit_transform(tables)
-    max_dt = referral_table['referral_referraltakendate'].max()
+                                        'referralreason_', 'referralbenefit_'],
+                                       ever_format='sparse' if sparse else 'dense')
+    ], aligner=AlignFeaturesToColumnSchemaTransformer(sparse=sparse, dtype='float32' if compact else 'float64'),
+        memory=memory)
+
+
+def matured_cutoff(dates):
+    """The date of the latest referral whose year of look-ahead the data covers, so whose target is known"""
     # Need to clip the data to have at least a year of observation
-    last_acceptable_date = max_dt - pd.Timedelta('365 days')
+    return dates.max() - pd.Timedelta('365 days')
+
 
-    X = X[referral_table['referral_referraltakendate'] <= last_acceptable_date]
+def generate_X_y(tables, cache=None, source_key=None, sparse=False, compact=False, profiler=None, memoize_steps=True):
+    """
+
+    :param tables: Dictionary of tables as produced by construct_full_tables, or a function returning it which is
+    only called if the features aren't cached
+    :param cache: DiskCache to take the features from, or store them in, if source_key is given
+    :param source_key: Identifies the contents of the tables
+    :param sparse: Build X as sparse columns
+    :param compact: Build the features with the compact dtype policy, see build_transformer_pipeline
+    :param profiler: Profiler recording each transformer step
+    :param memoize_steps: Also cache the output of each transformer step in cache, so a retrain with changed steps
+    reruns only the steps from the first changed one. Every step's output is written on every retrain, which needs a
+    cache with room for several copies of the features
+    """
+    transformer = build_transformer_pipeline(memory=cache if memoize_steps else None, sparse=sparse, compact=compact)
+    if cache is not None and source_key is not None:
+        # Client ages and address lengths are measured from today, so features are only reused on the day they're built
+        key = cache.key('features', source_key, transformer.fingerprint(), str(datetime.now().date()))
+        cached = cache.get(key, 'features')
+        if cached is not None:
+            if profiler is not None:
+                profiler.record_cached('features', cached[0])
+            return cached
+    if callable(tables):
+        tables = tables()
+    X, y, referral_table = transformer.fit_transform(tables, profiler)
+    last_acceptable_date = matured_cutoff(referral_table['referral_referraltakendate'])
+
+    X = take_rows(X, np.flatnonzero(referral_table['referral_referraltakendate'] <= last_acceptable_date))
 
     y = y[referral_table['referral_referraltakendate'] <= last_acceptable_date]
 
@@ -78,8 +263,11 @@ def generate_X_y(tables):
     # Since the data is all numerical or dummied we can fill any nulls with 0
     X = X.fillna(0)
     logger.info("Features Matrix generated" \
-                " consisting of {} referrals and {} features".format(X.shape[0], X.shape[1]))
+                " consisting of {} referrals and {} features ({:.1f} MB)".format(X.shape[0], X.shape[1],
+                                                                               frame_memory_mb(X)))
     sync_log_to_s3(logger)
+    if cache is not None and source_key is not None:
+        cache.put(key, (X, y, referral_table, transformer), 'features')
     return X, y, referral_table, transformer
 
 
@@ -99,20 +287,23 @@ def split_train_test(X, y, referral_table, test_proportion=0.25):
     return X_train, X_test, y_train, y_test, referral_table_train, referral_table_test
 
 
-def train_model(X_train, y_train, hyperparams=None):
+def build_regressor(hyperparams=None, n_jobs=-1):
     if hyperparams is not None:
-        et = ExtraTreesRegressor(n_jobs=-1, **hyperparams)
-    else:
-        et = ExtraTreesRegressor(n_jobs=-1, n_estimators=120)
+        return ExtraTreesRegressor(n_jobs=n_jobs, **hyperparams)
+    return ExtraTreesRegressor(n_jobs=n_jobs, n_estimators=120)
+
 
-    et.fit(X_train, y_train)
+def train_model(X_train, y_train, hyperparams=None):
+    et = build_regressor(hyperparams)
+
+    et.fit(model_input(X_train), y_train)
     logger.info('Trained Model on: {} observations'.format(len(X_train)))
     sync_log_to_s3(logger)
     return et
 
 
 def evaluate_model(model, X_test, y_test, referral_table_test, threshold):
-    y_pred = model.predict(X_test)
+    y_pred = model.predict(model_input(X_test))
 
     # following dumps may be useful for testing
     # pickle.dump(pd.Series(y_pred, X_test.index), open('test_predictions.p', 'wb'))
@@ -126,5 +317,97 @@ def evaluate_model(model, X_test, y_test, referral_table_test, threshold):
                 "\tTest Set Overlap of top {}% worst cases: {}" \
                 .format(evaluation_series['spearman'], threshold * 100, evaluation_series['overlap']))
     sync_log_to_s3(logger)
+    return evaluation_series
+
+
+def walk_forward_folds(n_rows, n_folds, min_train_proportion=0.5):
+    """Row positions (train_end, test_end) of the walk-forward folds over rows in date order. Each fold trains on the
+    rows before train_end and is tested on those from train_end to test_end, the test blocks evenly dividing the rows
+    after the first min_train_proportion of them"""
+    bounds = np.linspace(int(min_train_proportion * n_rows), n_rows, n_folds + 1).astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def save_npy(array, directory, name):
+    path = os.path.join(directory, name + '.npy')
+    np.save(path, array)
+    return path
+
+
+def share_matrix(X, directory):
+    """Writes the model input of X to .npy files in directory, for other processes to memory map with open_shared
+    rather than receive a pickled copy. Returns their description. The values are written as float32, as the trees
+    take them"""
+    X = model_input(X)
+    if sp.issparse(X):
+        X = X.tocsr().astype(np.float32)
+        return {'format': 'csr', 'shape': X.shape,
+                'paths': {name: save_npy(getattr(X, name), directory, name) for name in ['data', 'indices', 'indptr']}}
+    return {'format': 'dense', 'path': save_npy(np.asarray(X, dtype=np.float32), directory, 'X')}
+
+
+def open_shared(spec):
+    """Memory maps a matrix written by share_matrix"""
+    if spec['format'] == 'csr':
+        arrays = {name: np.load(path, mmap_mode='r') for name, path in spec['paths'].items()}
+        return sp.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=spec['shape'], copy=False)
+    return np.load(spec['path'], mmap_mode='r')
+
+
+def evaluate_fold(X_spec, y_path, referral_table_test, train_end, test_end, hyperparams, threshold, n_jobs):
+    """Fits a model on the rows before train_end of the shared X and y and evaluates it on those up to test_end. Run in
+    a worker process, so it doesn't log"""
+    X, y = open_shared(X_spec), np.load(y_path, mmap_mode='r')
+    model = build_regressor(hyperparams, n_jobs)
+    model.fit(X[:train_end], y[:train_end])
+    y_pred = model.predict(X[train_end:test_end])
+    return evaluate_average_weekly_rank_correlation(referral_table_test, np.asarray(y[train_end:test_end]), y_pred,
+                                                    threshold)
+
+
+def walk_forward_validation(X, y, referral_table, n_folds, hyperparams=None, threshold=0.2, workers=None,
+                            min_train_proportion=0.5):
+    """Evaluates the model on n_folds successive blocks of the latest referrals, each with a model fitted on all the
+    referrals before the block. The folds are fitted in parallel processes, which memory map X and y from a temporary
+    directory and split the cores between them. Returns a DataFrame of each fold's metrics
+
+    :param X: Features of the referrals in date order, as generate_X_y returns them
+    :param n_folds: Number of test blocks
+    :param workers: Number of processes, at most n_folds, by default one per core. With 1 the folds are fitted in
+    this process, e.g. where process pools aren't available as on AWS Lambda
+    :param min_train_proportion: Proportion of the referrals the first fold is fitted on
+    """
+    folds = walk_forward_folds(len(X), n_folds, min_train_proportion)
+    cores = os.cpu_count() or 1
+    workers = min(n_folds, workers or cores)
+    n_jobs = max(1, cores // workers)
+    # Only the columns the evaluation groups by are sent to the workers
+    evaluation_table = referral_table[['referral_referraltakendate', 'client_clientid']]
+    with tempfile.TemporaryDirectory() as directory:
+        X_spec = share_matrix(X, directory)
+        y_path = save_npy(np.asarray(y), directory, 'y')
+        arguments = [(X_spec, y_path, evaluation_table.iloc[train_end:test_end], train_end, test_end, hyperparams,
+                      threshold, n_jobs) for train_end, test_end in folds]
+        if workers == 1:
+            results = [evaluate_fold(*fold_arguments) for fold_arguments in arguments]
+        else:
+            with ProcessPoolExecutor(workers) as executor:
+                results = list(executor.map(evaluate_fold, *zip(*arguments)))
+
+    dates = referral_table['referral_referraltakendate']
+    metrics = pd.DataFrame(results, columns=['spearman', 'overlap'])
+    metrics.insert(0, 'train_rows', [train_end for train_end, _ in folds])
+    metrics.insert(1, 'test_rows', [test_end - train_end for train_end, test_end in folds])
+    metrics.insert(2, 'test_start', [dates.iloc[train_end] for train_end, _ in folds])
+    metrics.insert(3, 'test_end', [dates.iloc[test_end - 1] for _, test_end in folds])
+    summary = metrics[['spearman', 'overlap']].agg(['mean', 'std', 'min'])
+    logger.info("Walk-forward Evaluation Metrics over {} folds:\n{}\n"
+                "\tMean Correlation of Predicted and Actual Mean Weekly Scores: {} (std {}, min {})\n"
+                "\tMean Overlap of top {}% worst cases: {} (std {}, min {})"
+                .format(n_folds, metrics.to_string(), summary.loc['mean', 'spearman'], summary.loc['std', 'spearman'],
+                        summary.loc['min', 'spearman'], threshold * 100, summary.loc['mean', 'overlap'],
+                        summary.loc['std', 'overlap'], summary.loc['min', 'overlap']))
+    sync_log_to_s3(logger)
+    return metrics
 
 
@@ -1,13 +1,143 @@
 import pandas as pd
 # from tqdm import tqdm
 from datetime import datetime
+import hashlib
 import json
 import sqlite3
 import logging
 import numpy as np
+import scipy.sparse
+from api.utils.profiling import Profiler
 
 logger = logging.getLogger('twc_logger')
 
+with open(__file__, 'rb') as _source:
+    # Changes to the transformer code change what the same configuration produces
+    CODE_VERSION = hashlib.sha256(_source.read()).hexdigest()
+
+def sparse_supported():
+    """Sparse feature columns need the pandas SparseDtype and sparse accessor of pandas >= 0.25"""
+    return hasattr(pd.DataFrame, 'sparse')
+
+def check_sparse_support():
+    if not sparse_supported():
+        raise ValueError('Sparse features require pandas >= 0.25, found {}'.format(pd.__version__))
+
+def model_input(X):
+    """The feature matrix as the regressor takes it, a CSR matrix if the features are sparse columns"""
+    if hasattr(X, 'sparse') and len(X.columns) and all(isinstance(t, pd.SparseDtype) for t in X.dtypes):
+        return X.sparse.to_coo().tocsr()
+    return X
+
+def dense_frame(X):
+    """X with its sparse columns made dense, for code which assigns to single cells, which SparseArrays don't support"""
+    sparse_columns = [c for c, t in X.dtypes.items() if hasattr(pd, 'SparseDtype') and isinstance(t, pd.SparseDtype)]
+    if not sparse_columns:
+        return X
+    X = X.copy()
+    for column in sparse_columns:
+        X[column] = X[column].sparse.to_dense()
+    return X
+
+def sparse_frame(arrays, index, columns):
+    """The DataFrame of a dict of SparseArrays, built from Series as building it from the dict makes a dense copy of
+    every array"""
+    if not len(columns):
+        return pd.DataFrame(index=index, columns=columns)
+    return pd.concat([pd.Series(arrays[column], index=index, name=column) for column in columns], axis=1)
+
+INTEGER_DTYPES = [np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32, np.int64]
+
+def smallest_dtypes(values):
+    """The smallest dtype which holds each column of a 2d float array exactly: the smallest integer type for integral
+    columns without nulls, float32 for integral columns with nulls if float32 holds them, otherwise float64"""
+    nulls = np.isnan(values)
+    integral = ((values == np.round(values)) | nulls).all(axis=0)
+    has_nulls = nulls.any(axis=0)
+    filled = np.where(nulls, 0, values)
+    if len(values):
+        lowest, highest = filled.min(axis=0), filled.max(axis=0)
+    else:
+        lowest = highest = np.zeros(values.shape[1])
+    dtypes = []
+    for i in range(values.shape[1]):
+        if not integral[i]:
+            dtypes.append(np.float64)
+        elif has_nulls[i]:
+            dtypes.append(np.float32 if max(-lowest[i], highest[i]) <= 2 ** 24 else np.float64)
+        else:
+            dtypes.append([t for t in INTEGER_DTYPES
+                           if np.iinfo(t).min <= lowest[i] and highest[i] <= np.iinfo(t).max][0])
+    return dtypes
+
+def compact_columns(frame, columns, fill_value=None, chunk_size=64):
+    """frame with the given columns in the smallest dtypes which hold them exactly, see smallest_dtypes. Bools become
+    uint8, and columns which aren't dense numbers are left as they are
+
+    :param frame: DataFrame
+    :param columns: Columns of frame to compact
+    :param fill_value: Value to fill nulls of the columns with first
+    :param chunk_size: Number of columns examined at a time, which bounds the float64 working memory
+    """
+    columns = set(columns)
+    # Extension dtypes, such as sparse and categorical columns, aren't numpy dtypes
+    numeric = [c for c, t in frame.dtypes.items() if c in columns and isinstance(t, np.dtype) and t.kind in 'iuf']
+    flags = [c for c, t in frame.dtypes.items() if c in columns and isinstance(t, np.dtype) and t.kind == 'b']
+    if not numeric and not flags:
+        return frame
+    parts = [frame.drop(numeric + flags, axis=1), frame[flags].astype(np.uint8)]
+    arrays = {}
+    for start in range(0, len(numeric), chunk_size):
+        chunk = numeric[start:start + chunk_size]
+        values = frame[chunk].values.astype(np.float64)
+        if fill_value is not None:
+            values[np.isnan(values)] = fill_value
+        for i, (column, dtype) in enumerate(zip(chunk, smallest_dtypes(values))):
+            arrays[column] = values[:, i].astype(dtype)
+    # One block per dtype
+    for dtype in set(values.dtype for values in arrays.values()):
+        block = [column for column in numeric if arrays[column].dtype == dtype]
+        parts.append(pd.DataFrame(np.column_stack([arrays[column] for column in block]), index=frame.index,
+                                  columns=block))
+    return pd.concat(parts, axis=1)[frame.columns]
+
+def frame_memory_mb(frame):
+    """Memory held by a DataFrame's index and columns in MB, counting the strings of object columns"""
+    return frame.memory_usage(deep=True).sum() / 2 ** 20
+
+def take_rows(frame, positions):
+    """frame.iloc[positions], with the sparse columns of each dtype moved together by relabelling the rows of their
+    COO matrix, rather than a column at a time, which is far slower
+
+    :param frame: DataFrame with dense and sparse columns
+    :param positions: Distinct row numbers of frame in the order to return them
+    """
+    positions = np.asarray(positions)
+    if not hasattr(pd, 'SparseDtype'):
+        return frame.iloc[positions]
+    sparse_dtypes = set(t for t in frame.dtypes if isinstance(t, pd.SparseDtype) and t.fill_value == 0)
+    if not sparse_dtypes:
+        return frame.iloc[positions]
+    index = frame.index[positions]
+    new_rows = np.full(len(frame), -1, dtype=np.int64)
+    new_rows[positions] = np.arange(len(positions))
+    parts = [frame[[c for c, t in frame.dtypes.items() if t not in sparse_dtypes]].iloc[positions]]
+    for dtype in sparse_dtypes:
+        columns = [c for c, t in frame.dtypes.items() if t == dtype]
+        matrix = frame[columns].sparse.to_coo()
+        rows = new_rows[matrix.row]
+        kept = rows >= 0
+        matrix = scipy.sparse.coo_matrix((matrix.data[kept], (rows[kept], matrix.col[kept])),
+                                         shape=(len(positions), len(columns)))
+        part = pd.DataFrame.sparse.from_spmatrix(matrix, index=index, columns=columns)
+        parts.append(part if (part.dtypes == dtype).all() else part.astype(dtype))
+    return pd.concat(parts, axis=1)[frame.columns]
+
+def sort_rows(frame, column):
+    """frame.sort_values(column), with the rows moved by take_rows"""
+    # The order only depends on the sort column, so it's found on the column alone
+    return take_rows(frame, frame[column].reset_index(drop=True).sort_values().index)
+
 class BaseTransformer(object):
     """Scikit-learn style transformer pattern, operating on a feature object X and returning a transformed version
     fit_transform by default simply calls transform, but in stateful transformers, will contain code which calculates
@@ -24,12 +154,16 @@ class TimeFeatureTransformer(BaseTransformer):
     a particular referral relative to a particular client's historical use pattern. For example, what number referral
     this is in a burst of high usage
     """
-    def __init__(self, break_length):
+    COMPACT_COLUMNS = ['timefeature_dayssincelastreferral', 'timefeature_startofburst', 'timefeature_indexinburst']
+
+    def __init__(self, break_length, compact=False):
         """
 
         :param break_length: The length in days of no usage which defines the end of a high usage burst
+        :param compact: Store the day counts and burst indicators of X in the smallest dtypes which hold them
         """
         self.break_length = break_length
+        self.compact = compact
 
     def fit_transform(self, referral_table):
         # We set the start date to ensure consistent frame of reference
@@ -38,15 +172,13 @@ class TimeFeatureTransformer(BaseTransformer):
         return self.transform(referral_table)
 
     def transform(self, referral_table):
-        valid_referrals = (referral_table[referral_table['referral_referraltakendate']
-                            >= self.dataset_start_date].copy())
-        valid_referrals['timefeature_referralnumber'] =( valid_referrals
-                                                        .groupby('referral_clientid')
-                                                        ['referral_referraltakendate'].rank())
-        referral_table['timefeature_referralnumber'] = (valid_referrals['timefeature_referralnumber']
-                                                        .loc[referral_table.index])
+        # Rank only the columns the rank needs, rather than a copy of every feature column
+        valid = referral_table['referral_referraltakendate'] >= self.dataset_start_date
+        referral_numbers = (referral_table['referral_referraltakendate'][valid]
+                            .groupby(referral_table['referral_clientid'][valid]).rank())
+        referral_table['timefeature_referralnumber'] = referral_numbers.loc[referral_table.index]
         # Add burst features
-        referral_table = referral_table.sort_values('referral_referraltakendate')
+        referral_table = sort_rows(referral_table, 'referral_referraltakendate')
         referral_table['timefeature_dayssincelastreferral'] = (referral_table.groupby('referral_clientid')
                                                     ['referral_referraltakendate'].diff().dt.days
                                                     .fillna(0))
@@ -60,7 +192,15 @@ class TimeFeatureTransformer(BaseTransformer):
         ## Add a total referrals per client column - this can be used for sample weighting
         client_count = referral_table.groupby('referral_clientid')[['referral_referraltakendate']].count()
         client_count = client_count.rename(columns={'referral_referraltakendate':'timefeature_totalreferralsforclient'})
-        referral_table = referral_table.merge(client_count, left_on='referral_clientid', right_index=True)
+        # The merge is made on the client ids alone, and its row order applied to the whole table
+        rows = referral_table[['referral_clientid']].reset_index(drop=True).merge(client_count,
+                                                                                  left_on='referral_clientid',
+                                                                                  right_index=True)
+        referral_table = take_rows(referral_table, rows.index)
+        referral_table['timefeature_totalreferralsforclient'] = rows['timefeature_totalreferralsforclient'].values
+        # Models pickled before the dtype policy existed have no compact attribute
+        if getattr(self, 'compact', False):
+            referral_table = compact_columns(referral_table, self.COMPACT_COLUMNS)
         return referral_table
 
 class ConsolidateTablesTransformer(BaseTransformer):
@@ -84,12 +224,25 @@ class ConsolidateTablesTransformer(BaseTransformer):
     'referraldocument': ('referralinstanceid','referraldocumentid'),
     }
 
-    def __init__(self, count_encode):
+    DUMMIED_COLUMNS = ['clientcountryid', 'clientaddresstypeid', 'addresslocalityid', 'clientresidencyid']
+
+    # Merge and group keys stay integers, as grouping by a categorical makes a group of every category
+    KEY_COLUMNS = ['referral_referralinstanceid', 'referral_clientid', 'client_clientid']
+
+    def __init__(self, count_encode, sparse=False, compact=False):
         """
 
         :param count_encode: Whether to use count encoding for categorical variables
+        :param sparse: Build the one-hot client columns and the flattened referral tables as sparse columns, which
+        only store their nonzero cells (requires pandas >= 0.25)
+        :param compact: Store the one-hot and count columns, which are 0 where absent as in X, in the smallest integer
+        types, and the other referral ids and repeated strings as categoricals
         """
+        if sparse:
+            check_sparse_support()
         self.count_encode = count_encode
+        self.sparse = sparse
+        self.compact = compact
 
     def transform(self, tables):
         rt = self.generate_master_referral_table(tables, training=False)
@@ -99,10 +252,45 @@ class ConsolidateTablesTransformer(BaseTransformer):
         rt = self.generate_master_referral_table(tables, training=True)
         return rt
         
+    def sparse_flat_table(self, table, key, referral_ids):
+        """The count of each item of a referral child table per referral, as the groupby().size().unstack() flattening
+        merged onto the referral rows gives it, with a sparse column per item that stores only the nonzero counts
+
+        :param table: The referral child table
+        :param key: Name of the table, the prefix of its columns
+        :param referral_ids: Index of the referral ids of the rows to return
+        """
+        referral_column, item_column = self.FLATTEN_TABLES_COLUMN_MAPPING[key]
+        table = table[table[referral_column].notnull() & table[item_column].notnull()]
+        item_codes, items = pd.factorize(table[item_column], sort=True)
+        rows = referral_ids.get_indexer(table[referral_column])
+        matched = rows != -1
+        counts = scipy.sparse.csc_matrix((np.ones(matched.sum()), (rows[matched], item_codes[matched])),
+                                         shape=(len(referral_ids), len(items)))
+        counts.sum_duplicates()
+        return pd.DataFrame.sparse.from_spmatrix(counts, index=referral_ids,
+                                                 columns=['{}_{}'.format(key, item) for item in items])
+
     def process_referral_table(self, referral_table):
         referral_table['referraltakendate'] = pd.to_datetime(referral_table['referraltakendate'])
         referral_table = referral_table.add_prefix('referral_')
+        if getattr(self, 'compact', False):
+            referral_table = self.categorize(referral_table)
         return referral_table
+
+    def categorize(self, referral_table):
+        """Stores the referral ids other than the keys, and the strings which repeat, as categoricals, which are
+        carried through the merges as small integer codes"""
+        categories = []
+        for column in referral_table.columns:
+            values = referral_table[column]
+            if column in self.KEY_COLUMNS:
+                continue
+            if column.endswith('id') and pd.api.types.is_numeric_dtype(values):
+                categories.append(column)
+            elif values.dtype == object and values.nunique() < len(values) / 2:
+                categories.append(column)
+        return referral_table.astype({column: 'category' for column in categories})
     
     def process_client_table(self, client_table, training=True):
         client_table['clientdateofbirth'] = pd.to_datetime(client_table['clientdateofbirth'])
@@ -118,7 +306,7 @@ class ConsolidateTablesTransformer(BaseTransformer):
         client_table['addresslength'] = (datetime.now() -
                                              client_table['addresssincedate']).dt.days / 365
 
-        dummied_cols = ['clientcountryid', 'clientaddresstypeid', 'addresslocalityid', 'clientresidencyid']
+        dummied_cols = self.DUMMIED_COLUMNS
         client_table[dummied_cols] = client_table[dummied_cols].astype(str)
         if self.count_encode:
             if training:
@@ -154,7 +342,6 @@ class ConsolidateTablesTransformer(BaseTransformer):
             raise Exception('referral table contains no data, this table must be populated')
                                  
         # Flatten all other referral related tables and join to referral table
-        flat_tables = {}
         for key in self.FLATTEN_TABLES_COLUMN_MAPPING.keys():
             if not tables[key].empty:
                 if self.count_encode:
@@ -164,9 +351,15 @@ class ConsolidateTablesTransformer(BaseTransformer):
 
                     flat_table = (tables[key].assign(**{item_id: self.encoding}).groupby(self.FLATTEN_TABLES_COLUMN_MAPPING[key])
                                                 .size().unstack().add_prefix(key + '_'))
+                elif getattr(self, 'sparse', False):
+                    # Added once the rows are in their final order, see add_sparse_features
+                    continue
                 else:
                     flat_table = (tables[key].groupby(list(self.FLATTEN_TABLES_COLUMN_MAPPING[key]))
                                                 .size().unstack().add_prefix(key + '_'))
+                if getattr(self, 'compact', False):
+                    # Counts are exact in float32, which holds the nulls of the left merge in half the memory
+                    flat_table = flat_table.astype(np.float32)
                 referral_table = referral_table.merge(flat_table, left_on='referral_referralinstanceid',
                                                       right_index=True, how='left')
 
@@ -185,14 +378,45 @@ class ConsolidateTablesTransformer(BaseTransformer):
                                     left_on='client_clientid', right_index=True, how='left')
         else:
             pass
-        
+        if getattr(self, 'compact', False):
+            client_table = compact_columns(client_table, [c for c in client_table.columns
+                                                          if c.startswith(self.count_prefixes())], fill_value=0)
+
         # Join Client and referral Table together into master table
         master_table = referral_table.merge(client_table, left_on='referral_clientid',
                                             right_on='client_clientid', how='left')
 
         # Order by referral taken date - this is important for spliting the train/test sets
         master_table = master_table.sort_values(['referral_referraltakendate', 'referral_referralinstanceid'])
-        return master_table.set_index('referral_referralinstanceid')
+        master_table = master_table.set_index('referral_referralinstanceid')
+        if getattr(self, 'sparse', False):
+            master_table = self.add_sparse_features(master_table, tables)
+        if getattr(self, 'compact', False):
+            master_table = self.compact_counts(master_table)
+        return master_table
+
+    def count_prefixes(self):
+        """Prefixes of the one-hot and count columns, which are absent, so 0 in X, where null"""
+        return tuple(['{}_'.format(key) for key in self.FLATTEN_TABLES_COLUMN_MAPPING]
+                     + ['client_{}_'.format(c) for c in self.DUMMIED_COLUMNS] + ['clientissue_'])
+
+    def compact_counts(self, master_table):
+        return compact_columns(master_table, [c for c in master_table.columns if c.startswith(self.count_prefixes())],
+                               fill_value=0)
+
+    def add_sparse_features(self, master_table, tables):
+        """Adds the flattened referral tables as sparse columns and makes the one-hot client and client issue columns
+        sparse, in the column order of the dense path. This is done once the rows are in their final order, because
+        reordering sparse columns costs far more than reordering dense ones"""
+        flat_tables = [self.sparse_flat_table(tables[key], key, master_table.index)
+                       for key in self.FLATTEN_TABLES_COLUMN_MAPPING if not tables[key].empty]
+        referral_columns = [c for c in master_table.columns if c.startswith('referral_')]
+        client_table = master_table.drop(referral_columns, axis=1)
+        sparse_prefixes = tuple(['client_{}_'.format(c) for c in self.DUMMIED_COLUMNS] + ['clientissue_'])
+        for column in client_table.columns:
+            if column.startswith(sparse_prefixes):
+                client_table[column] = pd.arrays.SparseArray(client_table[column].values, fill_value=0)
+        return pd.concat([master_table[referral_columns]] + flat_tables + [client_table], axis=1)
 
 class AddFutureReferralTargetFeatures(BaseTransformer):
     """
@@ -202,21 +426,31 @@ class AddFutureReferralTargetFeatures(BaseTransformer):
     (number of referrals - number of gaps) / (52) in the time t to t + window in the future, which is bounded by 1 which
     implies constant use in the year following the datapoint.
     """
-    def __init__(self, window=365, break_length=28, break_coefficients=1):
+    TARGET_COLUMNS = ['futurereferraltargetfeature_futurereferralcount',
+                      'futurereferraltargetfeature_futurereferralscore',
+                      'futurereferraltargetfeature_futurereferralgaps']
+
+    def __init__(self, window=365, break_length=28, break_coefficients=1, vectorized=True):
         """
 
         :param window: Lookahead period in days
         :param break_length: Definition of a gap
         :param break_coefficients: Bonus to the client for successful gap
+        :param vectorized: Use the single pass engine rather than the per referral number loop
         """
         self.window = window
         self.break_length = break_length
         self.break_coefficients = break_coefficients
+        self.vectorized = vectorized
 
 
     def fit_transform(self, referral_table):
-        referral_table = self.calc_look_ahead_stats(referral_table, self.window,
-                                                    self.break_length, self.break_coefficients)
+        if self.vectorized:
+            calc_look_ahead_stats = self.calc_look_ahead_stats_vectorized
+        else:
+            calc_look_ahead_stats = self.calc_look_ahead_stats
+        referral_table = calc_look_ahead_stats(referral_table, self.window,
+                                               self.break_length, self.break_coefficients)
         return referral_table
 
     def transform(self, referral_table):
@@ -251,14 +485,90 @@ class AddFutureReferralTargetFeatures(BaseTransformer):
         referrals[all_ratios_df.columns] = all_ratios_df
         return referrals 
 
+    def calc_look_ahead_stats_vectorized(self, referrals, window=365, break_length=28, break_coefficient=1):
+        """Computes the same statistics as calc_look_ahead_stats in a single pass. Once referrals are sorted by client
+        and date, the look ahead window of every referral is a contiguous slice [start, end) of the sorted arrays, so
+        counts are end - start - 1 and gaps are a difference of the cumulative sum of the gap indicator
+        """
+        client_codes = pd.factorize(referrals['referral_clientid'])[0]
+        dates = referrals['referral_referraltakendate'].values.astype('datetime64[ns]').view('i8')
+        one_day = np.timedelta64(1, 'D').astype('timedelta64[ns]').astype('i8')
+
+        order = np.lexsort((dates, client_codes))
+        sorted_clients = client_codes[order]
+        sorted_dates = dates[order]
+        n = len(order)
+
+        # The window starts at the first referral of the client on the same date, including same day referrals
+        # which were ordered before the reference referral
+        new_run = np.ones(n, dtype=bool)
+        new_run[1:] = (sorted_clients[1:] != sorted_clients[:-1]) | (sorted_dates[1:] != sorted_dates[:-1])
+        start = np.maximum.accumulate(np.where(new_run, np.arange(n), 0))
+
+        # The loop keeps referrals whose whole number of days after the reference date is <= window
+        end = _lexsorted_search(sorted_clients, sorted_dates, sorted_clients, sorted_dates + (window + 1) * one_day)
+
+        same_client = np.zeros(n, dtype=bool)
+        same_client[1:] = sorted_clients[1:] == sorted_clients[:-1]
+        days_between = np.zeros(n, dtype=np.int64)
+        days_between[1:] = (sorted_dates[1:] - sorted_dates[:-1]) // one_day
+        cumulative_gaps = np.cumsum(same_client & (days_between > break_length))
+
+        counts = (end - start - 1).astype(float)
+        gaps = (cumulative_gaps[end - 1] - cumulative_gaps[start]).astype(float)
+        scores = (counts - gaps * break_coefficient) / (window / 7)
+
+        # The loop never reaches the highest referral number, so those referrals (and referrals without a client)
+        # are left empty to keep the outputs identical
+        referral_no = referrals.groupby('referral_clientid').cumcount().values + 1
+        missing = (referral_no == referral_no.max()) | (client_codes == -1)
+        missing = missing[order]
+
+        referrals = referrals.copy()
+        for column, values in zip(self.TARGET_COLUMNS, [counts, scores, gaps]):
+            values[missing] = np.nan
+            column_values = np.empty(n)
+            column_values[order] = values
+            referrals[column] = column_values
+        return referrals
+
+
+def _lexsorted_search(sorted_groups, sorted_values, groups, values):
+    """Equivalent of np.searchsorted(side='left') for (group, value) pairs, where sorted_groups and sorted_values are
+    lexicographically sorted by group then value. The queries are merged into the sorted data with a single lexsort
+    and the number of data points ahead of each query is read off a cumulative count
+    """
+    is_data = np.concatenate([np.zeros(len(groups), dtype=bool), np.ones(len(sorted_groups), dtype=bool)])
+    order = np.lexsort((is_data, np.concatenate([values, sorted_values]),
+                        np.concatenate([groups, sorted_groups])))
+    data_before = np.cumsum(is_data[order])
+    is_query = ~is_data[order]
+    positions = np.empty(len(groups), dtype=np.int64)
+    positions[order[is_query]] = data_before[is_query]
+    return positions
+
 class SplitCurrentAndEverTransformer(BaseTransformer):
     """This Transformer takes the full referral dataframe and for a selected set of
         features splits them out into current referral features and ever referral features.
         e.g. current referral feature might be if a client has been referred by Agency 1
         but ever referral feature might be if a client has ever been referred by Agency1"""
     
-    def __init__(self, features_classes_to_split):
+    EVER_FORMATS = ['dense', 'sparse']
+
+    def __init__(self, features_classes_to_split, vectorized=True, ever_format='dense'):
+        """
+
+        :param features_classes_to_split: Column prefixes of the features to split
+        :param vectorized: Compute the ever features as a grouped cumulative max rather than a grouped expanding sum
+        :param ever_format: 'dense' for boolean columns, or 'sparse' for sparse boolean columns which only store the
+        flags that are set, at about five bytes a flag, so it saves memory when under a fifth of the flags are set
+        (requires pandas >= 0.25)
+        """
+        if ever_format not in self.EVER_FORMATS:
+            raise ValueError('ever_format must be one of {}'.format(self.EVER_FORMATS))
         self.features_classes_to_split = features_classes_to_split
+        self.vectorized = vectorized
+        self.ever_format = ever_format
 
     def transform(self, referral_table):
         # Get list of features to split that are in dataframe
@@ -268,18 +578,61 @@ class SplitCurrentAndEverTransformer(BaseTransformer):
 
         # Get dataframe of current features
         current_features = referral_table[features_to_split]
-        # Get any time features
-        any_features = current_features.groupby(referral_table['referral_clientid'],
-                                                as_index=False, sort=False).expanding().sum() > 0
-        any_features.index = any_features.index.droplevel(0)
-        # Re-index to the referral table
-        any_features = any_features.loc[referral_table.index]
+        # Get any time features, models pickled before the fast path existed have none of its attributes
+        if getattr(self, 'vectorized', True):
+            ever_flags = self.get_ever_flags(current_features, referral_table['referral_clientid'])
+            any_features = self.ever_flags_to_frame(ever_flags, current_features.index, current_features.columns,
+                                                    getattr(self, 'ever_format', 'dense'))
+        else:
+            any_features = current_features.groupby(referral_table['referral_clientid'],
+                                                    as_index=False, sort=False).expanding().sum() > 0
+            any_features.index = any_features.index.droplevel(0)
+            # Re-index to the referral table
+            any_features = any_features.loc[referral_table.index]
         # Remove the original features from referral table
         referral_table = referral_table.drop(features_to_split, axis=1)
         # Merge all three together
         return pd.concat([referral_table, current_features.add_suffix('_current'),
                           any_features.add_suffix('_ever')], axis=1)
 
+    @staticmethod
+    def get_ever_flags(current_features, client_ids, chunk_size=64):
+        """Whether each feature has been positive for the client in this or any earlier row of the table, as a uint8
+        block aligned with current_features.
+
+        Rows are stably sorted by client so each client is a contiguous segment. Within a chunk of columns, a running
+        maximum of the row numbers where the feature is positive gives the last positive row so far, and the flag is
+        set when that row falls inside the client's own segment.
+
+        :param current_features: DataFrame of non-negative feature values, NaN counts as not present
+        :param client_ids: Series of client ids aligned with current_features
+        :param chunk_size: Number of columns processed at a time, which bounds the int32 working memory
+        """
+        client_codes = pd.factorize(client_ids)[0]
+        order = np.argsort(client_codes, kind='mergesort')
+        sorted_codes = client_codes[order]
+        row_numbers = np.arange(len(order), dtype=np.int32)
+        segment_start = np.ones(len(order), dtype=bool)
+        segment_start[1:] = sorted_codes[1:] != sorted_codes[:-1]
+        segment_start = np.maximum.accumulate(np.where(segment_start, row_numbers, 0))[:, np.newaxis]
+
+        flags = np.empty(current_features.shape, dtype=np.uint8)
+        for start in range(0, current_features.shape[1], chunk_size):
+            values = current_features.iloc[:, start:start + chunk_size].values[order]
+            last_positive = np.where(values > 0, row_numbers[:, np.newaxis], -1)
+            np.maximum.accumulate(last_positive, axis=0, out=last_positive)
+            flags[order, start:start + chunk_size] = last_positive >= segment_start
+        return flags
+
+    @staticmethod
+    def ever_flags_to_frame(ever_flags, index, columns, ever_format='dense'):
+        if ever_format == 'sparse':
+            if not sparse_supported():
+                raise ValueError('ever_format="sparse" requires pandas >= 0.25')
+            return sparse_frame({column: pd.arrays.SparseArray(ever_flags[:, i].astype(bool), fill_value=False)
+                                 for i, column in enumerate(columns)}, index, columns)
+        return pd.DataFrame(ever_flags.astype(bool), index=index, columns=columns)
+
 class AlignFeaturesToColumnSchemaTransformer(object):
     """This transformer takes the column schema defined by the model and
         selects the features from the referral table using this schema
@@ -308,36 +661,80 @@ class AlignFeaturesToColumnSchemaTransformer(object):
                 'timefeature_burstnumber', 'timefeature_referralnumber']
 
 
-    def __init__(self):
+    def __init__(self, sparse=False, dtype='float64'):
+        """
+
+        :param sparse: Return X as sparse float columns, which model_input turns into a CSR matrix (requires
+        pandas >= 0.25)
+        :param dtype: Float dtype of X. The trees compare features as float32, so float32 gives the same predictions
+        in half the memory. It's kept with the fitted column schema, so transform builds X as training did
+        """
+        if sparse:
+            check_sparse_support()
         self.column_schema = None
+        self.sparse = sparse
+        self.dtype = dtype
         
     def fit_transform(self, referral_table):
         self.column_schema = list(referral_table.drop(self.to_drop, axis=1, errors='ignore').columns)
-        referral_table = referral_table.sort_values('referral_referraltakendate')
-        X = referral_table.reindex(self.column_schema, axis=1)
+        referral_table = sort_rows(referral_table, 'referral_referraltakendate')
+        X = self.align(referral_table)
         y = referral_table['futurereferraltargetfeature_futurereferralscore']
-        return X.fillna(0), y.fillna(0), referral_table.drop(X.columns, axis=1, errors='ignore')
+        return X, y.fillna(0), referral_table.drop(X.columns, axis=1, errors='ignore')
 
     def transform(self, referral_table):
-        referral_table = referral_table.sort_values('referral_referraltakendate')
-        X = referral_table.reindex(self.column_schema, axis=1)
-        return X.fillna(0), None, referral_table.drop(X.columns, axis=1, errors='ignore')
+        referral_table = sort_rows(referral_table, 'referral_referraltakendate')
+        X = self.align(referral_table)
+        return X, None, referral_table.drop(X.columns, axis=1, errors='ignore')
+
+    def align(self, referral_table):
+        # Models pickled before the sparse path and dtype policy existed have neither attribute
+        dtype = getattr(self, 'dtype', 'float64')
+        if getattr(self, 'sparse', False):
+            return self.align_sparse(referral_table, dtype)
+        if dtype == 'float64':
+            return referral_table.reindex(self.column_schema, axis=1).fillna(0)
+        # Cast before filling, so the nulls are filled in the smaller copy
+        X = referral_table.reindex(self.column_schema, axis=1, fill_value=0).astype(dtype)
+        return X.fillna(0) if X.isnull().values.any() else X
+
+    def align_sparse(self, referral_table, dtype='float64'):
+        """The schema columns as sparse float columns with a fill value of 0, missing columns and nulls are 0"""
+        columns = {}
+        for column in self.column_schema:
+            if column not in referral_table.columns:
+                columns[column] = pd.arrays.SparseArray(np.zeros(len(referral_table), dtype=dtype), fill_value=0)
+                continue
+            values = referral_table[column].values
+            if isinstance(values, pd.arrays.SparseArray) and values.fill_value == 0:
+                # Already sparse around 0, only the stored values need converting
+                stored = values.sp_values.astype(dtype)
+                columns[column] = pd.arrays.SparseArray(np.where(np.isnan(stored), 0, stored),
+                                                        sparse_index=values.sp_index, fill_value=0)
+            else:
+                dense = np.asarray(values, dtype=dtype)
+                columns[column] = pd.arrays.SparseArray(np.where(np.isnan(dense), 0, dense), fill_value=0)
+        return sparse_frame(columns, referral_table.index, self.column_schema)
 
 
 class TimeWindowFeatures(BaseTransformer):
     """
     Appends the referral count for the past n week windows
     """
-    def __init__(self, windows):
+    def __init__(self, windows, vectorized=True, compact=False):
         """
 
         :param windows: List<int> where each integer represents a week length window to append
+        :param vectorized: Count all windows in one pass over week binned arrays rather than with grouped applies
+        :param compact: Store the counts in the smallest dtype which holds them
         """
         self.windows = windows
+        self.vectorized = vectorized
+        self.compact = compact
 
     def get_rolling_count(self, referrals, window_size=10):
         unrolled = referrals.set_index('referral_referraltakendate').groupby('client_clientid').apply(
-            lambda k: k.groupby(pd.TimeGrouper('1W', convention='e')).size())
+            lambda k: k.groupby(pd.Grouper(freq='1W')).size())
         # if only one client, split-apply-combine returns strange shape
         if unrolled.index.name == 'client_clientid':
             unrolled = unrolled.T
@@ -363,24 +760,129 @@ class TimeWindowFeatures(BaseTransformer):
             df['window_count_{}'.format(i)] = ewm
         return df
 
+    def get_all_rolling_counts_vectorized(self, windows, referrals):
+        """Bins every referral into its client's week once, as a sortable (client, week) integer key. The count for a
+        window of n weeks is then the number of keys between (client, week - n + 1) and (client, week) inclusive,
+        which is two binary searches into the sorted keys for each window
+        """
+        referrals['weeks'] = week_ending(referrals['referral_referraltakendate'])
+        client_codes = pd.factorize(referrals['client_clientid'])[0]
+        has_client = client_codes != -1
+        week_numbers = week_number(referrals['weeks'])
+
+        df = pd.DataFrame(index=referrals.index)
+        if not has_client.any():
+            for i in windows:
+                df['window_count_{}'.format(i)] = np.nan
+            return df
+
+        # Offset the weeks so that looking back the longest window never reaches the previous client's keys
+        max_window = max(windows)
+        first_week = week_numbers[has_client].min()
+        weeks_per_client = week_numbers[has_client].max() - first_week + 1 + max_window
+        keys = client_codes * weeks_per_client + (week_numbers - first_week + max_window)
+        sorted_keys = np.sort(keys[has_client])
+
+        window_end = np.searchsorted(sorted_keys, keys, side='right')
+        for i in windows:
+            counts = (window_end - np.searchsorted(sorted_keys, keys - (i - 1), side='left')).astype(float)
+            counts[~has_client] = np.nan
+            df['window_count_{}'.format(i)] = counts
+        return df
+
     def fit_transform(self, X):
-        time_features = self.get_all_rolling_counts(self.windows, X)
+        # Models pickled before the vectorized engine existed have no vectorized attribute, the engines agree so
+        # those use the faster one too
+        if getattr(self, 'vectorized', True):
+            time_features = self.get_all_rolling_counts_vectorized(self.windows, X)
+        else:
+            time_features = self.get_all_rolling_counts(self.windows, X)
+        if getattr(self, 'compact', False):
+            time_features = compact_columns(time_features, time_features.columns)
         return pd.concat([X, time_features], axis=1)
 
     def transform(self, X):
         return self.fit_transform(X)
 
+def week_ending(dates):
+    """Maps each date to the Sunday which ends its week, which is the label a 1W Grouper gives the date's bin
+
+    :param dates: Series of datetimes
+    """
+    return (dates - pd.to_timedelta(dates.dt.dayofweek, unit='d') + pd.to_timedelta(6, unit='d')).dt.normalize()
+
+def week_number(weeks):
+    """Consecutive integer numbering of week ending dates, so that consecutive weeks differ by one
+
+    :param weeks: Series of week ending dates as returned by week_ending
+    """
+    return weeks.values.astype('datetime64[D]').astype(np.int64) // 7
+
+def step_fingerprint(step):
+    """The class and parameters of an unfitted transformer, which determine what it produces from a given input"""
+    return [type(step).__name__, sorted(vars(step).items())]
+
+def data_fingerprint(data):
+    """Hashes the contents of a DataFrame, or a dictionary of DataFrames such as the input tables"""
+    if isinstance(data, dict):
+        return [[name, data_fingerprint(data[name])] for name in sorted(data)]
+    sha256 = hashlib.sha256(pd.util.hash_pandas_object(data, index=True).values.tobytes())
+    sha256.update(json.dumps([[str(c), str(t)] for c, t in data.dtypes.items()]).encode('utf-8'))
+    return sha256.hexdigest()
+
 class TransformerPipeline(BaseTransformer):
-    def __init__(self, steps, aligner):
+    def __init__(self, steps, aligner, memory=None):
+        """
+
+        :param steps: Transformers applied in order
+        :param aligner: AlignFeaturesToColumnSchemaTransformer producing X, y and the referral table
+        :param memory: DiskCache to memoize the fitted steps and their outputs in, so that fit_transform reruns only
+        the steps whose parameters or input changed
+        """
         self.pipeline = steps
         self.aligner = aligner
+        self.memory = memory
+
+    def fingerprint(self):
+        """Identifies the configuration of the unfitted pipeline, for keying cached outputs of it"""
+        return [CODE_VERSION] + [step_fingerprint(step) for step in self.pipeline + [self.aligner]]
+
+    def fit_transform(self, X, profiler=None):
+        """
+
+        :param profiler: Profiler recording each step as a stage
+        """
+        if profiler is None:
+            profiler = Profiler(enabled=False)
+        # Pipelines pickled before memoization existed have no memory attribute
+        if getattr(self, 'memory', None) is not None:
+            return self.memoized_fit_transform(X, profiler)
 
-    def fit_transform(self, X):
         for transformer in self.pipeline:
             logger.debug('{} fit_transform'.format(type(transformer).__name__))
-            X = transformer.fit_transform(X)
-
-        return self.aligner.fit_transform(X)
+            X = profiler.call(type(transformer).__name__, transformer.fit_transform, X)
+
+        return profiler.call(type(self.aligner).__name__, self.aligner.fit_transform, X)
+
+    def memoized_fit_transform(self, X, profiler):
+        """fit_transform taking each fitted step and its output from memory when they were built before. Each step's key
+        chains the previous step's key with the step's parameters, so it identifies the pipeline input and every step
+        up to and including this one, and only the steps from the first changed one onwards rerun"""
+        steps = self.pipeline + [self.aligner]
+        # ConsolidateTablesTransformer measures ages from today, so outputs are only reused on the day they're built
+        key = self.memory.key('pipeline input', data_fingerprint(X), str(datetime.now().date()))
+        for i, step in enumerate(steps):
+            key = self.memory.key(key, CODE_VERSION, step_fingerprint(step))
+            name = '{} fit_transform'.format(type(step).__name__)
+            cached = self.memory.get(key, name)
+            if cached is None:
+                X = profiler.call(type(step).__name__, step.fit_transform, X)
+                self.memory.put(key, (step, X), name)
+            else:
+                steps[i], X = cached
+                profiler.record_cached(type(step).__name__, X)
+        self.pipeline, self.aligner = steps[:-1], steps[-1]
+        return X
 
     def transform(self, X):
         for transformer in self.pipeline:
@@ -388,6 +890,12 @@ class TransformerPipeline(BaseTransformer):
 
         return self.aligner.transform(X)
 
+    def __getstate__(self):
+        # The cache belongs to the process that fitted the pipeline, not to the model
+        state = dict(self.__dict__)
+        state.pop('memory', None)
+        return state
+
 class ParseJSONToTablesTransformer(BaseTransformer):
     """This transformer takes the json from the request
     and turns it into a dictionary of tables"""
@@ -407,43 +915,99 @@ class ParseJSONToTablesTransformer(BaseTransformer):
 
 class TrainingDataGenerator(object):
     """
-    A legacy object for creating a training matrix direct from an sqlite database dump of the TWC database
+    A legacy object for creating a training matrix direct from an sqlite database dump of the TWC database. Filters
+    on the referrals are applied in the queries, and the other tables are cut down to the rows of the selected
+    referrals and their clients there too, so only the rows which are used are read
     """
-    SQL_DICT = {'referral': """SELECT * FROM referral;""",
-                
-                'client': """SELECT * FROM Client;""",
-                
-                'referralbenefit':"""SELECT ref_dim.* FROM referralbenefit as ref_dim
-                LEFT JOIN  referral on referral.referralinstanceid = ref_dim.referralinstanceid;""",
-                
-                'referraldietaryrequirements':"""SELECT ref_dim.* FROM referraldietaryRequirements as ref_dim
-                LEFT JOIN  referral on referral.referralinstanceid = ref_dim.referralinstanceid;""",
-
-                'referraldocument':"""SELECT ref_dim.* FROM referraldocument as ref_dim
-                LEFT JOIN  referral on referral.referralinstanceid = ref_dim.referralinstanceid;""",
-
-                'referraldomesticcircumstances': """SELECT ref_dim.* FROM referralDomesticCircumstances as ref_dim
-                LEFT JOIN  referral on referral.referralinstanceid = ref_dim.referralinstanceid;""",
-
-                'referralissue':"""SELECT ref_dim.* FROM referralIssue as ref_dim
-                LEFT JOIN  referral on referral.referralinstanceid = ref_dim.referralinstanceid;""",
-
-                'referralreason': """SELECT ref_dim.* FROM referralReason as ref_dim
-                LEFT JOIN  referral on referral.referralinstanceid = ref_dim.referralinstanceid;""",
-
-                'clientissue': """SELECT * FROM clientissue;"""
-                }
-    
-    def __init__(self, database_path):
-        self.con = sqlite3.connect(database_path)
+    # Names of the tables in the database, which differ in case from the table names
+    TABLES = {'referral': 'referral', 'client': 'Client', 'referralbenefit': 'referralbenefit',
+              'referraldietaryrequirements': 'referraldietaryRequirements', 'referraldocument': 'referraldocument',
+              'referraldomesticcircumstances': 'referralDomesticCircumstances', 'referralissue': 'referralIssue',
+              'referralreason': 'referralReason', 'clientissue': 'clientissue'}
 
-    def get_training_data(self, limit=None):
-        tables_dict = {k: pd.read_sql(v, con=self.con) for k, v in self.SQL_DICT.items()}
-        for k, t in tables_dict.items():
-            t.columns = [c.lower() for c in t.columns]
+    # Tables keyed by client rather than by referral
+    CLIENT_TABLES = ['client', 'clientissue']
 
-        if limit is not None:
-            tables_dict['referral'] = (tables_dict['referral'][tables_dict['referral']
-                                                ['referralinstanceid'] < limit])
+    # The keys and the item ids which become feature names are read as integers as in the json dumps. A column with
+    # nulls is left as the floats sqlite reads it as, since the nulls are handled downstream
+    DTYPES = {'referralinstanceid': np.int64, 'clientid': np.int64}
+    DTYPES.update({item_id: np.int64
+                   for _, item_id in ConsolidateTablesTransformer.FLATTEN_TABLES_COLUMN_MAPPING.values()})
 
-        return tables_dict
+    DATE_COLUMNS = ['referraltakendate', 'clientdateofbirth', 'addresssincedate']
+
+    def __init__(self, database_path, create_indexes=False):
+        """
+
+        :param database_path: Path of the sqlite database, or ':memory:'
+        :param create_indexes: Create the indexes the filtered queries look rows up by in the database if it doesn't
+        have them, which changes the database so is only done when asked
+        """
+        self.con = sqlite3.connect(database_path)
+        self.create_indexes = create_indexes
+
+    def ensure_indexes(self):
+        """Creates the indexes on the referral and client ids which the filtered queries look rows up by"""
+        existing = {row[0] for row in self.con.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        for table in self.TABLES.values():
+            columns = [row[1].lower() for row in self.con.execute('PRAGMA table_info({})'.format(table))]
+            for column in ['referralinstanceid', 'clientid']:
+                name = 'ix_{}_{}'.format(table, column)
+                if column in columns and name not in existing:
+                    logger.info('Creating index {} on {}.{}'.format(name, table, column))
+                    self.con.execute('CREATE INDEX {} ON {} ({})'.format(name, table, column))
+        self.con.commit()
+
+    def referral_filter(self, limit=None, start_date=None, end_date=None, client_ids=None):
+        """The WHERE clause selecting the referrals and its parameters, the clause is empty if there are no filters"""
+        conditions, params = [], []
+        # Dates are stored as text, with or without a time and with a space or T before it, so both sides are compared
+        # as sqlite's normalised datetime rather than as strings
+        if start_date is not None:
+            conditions.append('datetime(referraltakendate) >= datetime(?)')
+            params.append(pd.Timestamp(start_date).strftime('%Y-%m-%d %H:%M:%S'))
+        if end_date is not None:
+            conditions.append('datetime(referraltakendate) < datetime(?)')
+            params.append(pd.Timestamp(end_date).strftime('%Y-%m-%d %H:%M:%S'))
+        if client_ids is not None:
+            # A temporary table holds any number of ids, where a parameter per id is limited to 999
+            self.con.execute('DROP TABLE IF EXISTS temp.selected_clients')
+            self.con.execute('CREATE TEMP TABLE selected_clients (clientid INTEGER PRIMARY KEY)')
+            self.con.executemany('INSERT OR IGNORE INTO temp.selected_clients VALUES (?)',
+                                 ((int(c),) for c in client_ids))
+            conditions.append('clientid IN (SELECT clientid FROM temp.selected_clients)')
+        if limit is not None:
+            conditions.append('referralinstanceid < ?')
+            params.append(limit)
+        return (' WHERE ' + ' AND '.join(conditions)) if conditions else '', params
+
+    def table_query(self, table_name, where):
+        table = self.TABLES[table_name]
+        if not where or table_name == 'referral':
+            return 'SELECT * FROM {}{}'.format(table, where)
+        key = 'clientid' if table_name in self.CLIENT_TABLES else 'referralinstanceid'
+        return 'SELECT * FROM {0} WHERE {1} IN (SELECT {1} FROM referral{2})'.format(table, key, where)
+
+    def read_table(self, query, params):
+        """Reads the result of a query, parsing its dates and casting its keys and item ids without nulls to
+        integers"""
+        table = pd.read_sql_query(query, self.con, params=params)
+        table.columns = [c.lower() for c in table.columns]
+        for column in self.DATE_COLUMNS:
+            if column in table.columns:
+                table[column] = pd.to_datetime(table[column])
+        return table.astype({c: t for c, t in self.DTYPES.items() if c in table.columns and table[c].notnull().all()})
+
+    def get_training_data(self, limit=None, start_date=None, end_date=None, client_ids=None):
+        """The dictionary of tables of the selected referrals, as ConsolidateTablesTransformer takes it
+
+        :param limit: Only take referrals with ids below this
+        :param start_date: Only take referrals taken on or after this date
+        :param end_date: Only take referrals taken before this date
+        :param client_ids: Only take the referrals of these clients
+        """
+        if self.create_indexes:
+            self.ensure_indexes()
+        where, params = self.referral_filter(limit, start_date, end_date, client_ids)
+        return {table_name: self.read_table(self.table_query(table_name, where), params)
+                for table_name in self.TABLES}
@@ -0,0 +1,112 @@
+import os
+import pickle
+import shutil
+import tempfile
+from unittest import TestCase
+import unittest.mock as mock
+
+import numpy as np
+from flask import Flask
+from sklearn.ensemble import RandomForestRegressor, ExtraTreesRegressor
+
+from api.model.artifact import (save_artifact, load_artifact, check_equivalence, ArtifactFormatError, ARTIFACT_SUFFIX,
+                                PREAMBLE, FlatForest)
+from api.model.models import TWCModel
+from api.model.train import generate_X_y
+from api.utils.synthetic import synthetic_tables
+from api.utils.aws import load_model_into_memory
+from api.utils.registry import ModelRegistry, LocalStorage
+
+
+class TestModelArtifact(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.tables = synthetic_tables(400)
+        self.X, y, _, transformer = generate_X_y({k: t.copy() for k, t in self.tables.items()})
+        forest = RandomForestRegressor(n_estimators=20, n_jobs=1, random_state=0).fit(self.X, y)
+        self.model = TWCModel(transformer, forest)
+        self.path = os.path.join(self.directory, 'twc_model_1' + ARTIFACT_SUFFIX)
+        save_artifact(self.model, self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_artifact_predicts_as_pickle(self):
+        for mmap in [True, False]:
+            loaded = load_artifact(self.path, mmap=mmap)
+            # Summed in tree order, as sklearn does with n_jobs=1, so the predictions are identical
+            np.testing.assert_array_equal(loaded.model.predict(self.X), self.model.model.predict(self.X))
+            self.assertEqual(loaded.predict({k: t.copy() for k, t in self.tables.items()}),
+                             self.model.predict({k: t.copy() for k, t in self.tables.items()}))
+            check_equivalence(self.model, loaded, self.X)
+
+    def test_node_arrays_are_memory_mapped(self):
+        loaded = load_artifact(self.path)
+        self.assertIsInstance(loaded.model.threshold.base, np.memmap)
+        self.assertFalse(loaded.model.threshold.flags.writeable)
+        self.assertEqual(loaded.model.threshold.ctypes.data % 64, 0)
+
+    def test_training_cutoff_is_kept(self):
+        self.assertIsNone(load_artifact(self.path).training_cutoff)
+        self.model.training_cutoff = self.tables['referral']['referraltakendate'].max()
+        save_artifact(self.model, self.path)
+        self.assertEqual(load_artifact(self.path).training_cutoff, self.model.training_cutoff)
+
+    def test_rejects_unknown_files_and_versions(self):
+        with open(self.path, 'r+b') as fh:
+            _, _, header_length = PREAMBLE.unpack(fh.read(PREAMBLE.size))
+            fh.seek(0)
+            fh.write(PREAMBLE.pack(b'TWCMODEL', 99, header_length))
+        with self.assertRaises(ArtifactFormatError):
+            load_artifact(self.path)
+        with open(self.path, 'r+b') as fh:
+            fh.write(b'NOTMODEL')
+        with self.assertRaises(ArtifactFormatError):
+            load_artifact(self.path)
+
+    def test_load_model_into_memory_uses_cached_artifact(self):
+        registry = ModelRegistry(LocalStorage(os.path.join(self.directory, 'bucket')), 'twc_model_', 'twc_status')
+        pickle_path = os.path.join(self.directory, 'twc_model_1')
+        self.model.save(pickle_path)
+        registry.register_model(pickle_path, 'twc_model_1', artifact_path=self.path)
+
+        app = Flask(__name__)
+        app.config.update(USE_MODEL_ARTIFACTS=True, MODEL_CACHE_DIR=os.path.join(self.directory, 'cache'))
+        with app.app_context(), mock.patch('api.utils.aws.get_registry', return_value=registry):
+            download = mock.patch.object(registry.storage, 'download_fileobj',
+                                         wraps=registry.storage.download_fileobj).start()
+            for _ in range(2):
+                loaded = load_model_into_memory('twc_model_1')
+                np.testing.assert_array_equal(loaded.model.predict(self.X), self.model.model.predict(self.X))
+            self.assertEqual(download.call_count, 1)
+            mock.patch.stopall()
+
+
+class TestFlatForestEngine(TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        # Integer valued columns put many rows exactly on split thresholds, and the float64 column has values which
+        # only split the same way once rounded to float32
+        self.X = np.column_stack([rng.randint(0, 5, 2000), rng.randint(0, 2, 2000), rng.rand(2000) * 1e3 + 1e-9])
+        y = self.X[:, 0] * 2 + self.X[:, 1] + rng.rand(2000)
+        self.forest = ExtraTreesRegressor(n_estimators=30, min_samples_leaf=1, n_jobs=1, random_state=0).fit(self.X, y)
+        self.flat = FlatForest.from_sklearn(self.forest)
+
+    def test_bit_for_bit_agreement_with_sklearn(self):
+        for n_rows in [1, 10, 100, 2000]:
+            np.testing.assert_array_equal(self.flat.predict(self.X[:n_rows]), self.forest.predict(self.X[:n_rows]))
+        np.testing.assert_array_equal(self.flat.apply(self.X, chunk_size=7) - self.flat.roots,
+                                      self.forest.apply(self.X))
+
+    def test_rejects_wrong_number_of_features(self):
+        with self.assertRaises(ValueError):
+            self.flat.predict(self.X[:, :2])
+
+    def test_engine_is_selectable_on_twc_model(self):
+        model = TWCModel(None, self.forest)
+        self.assertIs(model.get_predictor(), self.forest)
+        model.set_engine('flat')
+        np.testing.assert_array_equal(model.get_predictor().predict(self.X), self.forest.predict(self.X))
+        self.assertNotIn('_flat_forest', pickle.loads(pickle.dumps(model)).__dict__)
+        with self.assertRaises(ValueError):
+            model.set_engine('gpu')
@@ -0,0 +1,148 @@
+import errno
+import os
+import pickle
+import shutil
+import tempfile
+from unittest import TestCase
+import unittest.mock as mock
+
+import pandas as pd
+
+from api.model.train import generate_X_y, build_transformer_pipeline, load_tables
+from api.utils.synthetic import synthetic_tables
+from api.utils.cache import DiskCache
+
+
+class TestDiskCache(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get_and_put(self):
+        cache = DiskCache(self.directory, 10 ** 6)
+        key = cache.key('tables', 'etag', [1, 2])
+        self.assertEqual(key, DiskCache.key('tables', 'etag', [1, 2]))
+        self.assertNotEqual(key, DiskCache.key('tables', 'other etag', [1, 2]))
+        self.assertIsNone(cache.get(key))
+        frame = pd.DataFrame({'a': [1, 2], 'b': ['x', None]})
+        cache.put(key, frame)
+        pd.testing.assert_frame_equal(cache.get(key), frame)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_evicts_least_recently_used(self):
+        value = b'x' * 1000
+        cache = DiskCache(self.directory, 2500)
+        cache.put('a', value)
+        cache.put('b', value)
+        os.utime(cache.path('a'), (1, 1))
+        os.utime(cache.path('b'), (2, 2))
+        cache.get('a')
+        cache.put('c', value)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), value)
+        self.assertEqual(cache.get('c'), value)
+        self.assertLessEqual(cache.size(), 2500)
+
+    def test_skips_oversized_values_and_drops_unreadable_entries(self):
+        cache = DiskCache(self.directory, 100)
+        cache.put('big', b'x' * 1000)
+        self.assertEqual(os.listdir(self.directory), [])
+        with open(cache.path('broken'), 'wb') as fh:
+            fh.write(b'not a pickle')
+        self.assertIsNone(cache.get('broken'))
+        self.assertFalse(os.path.exists(cache.path('broken')))
+
+    def test_failed_writes_are_not_kept(self):
+        cache = DiskCache(self.directory, 10 ** 6)
+        with mock.patch('pickle.dump', side_effect=OSError(errno.ENOSPC, 'No space left on device')):
+            cache.put('full', b'x' * 1000)
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertIsNone(cache.get('full'))
+
+
+class TestTrainingCache(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = DiskCache(self.directory, 10 ** 9)
+        self.tables = synthetic_tables(400)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_features_are_reused_for_the_same_source(self):
+        X, y, referral_table, _ = generate_X_y({k: t.copy() for k, t in self.tables.items()}, self.cache, 'etag')
+        load = mock.Mock()
+        cached_X, cached_y, cached_referral_table, transformer = generate_X_y(load, self.cache, 'etag')
+        load.assert_not_called()
+        pd.testing.assert_frame_equal(cached_X, X)
+        pd.testing.assert_series_equal(cached_y, y)
+        pd.testing.assert_frame_equal(cached_referral_table, referral_table)
+        self.assertEqual(transformer.aligner.column_schema, list(X.columns))
+
+        load = mock.Mock(return_value={k: t.copy() for k, t in self.tables.items()})
+        generate_X_y(load, self.cache, 'other etag')
+        load.assert_called_once_with()
+
+    def test_steps_are_only_memoized_on_request(self):
+        generate_X_y({k: t.copy() for k, t in self.tables.items()}, self.cache, 'etag', memoize_steps=False)
+        # Only the features
+        self.assertEqual(len(self.cache.entries()), 1)
+
+    def test_tables_are_reused_for_the_same_source(self):
+        tables = load_tables(lambda: [{name: table.to_dict('records')} for name, table in self.tables.items()],
+                             cache=self.cache, source_key='etag')
+        load = mock.Mock()
+        cached = load_tables(load, cache=self.cache, source_key='etag')
+        load.assert_not_called()
+        for name, table in tables.items():
+            pd.testing.assert_frame_equal(cached[name], table)
+
+    def test_fingerprint_changes_with_step_parameters(self):
+        pipeline = build_transformer_pipeline()
+        changed = build_transformer_pipeline()
+        changed.pipeline[3].windows = [1, 4]
+        self.assertEqual(DiskCache.key(pipeline.fingerprint()), DiskCache.key(build_transformer_pipeline().fingerprint()))
+        self.assertNotEqual(DiskCache.key(pipeline.fingerprint()), DiskCache.key(changed.fingerprint()))
+
+
+class TestPipelineMemory(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.memory = DiskCache(self.directory, 10 ** 9)
+        self.tables = synthetic_tables(400)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def fit_transform(self, pipeline):
+        return pipeline.fit_transform({k: t.copy() for k, t in self.tables.items()})
+
+    def assert_outputs_equal(self, left, right):
+        pd.testing.assert_frame_equal(left[0], right[0])
+        pd.testing.assert_series_equal(left[1], right[1])
+        pd.testing.assert_frame_equal(left[2], right[2])
+
+    def test_unchanged_prefix_is_reused(self):
+        fitted = build_transformer_pipeline()
+        expected = self.fit_transform(fitted)
+        self.assert_outputs_equal(self.fit_transform(build_transformer_pipeline(memory=self.memory)), expected)
+        self.assertEqual((self.memory.hits, self.memory.misses), (0, 6))
+
+        pipeline = build_transformer_pipeline(memory=self.memory)
+        self.assert_outputs_equal(self.fit_transform(pipeline), expected)
+        self.assertEqual(self.memory.hits, 6)
+        # The fitted steps come from memory too
+        self.assertEqual(pipeline.pipeline[2].dataset_start_date, fitted.pipeline[2].dataset_start_date)
+        self.assertEqual(pipeline.aligner.column_schema, fitted.aligner.column_schema)
+        self.assertNotIn('memory', pickle.loads(pickle.dumps(pipeline)).__dict__)
+
+    def test_changed_step_reruns_from_that_step(self):
+        self.fit_transform(build_transformer_pipeline(memory=self.memory))
+        changed, expected = build_transformer_pipeline(memory=self.memory), build_transformer_pipeline()
+        changed.pipeline[3].windows = expected.pipeline[3].windows = [2, 8]
+        self.memory.hits = self.memory.misses = 0
+        self.assert_outputs_equal(self.fit_transform(changed), self.fit_transform(expected))
+        # Consolidation, future referral targets and time features are reused
+        self.assertEqual((self.memory.hits, self.memory.misses), (3, 3))
@@ -0,0 +1,60 @@
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+
+from api.utils.evaluate import evaluate_average_weekly_rank_correlation, get_scores_per_window, weekly_scores
+from api.utils.synthetic import synthetic_referral_table
+
+
+def grouped_weekly_scores(test_referral_table, y_test, y_pred, threshold):
+    """The per week scores as evaluate_average_weekly_rank_correlation computed them with a groupby apply"""
+    grouped = test_referral_table.assign(y=y_test, pred=y_pred)\
+                                 .set_index('referral_referraltakendate')\
+                                 .groupby([pd.Grouper(freq='1W'), 'client_clientid'])[['y', 'pred']]\
+                                 .mean()
+    return grouped.reset_index()\
+                  .groupby(['referral_referraltakendate'])\
+                  .apply(lambda k: get_scores_per_window(k['y'], k['pred'], k['client_clientid'], threshold))
+
+
+def scored_referrals(n_referrals, seed=0, decimals=None):
+    rng = np.random.RandomState(seed)
+    referrals = synthetic_referral_table(n_referrals, seed).reset_index()
+    # Times of day, so that weeks are binned by date rather than timestamp
+    referrals['referral_referraltakendate'] += pd.to_timedelta(rng.randint(0, 24 * 3600, len(referrals)), unit='s')
+    y = pd.Series(rng.rand(len(referrals)), index=referrals.index)
+    pred = y + rng.normal(0, 0.3, len(referrals))
+    if decimals is not None:
+        # Rounded scores have many ties
+        y, pred = y.round(decimals), pred.round(decimals)
+    return referrals, y, pred.values
+
+
+class TestWeeklyScores(TestCase):
+    def assert_matches_groupby(self, referrals, y, pred, threshold):
+        expected = grouped_weekly_scores(referrals, y, pred, threshold)
+        actual = weekly_scores(referrals, y, pred, threshold)
+        np.testing.assert_array_equal(actual.index.values, expected.index.values)
+        np.testing.assert_allclose(actual.values, expected.values, equal_nan=True, atol=1e-12)
+        np.testing.assert_allclose(evaluate_average_weekly_rank_correlation(referrals, y, pred, threshold).values,
+                                   expected.dropna().mean().values)
+
+    def test_matches_the_groupby_evaluation(self):
+        referrals, y, pred = scored_referrals(20000)
+        for threshold in [0.2, 0.5]:
+            self.assert_matches_groupby(referrals, y, pred, threshold)
+
+    def test_ties_are_ranked_as_averages(self):
+        referrals, y, pred = scored_referrals(20000, seed=1, decimals=1)
+        self.assert_matches_groupby(referrals, y, pred, 0.2)
+
+    def test_undefined_weeks_are_null(self):
+        referrals = pd.DataFrame({'referral_referraltakendate': pd.to_datetime(['2018-01-01', '2018-01-02',
+                                                                                '2018-01-08', '2018-01-09']),
+                                  'client_clientid': [1, 1, 1, 2]})
+        scores = weekly_scores(referrals, np.array([1.0, 2.0, 1.0, 1.0]), np.array([1.0, 2.0, 3.0, 4.0]), 0.5)
+        self.assertEqual(list(scores.index), list(pd.to_datetime(['2018-01-07', '2018-01-14'])))
+        # A single client in the first week, constant actual scores in the second
+        self.assertTrue(scores['spearman'].isnull().all())
+        self.assertTrue(evaluate_average_weekly_rank_correlation(referrals, np.ones(4), np.ones(4), 0.5).isnull().all())
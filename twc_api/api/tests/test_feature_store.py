@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase, skipUnless
+
+import pandas as pd
+
+from api.model.feature_store import ClientFeatureStore, HistoryRequired
+from api.model.models import TWCModel
+from api.model.train import generate_X_y, train_model
+from api.model.transformers import dense_frame, sparse_supported
+from api.utils.synthetic import synthetic_tables, select_referrals
+
+
+class TestClientFeatureStore(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.tables = synthetic_tables(400)
+        _, _, _, self.transformer = generate_X_y({k: t.copy() for k, t in self.tables.items()})
+        self.store = ClientFeatureStore(os.path.join(self.directory, 'store.sqlite'))
+        referrals = self.tables['referral'].assign(date=pd.to_datetime(self.tables['referral']['referraltakendate']))
+        self.referrals = referrals.sort_values(['date', 'referralinstanceid'])
+        self.history = self.referrals[self.referrals['date'] < pd.Timestamp('2018-01-01')]
+        self.new = self.referrals[self.referrals['date'] >= pd.Timestamp('2018-01-01')]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_incremental_matches_batch(self):
+        self.store.build(self.transformer, select_referrals(self.tables, self.history['referralinstanceid']),
+                         'twc_model_1')
+        self.assertEqual(self.store.model_key, 'twc_model_1')
+
+        # Score the new referrals a day at a time, each against the batch features of the history up to that day
+        for date, day in self.new.groupby('date'):
+            incremental_X, _, states = self.store.transform(
+                self.transformer, select_referrals(self.tables, day['referralinstanceid']))
+            self.store.save_states(states, incremental_X.index)
+
+            history = self.referrals[self.referrals['date'] <= date]['referralinstanceid']
+            batch_X, _, _ = self.transformer.transform(select_referrals(self.tables, history))
+            pd.testing.assert_frame_equal(incremental_X.sort_index(),
+                                          batch_X.loc[incremental_X.index].astype(float).sort_index(),
+                                          check_exact=False)
+
+    def test_rejects_out_of_order_and_repeated_referrals(self):
+        self.store.build(self.transformer, select_referrals(self.tables, self.new['referralinstanceid']),
+                         'twc_model_1')
+        with self.assertRaises(HistoryRequired):
+            self.store.transform(self.transformer, select_referrals(self.tables, self.history['referralinstanceid']))
+        with self.assertRaises(HistoryRequired):
+            self.store.transform(self.transformer, select_referrals(self.tables, self.new['referralinstanceid'][:1]))
+
+    @skipUnless(sparse_supported(), 'Sparse features require pandas >= 0.25')
+    def test_sparse_pipeline(self):
+        X, y, _, transformer = generate_X_y({k: t.copy() for k, t in self.tables.items()}, sparse=True)
+        model = TWCModel(transformer, train_model(X, y, {'n_estimators': 5, 'random_state': 0}))
+        self.store.build(transformer, select_referrals(self.tables, self.history['referralinstanceid']), 'twc_model_1')
+        new = select_referrals(self.tables, self.new['referralinstanceid'])
+        incremental_X, _, _ = self.store.transform(transformer, new)
+        batch_X, _, _ = transformer.transform(select_referrals(self.tables, self.referrals['referralinstanceid']))
+        pd.testing.assert_frame_equal(incremental_X.sort_index(),
+                                      dense_frame(batch_X).loc[incremental_X.index].astype(float).sort_index(),
+                                      check_exact=False)
+        scores = model.predict_incremental(new, self.store)
+        self.assertEqual(set(scores), set(self.new['referralinstanceid']))
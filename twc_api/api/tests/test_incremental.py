@@ -0,0 +1,85 @@
+from unittest import TestCase
+import unittest.mock as mock
+
+import numpy as np
+import pandas as pd
+
+from api.model.train import train_model_from_json, generate_delta_X_y, incremental_retrain, matured_cutoff
+from api.model.transformers import model_input
+from api.utils.synthetic import synthetic_tables
+
+HYPERPARAMS = {'n_estimators': 6, 'random_state': 0}
+
+
+def tables_before(tables, date):
+    """The dump as it was on date, with the referrals taken since and their rows in the child tables removed"""
+    referral = tables['referral'][tables['referral']['referraltakendate'] < date]
+    truncated = {}
+    for table_name, table in tables.items():
+        if table_name == 'referral':
+            table = referral
+        elif table_name != 'client' and 'referralinstanceid' in table.columns:
+            table = table[table['referralinstanceid'].isin(referral['referralinstanceid'])]
+        truncated[table_name] = table.reset_index(drop=True)
+    return truncated
+
+
+def copy_tables(tables):
+    return {name: table.copy() for name, table in tables.items()}
+
+
+def fit_model(tables):
+    with mock.patch('api.model.train.load_tables', return_value=copy_tables(tables)):
+        return train_model_from_json(None, HYPERPARAMS)
+
+
+class TestIncrementalRetrain(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tables = synthetic_tables(4000)
+        dates = cls.tables['referral']['referraltakendate']
+        cls.date = dates.min() + (dates.max() - dates.min()) * 0.8
+        cls.old_tables = tables_before(cls.tables, cls.date)
+        _, _, cls.referral_table, cls.model = fit_model(cls.old_tables)
+
+    def test_training_cutoff_is_the_latest_matured_referral(self):
+        self.assertEqual(self.model.training_cutoff, self.referral_table['referral_referraltakendate'].max())
+        self.assertLessEqual(self.model.training_cutoff,
+                             matured_cutoff(pd.to_datetime(self.old_tables['referral']['referraltakendate'])))
+
+    def test_delta_holds_only_the_newly_matured_referrals(self):
+        since = self.model.training_cutoff
+        X, y, referral_table, cutoff = generate_delta_X_y(copy_tables(self.tables), self.model.transformer, since)
+        dates = pd.to_datetime(self.tables['referral']['referraltakendate'])
+        self.assertEqual(cutoff, matured_cutoff(dates))
+        self.assertEqual(len(X), ((dates > since) & (dates <= cutoff)).sum())
+        self.assertTrue((referral_table['referral_referraltakendate'] > since).all())
+        self.assertTrue((referral_table['referral_referraltakendate'] <= cutoff).all())
+        self.assertEqual(list(X.columns), self.model.transformer.aligner.column_schema)
+        self.assertEqual(len(y), len(X))
+        self.assertFalse(np.isnan(y).any())
+
+    def test_delta_features_match_a_full_rebuild(self):
+        X = generate_delta_X_y(copy_tables(self.tables), self.model.transformer, self.model.training_cutoff)[0]
+        X_full = self.model.transformer.transform(copy_tables(self.tables))[0]
+        # Both are indexed by referral id
+        pd.testing.assert_frame_equal(X, X_full.loc[X.index], check_dtype=False)
+
+    def test_extend_keeps_the_newest_trees(self):
+        model = fit_model(self.old_tables)[3]
+        oldest, newest = model.model.estimators_[0], model.model.estimators_[-1]
+        X, y, _, model = incremental_retrain(copy_tables(self.tables), model, new_trees=4, max_trees=8)
+        self.assertEqual(len(model.model.estimators_), 8)
+        self.assertEqual(model.model.n_estimators, 8)
+        self.assertNotIn(oldest, model.model.estimators_)
+        self.assertIs(model.model.estimators_[3], newest)
+        self.assertLessEqual(model.training_cutoff,
+                             matured_cutoff(pd.to_datetime(self.tables['referral']['referraltakendate'])))
+        self.assertEqual(len(model.model.predict(model_input(X))), len(X))
+
+    def test_nothing_to_add_leaves_the_model_unchanged(self):
+        model = fit_model(self.old_tables)[3]
+        X, _, _, extended = incremental_retrain(copy_tables(self.old_tables), model, new_trees=4, max_trees=8)
+        self.assertIsNone(X)
+        self.assertIs(extended, model)
+        self.assertEqual(len(model.model.estimators_), 6)
@@ -0,0 +1,69 @@
+import io
+import json
+from unittest import TestCase
+
+import pandas as pd
+
+from api.model.ingest import iter_json_array, stream_full_tables
+from api.model.train import construct_full_tables, load_tables, table_names
+from api.utils.synthetic import synthetic_tables
+
+
+def tables_to_dump(tables):
+    """Splits a dictionary of tables into a json dump of one record per client"""
+    referral_clients = tables['referral'].set_index('referralinstanceid')['clientid']
+    dump = {}
+    for table_name, table in tables.items():
+        if 'clientid' in table.columns:
+            client_ids = table['clientid']
+        else:
+            client_ids = table['referralinstanceid'].map(referral_clients)
+        for client_id, rows in table.groupby(client_ids):
+            records = json.loads(rows.to_json(orient='records'))
+            dump.setdefault(int(client_id), {})[table_name] = records
+    return [dump[client_id] for client_id in sorted(dump)]
+
+
+class TestStreamingIngestion(TestCase):
+    def setUp(self):
+        self.dump = tables_to_dump(synthetic_tables(400))
+        # Rows missing a column, explicit nulls, a column which only appears part way and non ascii text
+        self.dump[0]['referral'][0]['referralnotes'] = 'Café – follow up'
+        self.dump[1]['referral'][0]['referralnotes'] = None
+        del self.dump[2]['client'][0]['partnerid']
+        self.dump[3]['referralissue'] = []
+        self.text = json.dumps(self.dump, ensure_ascii=False, indent=1)
+
+    def assert_tables_equal(self, streamed, expected):
+        self.assertEqual(sorted(streamed), sorted(table_names))
+        for table_name in table_names:
+            pd.testing.assert_frame_equal(streamed[table_name], expected[table_name])
+
+    def test_matches_construct_full_tables(self):
+        expected = construct_full_tables(json.loads(self.text))
+        for chunk_size in [3, 64, 1 << 20]:
+            streamed = stream_full_tables(io.BytesIO(self.text.encode('utf-8')), table_names, chunk_size=chunk_size)
+            self.assert_tables_equal(streamed, expected)
+        self.assert_tables_equal(stream_full_tables(io.StringIO(self.text), table_names), expected)
+
+    def test_limit(self):
+        streamed = stream_full_tables(io.BytesIO(self.text.encode('utf-8')), table_names, limit=4)
+        self.assert_tables_equal(streamed, construct_full_tables(json.loads(self.text), limit=4))
+
+    def test_load_tables_closes_the_stream_it_opens(self):
+        stream = io.BytesIO(self.text.encode('utf-8'))
+        self.assert_tables_equal(load_tables(lambda: stream), construct_full_tables(json.loads(self.text)))
+        self.assertTrue(stream.closed)
+        stream = io.BytesIO(self.text.encode('utf-8'))
+        load_tables(stream)
+        self.assertFalse(stream.closed)
+
+    def test_iter_json_array(self):
+        text = ' [ {"a": [1, 2]} ,"é", 3.5 , [] , null ]  '
+        for chunk_size in [1, 2, 100]:
+            self.assertEqual(list(iter_json_array(io.BytesIO(text.encode('utf-8')), chunk_size)),
+                             [{'a': [1, 2]}, 'é', 3.5, [], None])
+        self.assertEqual(list(iter_json_array(io.StringIO('[]'))), [])
+        for text in ['{}', '[1, 2', '[1 2]', '[{"a": 1]']:
+            with self.assertRaises(ValueError):
+                list(iter_json_array(io.StringIO(text), 2))
@@ -0,0 +1,150 @@
+import logging
+import threading
+import time
+from unittest import TestCase
+import unittest.mock as mock
+
+from api.utils import aws
+from api.utils.log_shipping import BufferedLogShipper
+
+
+class RecordingStore(object):
+    """Collects the parts written by a shipper, optionally failing or blocking the first writes"""
+    def __init__(self, fail=0, delay=0):
+        self.parts = {}
+        self.fail = fail
+        self.delay = delay
+        self.written = threading.Event()
+
+    def write_part(self, index, text):
+        time.sleep(self.delay)
+        if self.fail:
+            self.fail -= 1
+            raise IOError('upload failed')
+        self.parts[index] = text
+        self.written.set()
+
+    def text(self):
+        return ''.join(self.parts[index] for index in sorted(self.parts))
+
+
+def shipping_logger(shipper):
+    logger = logging.getLogger('test_log_shipping')
+    logger.handlers = [shipper]
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    return logger
+
+
+class TestBufferedLogShipper(TestCase):
+    def test_parts_concatenate_to_the_log(self):
+        store = RecordingStore()
+        shipper = BufferedLogShipper(store.write_part, flush_interval=60, flush_bytes=100)
+        logger = shipping_logger(shipper)
+        for i in range(100):
+            logger.info('record {}'.format(i))
+        # Past flush_bytes the buffer is shipped without a request
+        self.assertTrue(store.written.wait(5))
+        for i in range(100, 200):
+            logger.info('record {}'.format(i))
+        shipper.close()
+        self.assertEqual(store.text(), ''.join('record {}\n'.format(i) for i in range(200)))
+        self.assertGreater(len(store.parts), 1)
+        self.assertEqual(shipper.shipped_bytes, len(store.text()))
+
+    def test_records_are_buffered_until_a_threshold(self):
+        store = RecordingStore()
+        shipper = BufferedLogShipper(store.write_part, flush_interval=60, flush_bytes=10 ** 6)
+        logger = shipping_logger(shipper)
+        logger.info('first')
+        self.assertFalse(store.written.wait(0.2))
+        shipper.ship_soon()
+        self.assertTrue(store.written.wait(5))
+        self.assertEqual(store.parts, {0: 'first\n'})
+        shipper.close()
+
+    def test_flush_interval_ships_without_a_request(self):
+        store = RecordingStore()
+        shipper = BufferedLogShipper(store.write_part, flush_interval=0.05, flush_bytes=10 ** 6)
+        shipping_logger(shipper).info('first')
+        self.assertTrue(store.written.wait(5))
+        shipper.close()
+
+    def test_logging_does_not_wait_for_uploads(self):
+        store = RecordingStore(delay=0.5)
+        shipper = BufferedLogShipper(store.write_part, flush_interval=60, flush_bytes=1)
+        logger = shipping_logger(shipper)
+        start = time.perf_counter()
+        for i in range(20):
+            logger.info('record {}'.format(i))
+        self.assertLess(time.perf_counter() - start, 0.25)
+        shipper.close()
+        self.assertEqual(store.text(), ''.join('record {}\n'.format(i) for i in range(20)))
+
+    def test_failed_parts_are_retried(self):
+        store = RecordingStore(fail=1)
+        shipper = BufferedLogShipper(store.write_part, flush_interval=60, first_part=3)
+        logger = shipping_logger(shipper)
+        logger.info('first')
+        with mock.patch('sys.stderr'):
+            self.assertFalse(shipper.ship())
+        logger.info('second')
+        shipper.close()
+        self.assertEqual(store.parts, {3: 'first\nsecond\n'})
+        self.assertEqual(shipper.failures, 1)
+
+    def test_failing_uploads_back_off(self):
+        store = RecordingStore(fail=10 ** 6)
+        shipper = BufferedLogShipper(store.write_part, flush_interval=0.01, flush_bytes=1, max_retry_interval=0.1)
+        logger = shipping_logger(shipper)
+        with mock.patch('sys.stderr'):
+            start = time.perf_counter()
+            # A full buffer doesn't cut the back off short
+            for i in range(50):
+                logger.info('record {}'.format(i))
+                time.sleep(0.01)
+            elapsed = time.perf_counter() - start
+            # Waits of 0.01, 0.02, 0.04 and 0.08s, then one retry every 0.1s
+            self.assertLessEqual(shipper.failures, 5 + elapsed / 0.1)
+            store.fail = 0
+            shipper.close()
+        self.assertEqual(store.text(), ''.join('record {}\n'.format(i) for i in range(50)))
+
+
+class TestS3LogParts(TestCase):
+    def setUp(self):
+        self.objects = {}
+        s3 = mock.MagicMock()
+        s3.Bucket.return_value.objects.filter.side_effect = lambda Prefix: [
+            mock.Mock(key=key) for key in self.objects if key.startswith(Prefix)]
+        s3.Bucket.return_value.delete_objects.side_effect = lambda Delete: [
+            self.objects.pop(o['Key']) for o in Delete['Objects']]
+        s3.Object.side_effect = self.s3_object
+        self.patcher = mock.patch('api.utils.aws.s3', s3)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def s3_object(self, bucket, key):
+        obj = mock.Mock()
+        obj.put.side_effect = lambda Body: self.objects.__setitem__(key, Body)
+        obj.get.side_effect = lambda: {'Body': mock.Mock(read=mock.Mock(return_value=self.objects[key]))}
+        return obj
+
+    def test_retrain_log_is_read_from_its_parts(self):
+        self.assertEqual(aws.get_training_log_json(), 'No model currently running')
+        logger = shipping_logger(aws.s3_log_handler(flush_interval=60, flush_bytes=10))
+        logger.info('test evaluation')
+        aws.stop_log_shipping(logger)
+        # A full retrain after the test evaluation appends to its log
+        logger = shipping_logger(aws.s3_log_handler(append_previous=True, flush_interval=60))
+        logger.info('full retrain')
+        aws.sync_log_to_s3(logger, wait=True)
+        self.assertEqual(aws.get_training_log_json(), 'test evaluation\nfull retrain\n')
+        self.assertEqual(sorted(self.objects), [aws.log_part_key(0), aws.log_part_key(1)])
+        aws.stop_log_shipping(logger)
+        self.assertEqual(logger.handlers, [])
+
+        aws.s3_log_handler().close()
+        self.assertEqual(self.objects, {})
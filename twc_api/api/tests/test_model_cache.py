@@ -0,0 +1,112 @@
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+import unittest.mock as mock
+
+import numpy as np
+from sklearn.ensemble import ExtraTreesRegressor
+
+from api.model.artifact import save_artifact, load_artifact
+from api.model.models import TWCModel
+from api.model.train import generate_X_y
+from api.utils import model_cache
+from api.utils.model_cache import ModelCache, model_size
+from api.utils.synthetic import synthetic_tables
+
+
+class RecordingLoader(object):
+    """Loads a model of each key's size in bytes, recording the loads"""
+    def __init__(self, delay=0):
+        self.loads = []
+        self.delay = delay
+
+    def __call__(self, key):
+        time.sleep(self.delay)
+        self.loads.append(key)
+        if key == 'missing':
+            raise KeyError(key)
+        return {'key': key}
+
+
+def sizes(model):
+    return int(model['key'].split('_')[-1])
+
+
+class TestModelCache(TestCase):
+    def test_loaded_models_are_reused(self):
+        loader = RecordingLoader()
+        cache = ModelCache(loader, max_bytes=100, sizer=sizes)
+        self.assertEqual(cache.get('model_10'), {'key': 'model_10'})
+        self.assertIs(cache.get('model_10'), cache.get('model_10'))
+        self.assertEqual(loader.loads, ['model_10'])
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['bytes']), (2, 1, 10))
+
+    def test_least_recently_used_are_evicted_over_budget(self):
+        loader = RecordingLoader()
+        cache = ModelCache(loader, max_bytes=100, sizer=sizes)
+        cache.get('a_40')
+        cache.get('b_40')
+        cache.get('a_40')
+        cache.get('c_40')
+        self.assertEqual([model['key'] for model in cache.stats()['models']], ['a_40', 'c_40'])
+        self.assertNotIn('b_40', cache)
+        # A model over the budget on its own is still kept until the next load
+        cache.get('d_500')
+        self.assertEqual([model['key'] for model in cache.stats()['models']], ['d_500'])
+        self.assertEqual(cache.stats()['evictions'], 3)
+
+    def test_concurrent_requests_load_once(self):
+        loader = RecordingLoader(delay=0.2)
+        cache = ModelCache(loader, max_bytes=100, sizer=sizes)
+        cache.get('cached_10')
+        threads = [threading.Thread(target=cache.get, args=('slow_10',)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        # Loading one model doesn't hold up requests for another
+        start = time.perf_counter()
+        cache.get('cached_10')
+        self.assertLess(time.perf_counter() - start, 0.1)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(loader.loads, ['cached_10', 'slow_10'])
+
+    def test_failed_loads_are_not_cached(self):
+        loader = RecordingLoader()
+        cache = ModelCache(loader, max_bytes=100, sizer=sizes)
+        for _ in range(2):
+            with self.assertRaises(KeyError):
+                cache.get('missing')
+        self.assertEqual(loader.loads, ['missing', 'missing'])
+        self.assertEqual(cache.stats()['models'], [])
+
+    def test_model_size_counts_arrays(self):
+        size = model_size({'values': np.zeros(10 ** 5)})
+        self.assertGreaterEqual(size, 8 * 10 ** 5)
+        self.assertLess(size, 8 * 10 ** 5 + 1000)
+
+    def test_model_size_of_models_does_not_serialize_the_trees(self):
+        X, y, _, transformer = generate_X_y(synthetic_tables(400))
+        model = TWCModel(transformer, ExtraTreesRegressor(n_estimators=10, random_state=0).fit(X, y))
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'twc_model_1.artifact')
+            save_artifact(model, path)
+            artifact_model = load_artifact(path)
+            with mock.patch.object(model_cache, 'pickled_size', wraps=model_cache.pickled_size) as pickled_size:
+                size = model_size(model)
+                artifact_size = model_size(artifact_model)
+            self.assertEqual([c[0][0] for c in pickled_size.call_args_list], [model.transformer,
+                                                                               artifact_model.transformer])
+            # Close to the pickle, which holds the same node arrays
+            self.assertLess(abs(size - len(pickle.dumps(model))), 0.2 * size)
+            flat = artifact_model.model
+            self.assertGreater(artifact_size, flat.children_left.nbytes + flat.threshold.nbytes + flat.value.nbytes)
+            self.assertLess(artifact_size, size)
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+import unittest.mock as mock
+
+from api.utils.aws import ModelVersionCache
+from api.utils.registry import ModelRegistry, LocalStorage
+
+
+class TestModelVersionCache(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.storage = LocalStorage(os.path.join(self.directory, 'bucket'))
+        self.registry = ModelRegistry(self.storage, 'twc_model_', 'twc_status')
+        model_file = os.path.join(self.directory, 'model')
+        with open(model_file, 'wb') as fh:
+            fh.write(b'model')
+        for key in ['twc_model_1', 'twc_model_2']:
+            self.registry.register_model(model_file, key)
+        self.registry.set_current(1)
+        self.patcher = mock.patch('api.utils.aws.get_registry', return_value=self.registry)
+        self.patcher.start()
+        self.storage_get = mock.patch.object(self.storage, 'get', wraps=self.storage.get).start()
+
+    def tearDown(self):
+        mock.patch.stopall()
+        shutil.rmtree(self.directory)
+
+    def test_steady_state_makes_no_storage_calls(self):
+        cache = ModelVersionCache()
+        for _ in range(10):
+            self.assertEqual(cache.get(ttl=60), 'twc_model_1')
+        self.assertEqual(self.storage_get.call_count, 1)
+        self.assertEqual(cache.stats()['hits'], 9)
+
+    def test_expired_entry_is_revalidated_by_etag(self):
+        cache = ModelVersionCache()
+        cache.get(ttl=0)
+        self.assertEqual(cache.get(ttl=0), 'twc_model_1')
+        self.assertEqual(cache.stats()['revalidations'], 1)
+
+        self.registry.set_current(2)
+        self.assertEqual(cache.get(ttl=0), 'twc_model_2')
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_invalidate(self):
+        cache = ModelVersionCache()
+        cache.get(ttl=60)
+        self.registry.set_current(2)
+        self.assertEqual(cache.get(ttl=60), 'twc_model_1')
+        cache.invalidate()
+        self.assertEqual(cache.get(ttl=60), 'twc_model_2')
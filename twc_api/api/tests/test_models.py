@@ -0,0 +1,63 @@
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import ExtraTreesRegressor
+
+from api.model.models import TWCModel, concat_tables
+from api.model.train import generate_X_y
+from api.utils.synthetic import synthetic_tables, select_referrals
+
+
+class TestPredictBatch(TestCase):
+    def setUp(self):
+        self.tables = synthetic_tables(400)
+        # The pipeline's date sort isn't stable, so a client's same day referrals are ordered by the rest of the
+        # table, which differs between a batch and a single payload. Keep one referral per client and day
+        referrals = self.tables['referral'].drop_duplicates(['clientid', 'referraltakendate'])
+        self.tables = select_referrals(self.tables, referrals['referralinstanceid'])
+        X, y, _, transformer = generate_X_y({k: t.copy() for k, t in self.tables.items()})
+        self.model = TWCModel(transformer, ExtraTreesRegressor(n_estimators=10, random_state=0).fit(X, y))
+
+    def client_payload(self, client_id):
+        referrals = self.tables['referral']
+        payload = select_referrals(self.tables, referrals.loc[referrals['clientid'] == client_id, 'referralinstanceid'])
+        payload['client'] = payload['client'][payload['client']['clientid'] == client_id].reset_index(drop=True)
+        payload['clientissue'] = payload['clientissue'][payload['clientissue']['clientid'] == client_id]
+        return payload
+
+    def test_batch_matches_per_payload_scores(self):
+        client_ids = [0, 1, 2, 3]
+        # The repeated payload is deduplicated rather than scored against a doubled history
+        payloads = [self.client_payload(c) for c in client_ids] + [self.client_payload(0)]
+        batch = self.model.predict_batch([{k: t.copy() for k, t in p.items()} for p in payloads])
+
+        expected = {}
+        for client_id in client_ids:
+            expected.update(self.model.predict(self.client_payload(client_id)))
+        self.assertEqual(len(batch), len(expected))
+        self.assertTrue(batch['referralinstanceid'].is_unique)
+        np.testing.assert_allclose(batch['score'].values, [expected[r] for r in batch['referralinstanceid']])
+
+        referrals = self.tables['referral'].set_index('referralinstanceid')
+        np.testing.assert_array_equal(batch['clientid'].values, referrals.loc[batch['referralinstanceid'], 'clientid'])
+
+    def test_concat_tables_keeps_last_values_of_a_key(self):
+        first, second = self.client_payload(0), self.client_payload(0)
+        second['client'] = second['client'].assign(clientismale=~second['client']['clientismale'])
+        tables = concat_tables([first, second])
+        self.assertEqual(len(tables['client']), 1)
+        self.assertEqual(tables['client']['clientismale'].iloc[0], second['client']['clientismale'].iloc[0])
+        self.assertEqual(len(tables['referral']), len(first['referral']))
+
+    def test_batch_keeps_items_repeated_within_a_payload(self):
+        referrals = self.tables['referral'].set_index('referralinstanceid')
+        client_id = referrals.loc[self.tables['referralissue']['referralinstanceid'].iloc[0], 'clientid']
+        payload = self.client_payload(client_id)
+        issues = payload['referralissue']
+        payload['referralissue'] = pd.concat([issues, issues.iloc[:1]], ignore_index=True)
+        tables = concat_tables([self.client_payload(client_id), payload])
+        self.assertEqual(len(tables['referralissue']), len(issues) + 1)
+        expected, _, _ = self.model.transformer.transform({k: t.copy() for k, t in payload.items()})
+        actual, _, _ = self.model.transformer.transform(tables)
+        pd.testing.assert_frame_equal(actual, expected)
@@ -0,0 +1,86 @@
+import json
+import os
+import pstats
+import shutil
+import tempfile
+from unittest import TestCase
+
+from api.model.train import generate_X_y, train_model, evaluate_model, split_train_test, train_model_from_json
+from api.utils.synthetic import synthetic_tables
+from api.utils.cache import DiskCache
+from api.utils.profiling import Profiler, REPORT_SUFFIX
+from api.utils.registry import ModelRegistry, LocalStorage
+from api.utils.synthetic import synthetic_dump
+
+STEPS = ['ConsolidateTablesTransformer', 'AddFutureReferralTargetFeatures', 'TimeFeatureTransformer',
+         'TimeWindowFeatures', 'SplitCurrentAndEverTransformer', 'AlignFeaturesToColumnSchemaTransformer']
+
+
+class TestProfiler(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_records_every_step_fit_and_evaluation(self):
+        profiler = Profiler(profile_dir=os.path.join(self.directory, 'cprofile'))
+        tables = synthetic_tables(400)
+        X, y, referral_table, _ = generate_X_y(tables, profiler=profiler)
+        X_train, X_test, y_train, y_test, _, referral_table_test = split_train_test(X, y, referral_table)
+        model = profiler.call('fit', train_model, X_train, y_train, {'n_estimators': 5})
+        profiler.call('evaluate', evaluate_model, model, X_test, y_test, referral_table_test, 0.2)
+
+        self.assertEqual([stage['name'] for stage in profiler.stages], STEPS + ['fit', 'evaluate'])
+        consolidate, align, fit = profiler.stages[0], profiler.stages[5], profiler.stages[6]
+        self.assertEqual(consolidate['input']['referral'], {'rows': len(tables['referral']),
+                                                            'columns': tables['referral'].shape[1]})
+        self.assertEqual(fit['input'], {'rows': len(X_train), 'columns': X.shape[1]})
+        self.assertIsNone(fit['output'])
+        self.assertEqual(align['output']['columns'], X.shape[1])
+        for stage in profiler.stages:
+            self.assertGreaterEqual(stage['wall_seconds'], 0)
+            self.assertGreaterEqual(stage['cpu_seconds'], 0)
+            self.assertGreaterEqual(stage['peak_rss_delta_mb'], 0)
+            pstats.Stats(stage['cprofile'])
+
+        path = profiler.save(os.path.join(self.directory, 'twc_model_1' + REPORT_SUFFIX))
+        with open(path) as fh:
+            report = json.load(fh)
+        self.assertEqual(len(report['stages']), 8)
+        self.assertGreater(report['peak_rss_mb'], 0)
+
+    def test_evaluation_then_publish_reuses_the_features(self):
+        profiler = Profiler()
+        X, _, _, _ = train_model_from_json(synthetic_dump(2000), {'n_estimators': 5}, test=True, profiler=profiler,
+                                           publish=True)
+        self.assertEqual([stage['name'] for stage in profiler.stages],
+                         ['load_tables'] + STEPS + ['fit', 'evaluate', 'final fit'])
+        fit, final_fit = profiler.stages[-3], profiler.stages[-1]
+        self.assertLess(fit['input']['rows'], len(X))
+        self.assertEqual(final_fit['input']['rows'], len(X))
+
+    def test_cached_steps_are_marked(self):
+        cache = DiskCache(os.path.join(self.directory, 'cache'), 10 ** 9)
+        generate_X_y(synthetic_tables(400), cache=cache)
+        profiler = Profiler()
+        generate_X_y(synthetic_tables(400), cache=cache, profiler=profiler)
+        self.assertEqual([stage['name'] for stage in profiler.stages], STEPS)
+        self.assertTrue(all(stage['cached'] for stage in profiler.stages))
+
+    def test_disabled_profiler_records_nothing(self):
+        profiler = Profiler(enabled=False)
+        self.assertEqual(profiler.call('add', lambda a, b: a + b, 1, 2), 3)
+        self.assertEqual(profiler.stages, [])
+
+    def test_report_is_registered_with_the_model(self):
+        registry = ModelRegistry(LocalStorage(os.path.join(self.directory, 'bucket')), 'twc_model_', 'twc_status')
+        model_path = os.path.join(self.directory, 'twc_model_1')
+        with open(model_path, 'wb') as fh:
+            fh.write(b'model')
+        profiler = Profiler()
+        profiler.call('stage', sum, [1, 2])
+        report_path = profiler.save(model_path + REPORT_SUFFIX)
+        entry = registry.register_model(model_path, 'twc_model_1', report_path=report_path)
+        self.assertEqual(entry['profile'], {'key': 'twc_model_1' + REPORT_SUFFIX})
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'bucket', 'twc_model_1' + REPORT_SUFFIX)))
@@ -0,0 +1,114 @@
+import datetime
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+import unittest.mock as mock
+
+from api.utils import registry
+from api.utils.registry import ModelRegistry, LocalStorage, MANIFEST_NAME, JOURNAL_PREFIX
+
+
+class TestModelRegistry(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.storage = LocalStorage(os.path.join(self.directory, 'bucket'))
+        self.registry = ModelRegistry(self.storage, 'twc_model_', 'twc_status')
+        self.model_file = os.path.join(self.directory, 'twc_model_1')
+        with open(self.model_file, 'wb') as fh:
+            fh.write(b'model')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_register_and_set_current(self):
+        self.assertEqual(self.registry.next_version(), 1)
+        entry = self.registry.register_model(self.model_file, 'twc_model_1', source='JSONExport.JSON')
+        self.assertEqual(entry['size'], 5)
+        self.assertEqual(entry['source'], 'JSONExport.JSON')
+        self.assertEqual(list(self.registry.models().keys()), [1])
+        self.assertEqual(self.registry.next_version(), 2)
+
+        self.assertTrue(self.registry.set_current(1))
+        self.assertFalse(self.registry.set_current(2))
+        self.assertEqual([s['current_version'] for s in self.registry.status()], [1])
+
+    def test_rejects_invalid_key(self):
+        with self.assertRaises(ValueError):
+            self.registry.register_model(self.model_file, 'model.p')
+
+    def test_manifest_built_from_existing_bucket(self):
+        self.storage.put('twc_model_3', b'model')
+        self.storage.put('twc_model_4', b'model')
+        self.storage.put('twc_model_4.log', b'log')
+        self.storage.put('twc_status', b'[{"current_version": 3, "timestamp": "2018-08-01"}]')
+        self.assertEqual(sorted(self.registry.models().keys()), [3, 4])
+        self.assertEqual(self.registry.status()[-1]['current_version'], 3)
+        self.assertIn(MANIFEST_NAME, os.listdir(self.storage.root))
+
+    def test_conditional_read(self):
+        self.registry.register_model(self.model_file, 'twc_model_1')
+        manifest, etag = self.registry.read_manifest()
+        self.assertEqual(self.registry.read_manifest(if_none_match=etag), (None, etag))
+        self.registry.set_current(1)
+        manifest, new_etag = self.registry.read_manifest(if_none_match=etag)
+        self.assertNotEqual(new_etag, etag)
+        self.assertEqual(manifest['status'][-1]['current_version'], 1)
+
+    def test_concurrent_updates_are_not_lost(self):
+        other = ModelRegistry(self.storage, 'twc_model_', 'twc_status')
+        self.registry.models()
+        write_manifest = self.registry.write_manifest
+
+        def interleaved(manifest):
+            # Another process registers a model between this registry's read and write of the manifest
+            if not other.models():
+                other.register_model(self.model_file, 'twc_model_2')
+                other.set_current(2)
+            write_manifest(manifest)
+
+        with mock.patch.object(self.registry, 'write_manifest', side_effect=interleaved):
+            self.registry.register_model(self.model_file, 'twc_model_1')
+        self.assertEqual(sorted(self.registry.models()), [1, 2])
+        self.assertEqual(sorted(other.models()), [1, 2])
+        self.assertEqual([s['current_version'] for s in self.registry.status()], [2])
+
+    def test_next_version_includes_journalled_models(self):
+        self.assertEqual(self.registry.next_version(), 1)
+        # A model journalled by another process which hasn't merged it into the manifest yet
+        ModelRegistry(self.storage, 'twc_model_', 'twc_status').write_journal('model', {'version': 1,
+                                                                                         'key': 'twc_model_1'})
+        self.assertEqual(self.registry.next_version(), 2)
+
+    def test_registering_a_version_twice_is_rejected(self):
+        self.registry.register_model(self.model_file, 'twc_model_1')
+        with self.assertRaises(ValueError):
+            self.registry.register_model(self.model_file, 'twc_model_1')
+
+        other = ModelRegistry(self.storage, 'twc_model_', 'twc_status')
+        write_journal = self.registry.write_journal
+
+        def interleaved(kind, record):
+            # Another process registers the same version between this registry's check and its journal write
+            other.register_model(self.model_file, 'twc_model_2', source='other')
+            return write_journal(kind, record)
+
+        with mock.patch.object(self.registry, 'write_journal', side_effect=interleaved):
+            with self.assertRaises(ValueError):
+                self.registry.register_model(self.model_file, 'twc_model_2', source='this')
+        self.assertEqual(self.registry.models()[2]['source'], 'other')
+
+    def test_journal_is_compacted(self):
+        self.registry.register_model(self.model_file, 'twc_model_1')
+        self.registry.set_current(1)
+        self.assertEqual(len(self.storage.list(JOURNAL_PREFIX)), 2)
+        self.assertEqual(len(self.registry.sync()['journal']), 2)
+
+        with mock.patch.object(registry, 'JOURNAL_RETENTION', datetime.timedelta(0)):
+            self.registry.set_current(1)
+        self.assertEqual(self.storage.list(JOURNAL_PREFIX), [])
+        manifest, _ = self.registry.read_manifest()
+        self.assertEqual(manifest['journal'], [])
+        self.assertEqual(list(self.registry.models(manifest)), [1])
+        self.assertEqual([s['current_version'] for s in self.registry.status(manifest)], [1, 1])
+        self.assertEqual(self.registry.next_version(), 2)
@@ -1,55 +1,170 @@
+import io
 import json
+import os
 import pickle
-import unittest
+import shutil
+import tempfile
 from unittest import TestCase
 import unittest.mock as mock
-import requests
+
 import api
-import os
-import pandas as pd
+from api.model.train import train_model_from_json, construct_full_tables
+from api.utils.log_shipping import BufferedLogShipper
+from api.utils.synthetic import synthetic_dump
+
+test_json = synthetic_dump(3000)
 
-test_json = json.load(open('../../../requests/JSONExport20180819140915.JSON', 'r'))
 
-def get_test_payloads():
-    test_users = pickle.load(open('test_clients.p', 'rb'))
-    payloads = []
-    for t in test_json:
-        if t['client'][0]['clientid'] in test_users:
-            payloads.append(t)
-    return payloads
+def get_test_payloads(n_clients=20):
+    # The clients with the longest histories, whose scores depend most on the time features
+    return sorted(test_json, key=lambda record: len(record['referral']), reverse=True)[:n_clients]
+
 
 test_payloads = get_test_payloads()
 
+
 class TestRetrain(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        _, _, _, cls.model = train_model_from_json(test_json, hyperparams={'n_estimators': 10})
+
     def setUp(self):
         api.app.config.from_object('api.config.TestingConfig')
         self.app = api.app.test_client()
+        api.ModelContainer.cache = None
+        api.ShadowContainer.scorer, api.ShadowContainer.started = None, False
+        self.directory = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory)
 
-    @mock.patch('api.get_current_model_key', autospec=True)
-    @mock.patch('api.load_model_into_memory', autospec=True)
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    @mock.patch('api.model.train.sync_log_to_s3', autospec=True)
+    @mock.patch('api.s3_log_handler', autospec=True)
+    @mock.patch('api.clear_log_file_from_s3', autospec=True)
+    @mock.patch('api.set_model', autospec=True)
     @mock.patch('api.save_model', autospec=True)
-    @mock.patch('api.load_train_file_into_memory', autospec=True)
+    @mock.patch('api.sync_log_to_s3', autospec=True)
+    @mock.patch('api.download_log_from_s3', autospec=True)
+    @mock.patch('api.train_file_etag', autospec=True)
+    @mock.patch('api.open_train_file', autospec=True)
     @mock.patch('api.next_model_name', autospec=True)
-    def test_retrain(self, f1, f2, f3, f4, f5):
-        f1.return_value = 'twc_model_5'
-        f2.return_value = test_json
-        f5.return_value = 'twc_model_5'
+    def test_retrain(self, next_model_name, open_train_file, train_file_etag, download_log_from_s3, sync_log_to_s3,
+                     save_model, set_model, clear_log_file_from_s3, s3_log_handler, _):
+        parts = {}
+        s3_log_handler.return_value = BufferedLogShipper(parts.__setitem__)
+        next_model_name.return_value = 'twc_model_5', 5
+        open_train_file.side_effect = lambda filename: io.BytesIO(json.dumps(test_json).encode('utf-8'))
+        train_file_etag.return_value = '"synthetic"'
+        api.app.config['TRAINING_CACHE_DIR'] = os.path.join(self.directory, 'cache')
 
-        self.app.post('retrain', json={'input_file': 'blah', 'test': True})
-        predictions = pickle.load(open('test_predictions.p', 'rb'))
-        f4.return_value = pickle.load(open('twc_model_5', 'rb'))
+        api.run_retrain('synthetic.json', {'n_estimators': 10})
+        save_model.assert_called_once()
+        set_model.assert_called_once_with(5)
+        # The log was shipped in full before the model was published
+        with open('retrain_output.log') as fh:
+            self.assertEqual(''.join(parts[i] for i in sorted(parts)), fh.read())
+        model = pickle.load(open('twc_model_5', 'rb'))
+        scores = model.predict(construct_full_tables(test_payloads[:1]))
+        self.assertEqual(len(scores), len(test_payloads[0]['referral']))
+
+    @mock.patch('api.model.train.sync_log_to_s3', autospec=True)
+    @mock.patch('api.s3_log_handler', autospec=True)
+    @mock.patch('api.clear_log_file_from_s3', autospec=True)
+    @mock.patch('api.set_model', autospec=True)
+    @mock.patch('api.save_model', autospec=True)
+    @mock.patch('api.sync_log_to_s3', autospec=True)
+    @mock.patch('api.train_file_etag', autospec=True)
+    @mock.patch('api.open_train_file', autospec=True)
+    @mock.patch('api.next_model_name', autospec=True)
+    def test_evaluation_then_publish_builds_the_features_once(self, next_model_name, open_train_file, train_file_etag,
+                                                              sync_log_to_s3, save_model, set_model,
+                                                              clear_log_file_from_s3, s3_log_handler, _):
+        s3_log_handler.return_value = BufferedLogShipper(lambda index, text: None)
+        next_model_name.return_value = 'twc_model_5', 5
+        open_train_file.side_effect = lambda filename: io.BytesIO(json.dumps(test_json).encode('utf-8'))
+        train_file_etag.return_value = '"synthetic"'
+        api.app.config['TRAINING_CACHE_DIR'] = os.path.join(self.directory, 'cache')
 
+        api.run_retrain('synthetic.json', {'n_estimators': 10}, test=True)
+        open_train_file.assert_called_once()
+        next_model_name.assert_called_once()
+        set_model.assert_called_once_with(5)
+        with open('twc_model_5.profile.json') as fh:
+            stages = [stage['name'] for stage in json.load(fh)['stages']]
+        self.assertEqual(stages.count('ConsolidateTablesTransformer'), 1)
+        self.assertEqual(stages[-3:], ['fit', 'evaluate', 'final fit'])
+
+    @mock.patch('api.s3_log_handler', autospec=True)
+    @mock.patch('api.clear_log_file_from_s3', autospec=True)
+    @mock.patch('api.set_model', autospec=True)
+    @mock.patch('api.sync_log_to_s3', autospec=True)
+    @mock.patch('api.train_file_etag', autospec=True)
+    @mock.patch('api.load_pickled_model', autospec=True)
+    @mock.patch('api.get_current_model_key', autospec=True)
+    @mock.patch('api.incremental_retrain', autospec=True)
+    @mock.patch('api.next_model_name', autospec=True)
+    def test_incremental_retrain_with_nothing_matured_clears_the_log(self, next_model_name, incremental_retrain,
+                                                                     get_current_model_key, load_pickled_model,
+                                                                     train_file_etag, sync_log_to_s3, set_model,
+                                                                     clear_log_file_from_s3, s3_log_handler):
+        s3_log_handler.return_value = BufferedLogShipper(lambda index, text: None)
+        next_model_name.return_value = 'twc_model_5', 5
+        incremental_retrain.return_value = None, None, None, self.model
+        api.app.config['TRAINING_CACHE_DIR'] = os.path.join(self.directory, 'cache')
+
+        api.run_retrain('synthetic.json', incremental=True)
+        set_model.assert_not_called()
+        clear_log_file_from_s3.assert_called_once_with()
 
     @mock.patch('api.get_current_model_key', autospec=True)
     @mock.patch('api.load_model_into_memory', autospec=True)
-    def test_equivalence(self, f1, f2):
-        predictions = pickle.load(open('test_predictions.p', 'rb'))
-        f1.return_value = pickle.load(open('twc_model_5', 'rb'))
+    def test_equivalence(self, load_model_into_memory, get_current_model_key):
+        get_current_model_key.return_value = 'twc_model_5'
+        load_model_into_memory.return_value = self.model
 
-        for i, t in enumerate(test_payloads):
+        for t in test_payloads:
+            expected = self.model.predict(construct_full_tables([t]))
             response = self.app.post('score', json=t)
-            return_series = pd.Series(response.json)
-            return_series.index = return_series.index.astype(int)
-            df = pd.concat([predictions.loc[return_series.index], return_series], axis=1).dropna()
-            all_matched = ((df[1] - df[0]).abs() < 1e-9).all()
-            self.assertTrue(all_matched)
+            self.assertEqual(response.json['model_name'], 'twc_model_5')
+            scores = {int(referral_id): score for referral_id, score in response.json['scores'].items()}
+            self.assertEqual(set(scores), set(expected))
+            for referral_id, score in expected.items():
+                self.assertAlmostEqual(scores[referral_id], score, places=9)
+
+    @mock.patch('api.get_models', autospec=True)
+    @mock.patch('api.get_current_model_key', autospec=True)
+    @mock.patch('api.load_model_into_memory', autospec=True)
+    def test_score_with_a_version(self, load_model_into_memory, get_current_model_key, get_models):
+        get_current_model_key.return_value = 'twc_model_5'
+        get_models.return_value = {4: {'key': 'twc_model_4'}, 5: {'key': 'twc_model_5'}}
+        load_model_into_memory.return_value = self.model
+
+        payload = test_payloads[0]
+        self.assertEqual(self.app.post('score', json=payload).json['model_name'], 'twc_model_5')
+        self.assertEqual(self.app.post('score?version=4', json=payload).json['model_name'], 'twc_model_4')
+        self.assertEqual(self.app.post('score?version=3', json=payload).status_code, 404)
+        # Both versions stay loaded
+        self.assertEqual(self.app.post('score', json=payload).json['model_name'], 'twc_model_5')
+        self.assertEqual(self.app.post('score?version=4', json=payload).json['model_name'], 'twc_model_4')
+        self.assertEqual([call[0][0] for call in load_model_into_memory.call_args_list], ['twc_model_5', 'twc_model_4'])
+
+    @mock.patch('api.get_current_model_key', autospec=True)
+    @mock.patch('api.load_model_into_memory', autospec=True)
+    def test_shadow_scoring(self, load_model_into_memory, get_current_model_key):
+        get_current_model_key.return_value = 'twc_model_5'
+        load_model_into_memory.return_value = self.model
+        api.app.config['SHADOW_LOG_DIR'] = self.directory
+
+        self.assertEqual(self.app.get('shadow').status_code, 404)
+        self.assertEqual(self.app.get('shadow?version=4').json['stats']['candidate'], 'twc_model_4')
+        for t in test_payloads[:5]:
+            self.assertEqual(self.app.post('score', json=t).json['model_name'], 'twc_model_5')
+        api.ShadowContainer.scorer.drain(10)
+        response = self.app.get('shadow').json
+        api.ShadowContainer.scorer.close()
+        self.assertEqual(response['stats']['scored_rows'], sum(len(t['referral']) for t in test_payloads[:5]))
+        # The candidate is the same model, so its scores are the live ones
+        self.assertEqual(response['report']['mean_absolute_difference'], 0)
@@ -0,0 +1,75 @@
+import copy
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+
+from api.model.schema import SchemaJSONToTablesTransformer, TABLE_SCHEMAS, UNDECLARED_COLUMNS
+from api.model.train import construct_full_tables, generate_X_y
+from api.model.transformers import ParseJSONToTablesTransformer
+from api.utils.synthetic import synthetic_dump
+
+
+class TestSchemaJSONToTablesTransformer(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dump = synthetic_dump(2000)
+        cls.payloads = sorted(cls.dump, key=lambda record: len(record['referral']), reverse=True)[:10]
+
+    def test_features_match_the_inferring_parser(self):
+        for compact in [False, True]:
+            _, _, _, transformer = generate_X_y(construct_full_tables(copy.deepcopy(self.dump)), compact=compact)
+            for payload in self.payloads:
+                expected, _, _ = transformer.transform(ParseJSONToTablesTransformer().transform(copy.deepcopy(payload)))
+                actual, _, _ = transformer.transform(SchemaJSONToTablesTransformer().transform(copy.deepcopy(payload)))
+                pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+
+    def test_undeclared_columns_are_inferred(self):
+        _, _, _, transformer = generate_X_y(construct_full_tables(copy.deepcopy(self.dump)))
+        schemas = dict(TABLE_SCHEMAS, client={c: t for c, t in TABLE_SCHEMAS['client'].items() if c != 'clientcountryid'})
+        parser = SchemaJSONToTablesTransformer(schemas)
+        for payload in self.payloads:
+            expected, _, _ = transformer.transform(ParseJSONToTablesTransformer().transform(copy.deepcopy(payload)))
+            actual, _, _ = transformer.transform(parser.transform(copy.deepcopy(payload)))
+            pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+
+    def test_columns_are_typed_as_declared(self):
+        tables = SchemaJSONToTablesTransformer().transform(self.payloads[0])
+        self.assertEqual(set(tables), set(TABLE_SCHEMAS))
+        referral = tables['referral']
+        self.assertEqual(referral['referralinstanceid'].dtype, np.int64)
+        self.assertEqual(referral['statusid'].dtype, np.float64)
+        self.assertTrue(np.issubdtype(referral['referraltakendate'].dtype, np.datetime64))
+        self.assertEqual(list(referral['referraltakendate']),
+                         list(pd.to_datetime([r['referraltakendate'] for r in self.payloads[0]['referral']])))
+        self.assertTrue(np.issubdtype(tables['client']['clientdateofbirth'].dtype, np.datetime64))
+
+    def test_unknown_missing_and_null_values(self):
+        payload = {
+            'referral': [{'referralinstanceid': 1, 'clientid': 7, 'referraltakendate': '2017-03-01 10:30:00',
+                          'statusid': None, 'unknown': 'x'},
+                         {'referralinstanceid': 2, 'clientid': None, 'referraltakendate': None,
+                          'referralnotes': 'note'}],
+            'client': [{'clientid': 7, 'clientismale': None}],
+            'referralissue': [],
+            'unknowntable': [{'a': 1}]
+        }
+        UNDECLARED_COLUMNS.discard(('referral', 'unknown'))
+        with self.assertLogs('twc_logger', 'WARNING') as logs:
+            tables = SchemaJSONToTablesTransformer().transform(payload)
+        self.assertIn('Column unknown of table referral', logs.output[0])
+        referral = tables['referral']
+        self.assertEqual(list(referral.columns),
+                         ['referralinstanceid', 'clientid', 'statusid', 'referraltakendate', 'referralnotes', 'unknown'])
+        self.assertEqual(referral['unknown'][0], 'x')
+        self.assertTrue(pd.isnull(referral['unknown'][1]))
+        self.assertEqual(referral['clientid'].dtype, np.float64)
+        self.assertTrue(np.isnan(referral['clientid'][1]))
+        # Dates not in the declared format are still parsed
+        self.assertEqual(referral['referraltakendate'][0], pd.Timestamp('2017-03-01 10:30'))
+        self.assertTrue(pd.isnull(referral['referraltakendate'][1]))
+        self.assertTrue(pd.isnull(referral['referralnotes'][0]))
+        self.assertTrue(np.isnan(tables['client']['clientismale'][0]))
+        self.assertTrue(tables['referralissue'].empty)
+        self.assertTrue(tables['clientissue'].empty)
+        self.assertNotIn('unknowntable', tables)
@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+from api.model.models import TWCModel, select_clients
+from api.model.train import generate_X_y, train_model
+from api.utils.evaluate import get_scores_per_window
+from api.utils.shadow import ShadowScorer, ShadowRequest, read_shadow_log, shadow_report, SHADOW_LOG_DTYPE
+from api.utils.synthetic import synthetic_tables
+
+
+def copy_tables(tables):
+    return {name: table.copy() for name, table in tables.items()}
+
+
+def fit(tables, n_rows=None, compact=False):
+    """A model fitted on the first n_rows referrals, which scores the rest differently to a model fitted on all"""
+    X, y, _, transformer = generate_X_y(copy_tables(tables), compact=compact)
+    return TWCModel(transformer, train_model(X.iloc[:n_rows], y.iloc[:n_rows], {'n_estimators': 5, 'random_state': 0}))
+
+
+class TestShadowScorer(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tables = synthetic_tables(3000)
+        cls.live = fit(cls.tables)
+        cls.candidate = fit(cls.tables, 1000)
+        client_ids = cls.tables['client']['clientid']
+        cls.payloads = [select_clients(cls.tables, client_ids.iloc[i:i + 3]) for i in range(0, 30, 3)]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.directory, 'shadow.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def shadow(self, scorer, payload):
+        raw_tables = copy_tables(payload) if scorer.needs_tables('live', self.live) else None
+        X, referral_table, scores = self.live.score_tables(copy_tables(payload))
+        return scorer.submit(X, referral_table, scores, raw_tables)
+
+    def expected_scores(self, candidate):
+        expected = {}
+        for payload in self.payloads:
+            expected.update(self.live.predict(copy_tables(payload)))
+        candidate_scores = {}
+        for payload in self.payloads:
+            candidate_scores.update(candidate.predict(copy_tables(payload)))
+        return expected, candidate_scores
+
+    def assert_logged(self, candidate):
+        live, candidate_scores = self.expected_scores(candidate)
+        records = read_shadow_log(self.log_path).set_index('referralinstanceid')
+        self.assertEqual(set(records.index), set(live))
+        for referral_id, row in records.iterrows():
+            self.assertAlmostEqual(row['live'], live[referral_id])
+            self.assertAlmostEqual(row['candidate'], candidate_scores[referral_id])
+
+    def test_candidate_scores_the_live_features(self):
+        scorer = ShadowScorer(lambda: self.candidate, 'candidate', self.log_path)
+        for payload in self.payloads:
+            self.assertTrue(self.shadow(scorer, payload))
+            scorer.drain(10)
+        self.assertFalse(scorer.needs_tables('live', self.live))
+        scorer.close()
+        self.assert_logged(self.candidate)
+        self.assertEqual(scorer.stats()['failures'], 0)
+
+    def test_candidate_with_other_features_transforms_the_tables(self):
+        candidate = fit(self.tables, 1000, compact=True)
+        scorer = ShadowScorer(lambda: candidate, 'candidate', self.log_path)
+        for payload in self.payloads:
+            self.shadow(scorer, payload)
+            scorer.drain(10)
+        self.assertTrue(scorer.needs_tables('live', self.live))
+        scorer.close()
+        self.assert_logged(candidate)
+
+    def test_requests_are_dropped_when_the_queue_is_full(self):
+        loaded = threading.Event()
+        X, referral_table, scores = self.live.score_tables(copy_tables(self.payloads[0]))
+        size = ShadowRequest(X, referral_table, scores, self.payloads[0]).size
+        scorer = ShadowScorer(lambda: loaded.wait(10) and self.candidate, 'candidate', self.log_path,
+                              max_queue_bytes=3 * size)
+        accepted = [self.shadow(scorer, payload) for payload in self.payloads]
+        self.assertIn(False, accepted)
+        self.assertLessEqual(scorer.stats()['queued_bytes'], 3 * size)
+        loaded.set()
+        self.assertTrue(scorer.drain(10))
+        stats = scorer.stats()
+        scorer.close()
+        self.assertEqual(stats['dropped'], accepted.count(False))
+        self.assertEqual((stats['queued'], stats['queued_bytes']), (0, 0))
+
+    def test_report(self):
+        scorer = ShadowScorer(lambda: self.candidate, 'candidate', self.log_path)
+        for payload in self.payloads + self.payloads[:2]:
+            self.shadow(scorer, payload)
+        scorer.drain(10)
+        scorer.close()
+        # A record cut short is ignored
+        with open(self.log_path, 'ab') as fh:
+            fh.write(b'\0' * (SHADOW_LOG_DTYPE.itemsize // 2))
+        records = read_shadow_log(self.log_path)
+        self.assertTrue(records['referralinstanceid'].is_unique)
+        report = shadow_report(self.log_path, 0.2)
+        expected = get_scores_per_window(records['live'], records['candidate'], records['clientid'], 0.2)
+        self.assertEqual(report['referrals'], len(records))
+        self.assertAlmostEqual(report['spearman'], expected['spearman'])
+        self.assertAlmostEqual(report['overlap'], expected['overlap'])
+        # Weeks with too few clients have no correlation, so the weekly metrics may be undefined
+        self.assertIn('weekly_spearman', report)
+        self.assertGreater(report['mean_absolute_difference'], 0)
+        self.assertEqual(shadow_report(os.path.join(self.directory, 'missing.bin')), {'referrals': 0, 'clients': 0})
@@ -0,0 +1,59 @@
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+
+from api.model.train import construct_full_tables, generate_X_y, table_names
+from api.model.models import select_clients
+from api.utils.synthetic import synthetic_tables, synthetic_dump, synthetic_referral_table
+
+
+class TestSyntheticData(TestCase):
+    def test_tables_have_the_shape_of_a_dump(self):
+        tables = synthetic_tables(2000)
+        self.assertEqual(set(tables), set(table_names))
+        referral = tables['referral']
+        self.assertGreaterEqual(len(referral), 2000)
+        self.assertTrue(referral['referralinstanceid'].is_unique)
+        self.assertTrue(referral['clientid'].isin(tables['client']['clientid']).all())
+        for table_name in table_names:
+            if 'referralinstanceid' in tables[table_name] and table_name != 'referral':
+                self.assertTrue(tables[table_name]['referralinstanceid'].isin(referral['referralinstanceid']).all())
+                self.assertFalse(tables[table_name].duplicated().any())
+
+    def test_dump_builds_the_same_tables(self):
+        tables = synthetic_tables(500, seed=3)
+        dumped = construct_full_tables(synthetic_dump(500, seed=3))
+        for table_name in table_names:
+            expected = tables[table_name].sort_values(list(tables[table_name].columns)).reset_index(drop=True)
+            actual = dumped[table_name][expected.columns].sort_values(list(expected.columns)).reset_index(drop=True)
+            for column in ['referraltakendate', 'clientdateofbirth', 'addresssincedate']:
+                if column in actual:
+                    actual[column] = pd.to_datetime(actual[column])
+            pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+
+    def test_referral_counts_are_heavy_tailed_and_bursty(self):
+        referrals = synthetic_referral_table(20000)
+        counts = referrals['referral_clientid'].value_counts()
+        self.assertEqual(counts.median(), 2)
+        self.assertGreater(counts.max(), 50 * counts.median())
+        gaps = referrals.sort_values(['referral_clientid', 'referral_referraltakendate']) \
+            .groupby('referral_clientid')['referral_referraltakendate'].diff().dropna().dt.days
+        self.assertGreater((gaps < 15).mean(), 0.8)
+        self.assertGreater((gaps > 28).mean(), 0.1)
+
+    def test_generation_is_deterministic(self):
+        first, second = synthetic_tables(1000, seed=7), synthetic_tables(1000, seed=7)
+        for table_name in table_names:
+            pd.testing.assert_frame_equal(first[table_name], second[table_name])
+
+    def test_tables_and_payloads_run_through_the_pipeline(self):
+        tables = synthetic_tables(3000)
+        X, y, referral_table, transformer = generate_X_y({name: t.copy() for name, t in tables.items()})
+        self.assertGreater(len(X), 0)
+        self.assertFalse(np.isnan(y).any())
+        client_ids = tables['client']['clientid'].iloc[:5]
+        payload = select_clients(tables, client_ids)
+        self.assertTrue(payload['referral']['clientid'].isin(client_ids).all())
+        X_payload, _, _ = transformer.transform(payload)
+        self.assertEqual(len(X_payload), len(payload['referral']))
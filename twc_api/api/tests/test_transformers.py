@@ -0,0 +1,233 @@
+from unittest import TestCase, skipUnless
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from api.model.train import build_transformer_pipeline
+from api.model.transformers import (AddFutureReferralTargetFeatures, TimeWindowFeatures,
+                                    SplitCurrentAndEverTransformer, TrainingDataGenerator, model_input, take_rows,
+                                    compact_columns, sparse_supported)
+from api.model.models import select_clients
+from api.utils.synthetic import synthetic_tables
+
+
+def random_referral_table(n_referrals=300, n_clients=15, seed=0):
+    rng = np.random.RandomState(seed)
+    referrals = pd.DataFrame({
+        'referral_clientid': rng.randint(0, n_clients, n_referrals),
+        # Includes same day referrals and times of day to exercise ties and whole day rounding
+        'referral_referraltakendate': (pd.Timestamp('2016-01-01')
+                                       + pd.to_timedelta(rng.randint(0, 900, n_referrals), unit='D')
+                                       + pd.to_timedelta(rng.choice([0, 5, 23], n_referrals), unit='h'))
+    }, index=pd.Index(rng.permutation(10 ** 6)[:n_referrals], name='referral_referralinstanceid'))
+    referrals['client_clientid'] = referrals['referral_clientid']
+    return referrals.sort_values(['referral_referraltakendate', 'referral_referralinstanceid'])
+
+
+class TestAddFutureReferralTargetFeatures(TestCase):
+    def test_vectorized_matches_loop(self):
+        transformer = AddFutureReferralTargetFeatures()
+        for seed in range(5):
+            referrals = random_referral_table(seed=seed)
+            loop = transformer.calc_look_ahead_stats(referrals)
+            vectorized = transformer.calc_look_ahead_stats_vectorized(referrals)
+            columns = AddFutureReferralTargetFeatures.TARGET_COLUMNS
+            pd.testing.assert_frame_equal(loop[columns], vectorized[columns])
+
+    def test_fit_transform_uses_engine(self):
+        referrals = random_referral_table()
+        loop = AddFutureReferralTargetFeatures(vectorized=False).fit_transform(referrals)
+        vectorized = AddFutureReferralTargetFeatures().fit_transform(referrals)
+        columns = AddFutureReferralTargetFeatures.TARGET_COLUMNS
+        pd.testing.assert_frame_equal(loop[columns], vectorized[columns])
+
+
+class TestTimeWindowFeatures(TestCase):
+    def test_vectorized_matches_apply(self):
+        for n_clients in [1, 3, 15]:
+            referrals = random_referral_table(n_clients=n_clients)
+            grouped = TimeWindowFeatures([1, 4, 12], vectorized=False).fit_transform(referrals.copy())
+            vectorized = TimeWindowFeatures([1, 4, 12]).fit_transform(referrals.copy())
+            pd.testing.assert_frame_equal(grouped, vectorized)
+
+
+class TestSplitCurrentAndEverTransformer(TestCase):
+    prefixes = ['referralissue_', 'referralreason_']
+
+    def referral_table(self, seed=0):
+        rng = np.random.RandomState(seed)
+        referrals = random_referral_table(seed=seed)
+        for i in range(40):
+            referrals['referralissue_{}'.format(i)] = np.where(rng.rand(len(referrals)) < 0.05, 1.0, np.nan)
+        referrals['referralreason_1'] = rng.randint(0, 3, len(referrals)).astype(float)
+        # Shuffle so each client's referrals are spread through the table
+        return referrals.sample(frac=1, random_state=seed)
+
+    def test_vectorized_matches_expanding(self):
+        for seed in range(3):
+            referrals = self.referral_table(seed)
+            expanding = SplitCurrentAndEverTransformer(self.prefixes, vectorized=False).transform(referrals.copy())
+            vectorized = SplitCurrentAndEverTransformer(self.prefixes).transform(referrals.copy())
+            pd.testing.assert_frame_equal(expanding, vectorized)
+
+    @skipUnless(sparse_supported(), 'Sparse features require pandas >= 0.25')
+    def test_sparse_ever_format(self):
+        referrals = self.referral_table()
+        dense = SplitCurrentAndEverTransformer(self.prefixes).transform(referrals.copy())
+        sparse = SplitCurrentAndEverTransformer(self.prefixes, ever_format='sparse').transform(referrals.copy())
+        ever_columns = [c for c in sparse.columns if c.endswith('_ever')]
+        self.assertTrue(all(hasattr(sparse[c], 'sparse') for c in ever_columns))
+        sparse[ever_columns] = sparse[ever_columns].sparse.to_dense()
+        pd.testing.assert_frame_equal(dense, sparse)
+
+
+@skipUnless(sparse_supported(), 'Sparse features require pandas >= 0.25')
+class TestSparseFeatures(TestCase):
+    def test_sparse_pipeline_matches_dense(self):
+        tables = synthetic_tables(400)
+        dense_pipeline, sparse_pipeline = build_transformer_pipeline(), build_transformer_pipeline(sparse=True)
+        dense_X, dense_y, dense_referrals = dense_pipeline.fit_transform({k: t.copy() for k, t in tables.items()})
+        sparse_X, sparse_y, sparse_referrals = sparse_pipeline.fit_transform({k: t.copy() for k, t in tables.items()})
+        self.assertTrue(all(isinstance(t, pd.SparseDtype) for t in sparse_X.dtypes))
+        pd.testing.assert_frame_equal(dense_X, sparse_X.sparse.to_dense(), check_dtype=False)
+        pd.testing.assert_series_equal(dense_y, sparse_y)
+        pd.testing.assert_frame_equal(dense_referrals, sparse_referrals)
+
+        matrix = model_input(sparse_X)
+        self.assertTrue(scipy.sparse.isspmatrix_csr(matrix))
+        np.testing.assert_array_equal(matrix.toarray(), dense_X.values)
+        self.assertIs(model_input(dense_X), dense_X)
+
+        payload = {k: t.copy() for k, t in tables.items()}
+        pd.testing.assert_frame_equal(dense_pipeline.transform({k: t.copy() for k, t in tables.items()})[0],
+                                      sparse_pipeline.transform(payload)[0].sparse.to_dense(), check_dtype=False)
+
+    def test_take_rows_matches_iloc(self):
+        rng = np.random.RandomState(0)
+        frame = pd.DataFrame({'a': rng.rand(50), 'b': pd.arrays.SparseArray(rng.rand(50) < 0.2, fill_value=False),
+                              'c': pd.arrays.SparseArray(np.where(rng.rand(50) < 0.2, 2.0, 0), fill_value=0)},
+                             index=rng.permutation(1000)[:50])
+        positions = rng.permutation(50)[:30]
+        pd.testing.assert_frame_equal(take_rows(frame, positions), frame.iloc[positions])
+
+
+class TestDtypePolicy(TestCase):
+    def test_compact_columns(self):
+        frame = pd.DataFrame({'flag': [True, False, True], 'count': [0.0, 3.0, 300.0], 'nulls': [1.0, np.nan, 2.0],
+                              'fraction': [0.5, 1.0, 2.0], 'negative': [-1, 2, 3], 'name': ['a', 'b', 'a']})
+        compact = compact_columns(frame, frame.columns)
+        self.assertEqual(list(compact.columns), list(frame.columns))
+        self.assertEqual([str(t) for t in compact.dtypes], ['uint8', 'uint16', 'float32', 'float64', 'int8', 'object'])
+        pd.testing.assert_frame_equal(compact.astype(frame.dtypes.to_dict()), frame)
+        filled = compact_columns(frame, ['nulls'], fill_value=0)
+        self.assertEqual(filled['nulls'].dtype, np.uint8)
+        self.assertEqual(filled['nulls'].tolist(), [1, 0, 2])
+
+    def test_compact_pipeline_matches_dense(self):
+        tables = synthetic_tables(400)
+        dense_X, dense_y, dense_referrals = build_transformer_pipeline().fit_transform(
+            {k: t.copy() for k, t in tables.items()})
+        pipeline = build_transformer_pipeline(compact=True)
+        X, y, referrals = pipeline.fit_transform({k: t.copy() for k, t in tables.items()})
+        self.assertTrue((X.dtypes == np.float32).all())
+        pd.testing.assert_frame_equal(X, dense_X.astype(np.float32))
+        pd.testing.assert_series_equal(y, dense_y)
+        pd.testing.assert_frame_equal(referrals.astype(dense_referrals.dtypes.to_dict()), dense_referrals)
+
+        # The dtype is part of the fitted schema, so a payload is built as in training
+        transform_X = pipeline.transform({k: t.copy() for k, t in tables.items()})[0]
+        self.assertTrue((transform_X.dtypes == np.float32).all())
+        pd.testing.assert_frame_equal(transform_X, X)
+
+
+def database_generator(tables, create_indexes=False):
+    """A TrainingDataGenerator of an in-memory database holding the tables under the database's table names"""
+    generator = TrainingDataGenerator(':memory:', create_indexes=create_indexes)
+    for table_name, table in tables.items():
+        table.to_sql(TrainingDataGenerator.TABLES[table_name], generator.con, index=False)
+    return generator
+
+
+def sorted_rows(table):
+    return table.sort_values(list(table.columns)).reset_index(drop=True)
+
+
+class TestTrainingDataGenerator(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tables = synthetic_tables(3000)
+
+    def assert_tables_equal(self, actual, expected):
+        self.assertEqual(set(actual), set(expected))
+        for table_name in expected:
+            self.assertEqual(list(actual[table_name].columns), list(expected[table_name].columns))
+            pd.testing.assert_frame_equal(sorted_rows(actual[table_name]), sorted_rows(expected[table_name]),
+                                          check_dtype=False)
+
+    def test_reads_every_table(self):
+        tables = database_generator(self.tables).get_training_data()
+        self.assert_tables_equal(tables, self.tables)
+        self.assertEqual(tables['referralissue']['clientissueid'].dtype, np.int64)
+        self.assertTrue(np.issubdtype(tables['referral']['referraltakendate'].dtype, np.datetime64))
+
+    def test_filters_are_applied_to_every_table(self):
+        referral = self.tables['referral']
+        start, end = referral['referraltakendate'].quantile([0.25, 0.75])
+        client_ids = self.tables['client']['clientid'].iloc[::3]
+        selected = referral[(referral['referraltakendate'] >= start) & (referral['referraltakendate'] < end)
+                            & referral['clientid'].isin(client_ids)]
+        expected = select_clients(self.tables, selected['clientid'].unique())
+        referral_ids = expected['referral']['referralinstanceid'].isin(selected['referralinstanceid'])
+        expected['referral'] = expected['referral'][referral_ids]
+        for table_name, table in expected.items():
+            if table_name != 'referral' and 'referralinstanceid' in table.columns:
+                expected[table_name] = table[table['referralinstanceid'].isin(selected['referralinstanceid'])]
+        tables = database_generator(self.tables).get_training_data(start_date=start, end_date=end,
+                                                                    client_ids=client_ids)
+        self.assert_tables_equal(tables, expected)
+
+    def test_date_filters_match_dates_stored_in_any_format(self):
+        referral = self.tables['referral']
+        day = referral['referraltakendate'].dt.normalize()
+        start, end = day.quantile([0.25, 0.75])
+        expected = referral[(day >= start) & (day < end)]['referralinstanceid']
+        for date_format in ['%Y-%m-%d', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S']:
+            tables = dict(self.tables, referral=referral.assign(
+                referraltakendate=day.dt.strftime(date_format)))
+            selected = database_generator(tables).get_training_data(start_date=start, end_date=end)['referral']
+            self.assertEqual(sorted(selected['referralinstanceid']), sorted(expected), date_format)
+
+    def test_limit_and_empty_results(self):
+        generator = database_generator(self.tables)
+        limit = self.tables['referral']['referralinstanceid'].median()
+        tables = generator.get_training_data(limit=limit)
+        self.assertTrue((tables['referral']['referralinstanceid'] < limit).all())
+        self.assertTrue(tables['referralreason']['referralinstanceid'].isin(tables['referral']['referralinstanceid'])
+                        .all())
+        tables = generator.get_training_data(client_ids=[])
+        self.assertTrue(all(table.empty for table in tables.values()))
+        self.assertEqual(list(tables['client'].columns), list(self.tables['client'].columns))
+
+    def test_null_keys_and_item_ids(self):
+        referral = self.tables['referral'].astype({'clientid': object})
+        referral.loc[0, 'clientid'] = None
+        issues = self.tables['referralissue'].astype({'clientissueid': object})
+        issues.loc[0, 'clientissueid'] = None
+        tables = database_generator(dict(self.tables, referral=referral, referralissue=issues)).get_training_data()
+        self.assertTrue(np.isnan(tables['referral']['clientid'][0]))
+        self.assertEqual(tables['referral']['referralinstanceid'].dtype, np.int64)
+        self.assertEqual(tables['referralissue']['clientissueid'].isnull().sum(), 1)
+        self.assertEqual(tables['referralbenefit']['benefittypeid'].dtype, np.int64)
+
+    def test_indexes_are_only_created_when_asked(self):
+        def index_tables(generator):
+            return {row[0] for row in generator.con.execute("SELECT tbl_name FROM sqlite_master WHERE type = 'index'")}
+
+        generator = database_generator(self.tables)
+        generator.get_training_data(limit=0)
+        self.assertEqual(index_tables(generator), set())
+        generator = database_generator(self.tables, create_indexes=True)
+        with self.assertLogs('twc_logger', 'INFO'):
+            generator.get_training_data(limit=0)
+        self.assertEqual(index_tables(generator), set(TrainingDataGenerator.TABLES.values()))
@@ -0,0 +1,56 @@
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from api.model.train import (generate_X_y, walk_forward_folds, walk_forward_validation, share_matrix, open_shared,
+                             build_regressor)
+from api.model.transformers import model_input
+from api.utils.evaluate import evaluate_average_weekly_rank_correlation
+from api.utils.synthetic import synthetic_tables
+
+HYPERPARAMS = {'n_estimators': 5, 'random_state': 0}
+
+
+class TestWalkForwardValidation(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.X, cls.y, cls.referral_table, _ = generate_X_y(synthetic_tables(4000))
+
+    def test_folds_walk_forward_over_the_latest_rows(self):
+        folds = walk_forward_folds(1000, 4)
+        self.assertEqual(folds, [(500, 625), (625, 750), (750, 875), (875, 1000)])
+        self.assertEqual(walk_forward_folds(1000, 2, min_train_proportion=0.8), [(800, 900), (900, 1000)])
+
+    def test_shared_matrices_round_trip(self):
+        directory = tempfile.mkdtemp()
+        try:
+            dense = np.arange(12, dtype=np.float32).reshape(4, 3)
+            shared = open_shared(share_matrix(pd.DataFrame(dense), directory))
+            self.assertIsInstance(shared, np.memmap)
+            np.testing.assert_array_equal(shared, dense)
+            csr = sp.random(20, 5, density=0.3, format='csr', random_state=0)
+            np.testing.assert_array_equal(open_shared(share_matrix(csr, directory)).toarray(),
+                                          csr.toarray().astype(np.float32))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_fold_metrics_match_a_fit_on_each_split(self):
+        metrics = walk_forward_validation(self.X, self.y, self.referral_table, 3, HYPERPARAMS, workers=1)
+        self.assertEqual(len(metrics), 3)
+        self.assertTrue((metrics['test_start'].diff().dropna() > pd.Timedelta(0)).all())
+        train_end, test_end = walk_forward_folds(len(self.X), 3)[1]
+        model = build_regressor(HYPERPARAMS, n_jobs=1).fit(model_input(self.X.iloc[:train_end]), self.y[:train_end])
+        expected = evaluate_average_weekly_rank_correlation(
+            self.referral_table.iloc[train_end:test_end], self.y.values[train_end:test_end],
+            model.predict(model_input(self.X.iloc[train_end:test_end])), 0.2)
+        self.assertAlmostEqual(metrics.loc[1, 'spearman'], expected['spearman'])
+        self.assertAlmostEqual(metrics.loc[1, 'overlap'], expected['overlap'])
+
+    def test_worker_processes_give_the_same_metrics(self):
+        sequential = walk_forward_validation(self.X, self.y, self.referral_table, 2, HYPERPARAMS, workers=1)
+        parallel = walk_forward_validation(self.X, self.y, self.referral_table, 2, HYPERPARAMS, workers=2)
+        pd.testing.assert_frame_equal(sequential, parallel)
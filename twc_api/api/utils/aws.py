@@ -1,21 +1,26 @@
-import datetime
-from json import JSONDecodeError
+import threading
+import time
 
 import boto3
 import os
-import tempfile
 import pickle
-import json
 from io import BytesIO
 import logging
 
 import shutil
+import tempfile
 from botocore.exceptions import ClientError
 from flask import current_app
 
+from api.model.artifact import load_artifact
+from api.utils.log_shipping import BufferedLogShipper
+from api.utils.registry import ModelRegistry, S3Storage, LocalStorage, file_sha256
+
 STATUS_FILE_NAME = 'twc_status'
 MODEL_ROOT_NAME = 'twc_model_'
 ACTIVE_RUN_LOGFILE_NAME = 'current_retrain_run.log'
+# The active retrain log is uploaded as numbered parts under this prefix, see BufferedLogShipper
+LOG_PARTS_PREFIX = ACTIVE_RUN_LOGFILE_NAME + '.parts/'
 TRAINING_BUCKET = 'twc-input'
 
 if 'SERVERTYPE' in os.environ and os.environ['SERVERTYPE'] == 'AWS Lambda':
@@ -32,16 +37,21 @@ def upload_file_to_bucket(file_path, bucket_name, file_name):
     bucket = s3.Bucket(bucket_name)
     bucket.upload_file(file_path, file_name)
 
-def get_models():
-    bucket = s3.Bucket(bucket_name())
-    return {int(o.key.split('_')[-1]): {'key': o.key,
-             'last_modified': str(o.last_modified)} for o in bucket.objects.all() if valid_name(o.key)}
+_registries = {}
 
-def valid_name(name):
-    try:
-        return name.startswith(MODEL_ROOT_NAME) and int(name[len(MODEL_ROOT_NAME):]) > -1
-    except:
-        return False
+def get_registry():
+    """Returns the ModelRegistry of the configured model storage, the model bucket or a local directory"""
+    if current_app.config['TWC_REGISTRY_BACKEND'] == 'local':
+        location = ('local', current_app.config['TWC_REGISTRY_PATH'])
+    else:
+        location = ('s3', bucket_name())
+    if location not in _registries:
+        storage = LocalStorage(location[1]) if location[0] == 'local' else S3Storage(s3, location[1])
+        _registries[location] = ModelRegistry(storage, MODEL_ROOT_NAME, STATUS_FILE_NAME)
+    return _registries[location]
+
+def get_models():
+    return get_registry().models()
 
 class OverwriteFailure(Exception):
     pass
@@ -54,39 +64,21 @@ class NoModelsFound(Exception):
 
 
 def get_status():
-    try:
-        file_content = s3.Object(bucket_name(), STATUS_FILE_NAME).get()['Body'].read().decode('utf-8')
-        json_content = json.loads(file_content)
-        return json_content
-    except ClientError as ex:
-        if ex.response['Error']['Code'] == 'NoSuchKey':
-            return []
-        else:
-            raise ex
-    except JSONDecodeError:
-        return []
+    return get_registry().status()
 
 def set_model(version):
-    models = get_models()
-    if int(version) not in models:
+    if not get_registry().set_current(version):
         raise ModelNotFound()
-    else:
-        new_entry = {
-            'current_version': int(version),
-            'timestamp': str(datetime.datetime.now())
-        }
-        status = get_status()
-        status.append(new_entry)
-        file = tempfile.NamedTemporaryFile('wb', delete=False)
-        with open(file.name, 'w') as fh:
-            json.dump(status, fh)
-        upload_file_to_bucket(file.name, bucket_name(), STATUS_FILE_NAME)
-        os.remove(file.name)
+    model_version_cache.invalidate()
+
+def model_key_of_version(version):
+    """The key a model version is registered under, raises ValueError if the version isn't a number"""
+    return MODEL_ROOT_NAME + str(int(version))
 
 def get_current_model_key():
-    models = get_models()
-    status = get_status()
+    return model_version_cache.get(current_app.config['MODEL_VERSION_TTL'])
 
+def resolve_current_model_key(models, status):
     if len(models) == 0:
         raise NoModelsFound()
 
@@ -101,49 +93,171 @@ def get_current_model_key():
     else:
         return models[max_model]['key']
 
+class ModelVersionCache(object):
+    """Caches the resolved live model key so that scoring doesn't read the registry manifest on every request.
+
+    Within the TTL the cached key is returned without any storage calls. Once it expires the manifest is revalidated
+    with a conditional GET on its ETag, which extends the TTL if the manifest is unchanged. Since the manifest holds
+    both the registered models and the live model history, any change which could move the live model changes it.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self.invalidate()
+
+    def invalidate(self):
+        """Forces the next lookup to resolve the live model from storage"""
+        self.model_key = None
+        self.etag = None
+        self.expires = 0
+
+    def get(self, ttl):
+        """
+
+        :param ttl: Seconds a resolved model key is used for before it is revalidated
+        """
+        with self.lock:
+            if self.model_key is not None and time.time() < self.expires:
+                self.hits += 1
+                return self.model_key
+
+            registry = get_registry()
+            manifest, etag = registry.read_manifest(if_none_match=self.etag if self.model_key is not None else None)
+            if manifest is None:
+                self.revalidations += 1
+                self.expires = time.time() + ttl
+                return self.model_key
+
+            self.misses += 1
+            self.model_key = resolve_current_model_key(registry.models(manifest), registry.status(manifest))
+            self.etag = etag
+            self.expires = time.time() + ttl
+            return self.model_key
+
+    def stats(self):
+        lookups = self.hits + self.revalidations + self.misses
+        return {
+            'hits': self.hits,
+            'revalidations': self.revalidations,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else None
+        }
+
+model_version_cache = ModelVersionCache()
+
 def load_model_into_memory(model_key):
+    registry = get_registry()
+    if current_app.config['USE_MODEL_ARTIFACTS']:
+        entry = [e for e in registry.models().values() if e['key'] == model_key]
+        if entry and 'artifact' in entry[0]:
+            return load_artifact(cache_artifact(entry[0]['artifact']))
+    return load_pickled_model(model_key)
+
+def load_pickled_model(model_key):
+    """The pickled TWCModel of a registered model, which unlike its artifact can be extended with new trees"""
     b = BytesIO()
-    bucket = s3.Bucket(bucket_name())
-    bucket.download_fileobj(model_key, b)
+    get_registry().storage.download_fileobj(model_key, b)
     b.seek(0)
-    model_dict = pickle.load(b)
-    return model_dict
+    return pickle.load(b)
+
+def cache_artifact(artifact):
+    """Returns the local path of a model artifact, downloading it into the model cache directory unless an identical
+    copy is already there. Cached files are named by content hash, so a copy is never stale"""
+    cache_dir = current_app.config['MODEL_CACHE_DIR']
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, '{}-{}'.format(artifact['sha256'][:16], artifact['key']))
+    if os.path.exists(path) and os.path.getsize(path) == artifact['size']:
+        return path
+    fd, temp_path = tempfile.mkstemp(dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            get_registry().storage.download_fileobj(artifact['key'], fh)
+        if file_sha256(temp_path) != artifact['sha256']:
+            raise IOError('Downloaded model artifact {} does not match its checksum'.format(artifact['key']))
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return path
 
-def save_model(filename, logfile, logfile_name):
-    upload_file_to_bucket(filename, bucket_name(), filename)
+def save_model(filename, logfile, logfile_name, source=None, artifact=None, report=None):
+    get_registry().register_model(filename, filename, source=source, artifact_path=artifact, report_path=report)
     upload_file_to_bucket(logfile, TRAINING_BUCKET, logfile_name)
 
-def load_train_file_into_memory(filename):
-    b = BytesIO()
-    bucket = s3.Bucket(TRAINING_BUCKET)
-    bucket.download_fileobj(filename, b)
-    b.seek(0)
-    input_file = json.load(b)
-    return input_file
+def open_train_file(filename):
+    """Returns a streaming file-like object of a training file, for parsing it without holding the whole file"""
+    return s3.Object(TRAINING_BUCKET, filename).get()['Body']
 
+def train_file_etag(filename):
+    """Returns the ETag of a training file, which changes whenever its contents do"""
+    return s3.Object(TRAINING_BUCKET, filename).e_tag
 
 def next_model_name():
-    models = get_models()
-    top_model_id = max(models.keys())
-    next_model_id = top_model_id + 1
-    return MODEL_ROOT_NAME + str(top_model_id + 1), next_model_id
+    next_model_id = get_registry().next_version()
+    return MODEL_ROOT_NAME + str(next_model_id), next_model_id
+
+def log_part_key(index):
+    return '{}{:06d}'.format(LOG_PARTS_PREFIX, index)
+
+def log_part_keys():
+    """Keys of the uploaded parts of the active retrain log, in order"""
+    return sorted(obj.key for obj in s3.Bucket(TRAINING_BUCKET).objects.filter(Prefix=LOG_PARTS_PREFIX))
 
-def sync_log_to_s3(logger):
-    file_handlers = [fh for fh in logger.handlers if type(fh)==logging.FileHandler]
-    if file_handlers:
-        fh = file_handlers[0]
-        upload_file_to_bucket(fh.baseFilename, TRAINING_BUCKET, ACTIVE_RUN_LOGFILE_NAME)
+def put_log_part(index, text):
+    s3.Object(TRAINING_BUCKET, log_part_key(index)).put(Body=text.encode('utf-8'))
+
+def s3_log_handler(append_previous=False, flush_interval=5.0, flush_bytes=64 * 2 ** 10):
+    """Returns a BufferedLogShipper writing the active retrain log to the training bucket, appending to the parts
+    already there if append_previous, otherwise replacing them"""
+    if append_previous:
+        first_part = len(log_part_keys())
+    else:
+        clear_log_file_from_s3()
+        first_part = 0
+    return BufferedLogShipper(put_log_part, flush_interval, flush_bytes, first_part)
+
+def sync_log_to_s3(logger, wait=False):
+    """Asks the logger's S3 log shipper to upload the records logged so far
+
+    :param wait: Wait for the upload, otherwise it is left to the shipper's background thread
+    """
+    for handler in logger.handlers:
+        if isinstance(handler, BufferedLogShipper):
+            if wait:
+                handler.flush()
+            else:
+                handler.ship_soon()
+
+def stop_log_shipping(logger):
+    """Uploads the remaining records of the logger's S3 log shippers and removes them from the logger"""
+    for handler in list(logger.handlers):
+        if isinstance(handler, BufferedLogShipper):
+            handler.close()
+            logger.removeHandler(handler)
 
 def clear_log_file_from_s3():
-    s3.Object(TRAINING_BUCKET, ACTIVE_RUN_LOGFILE_NAME).delete()
+    keys = log_part_keys()
+    # delete_objects takes at most 1000 keys
+    for start in range(0, len(keys), 1000):
+        s3.Bucket(TRAINING_BUCKET).delete_objects(
+            Delete={'Objects': [{'Key': key} for key in keys[start:start + 1000]]})
+
+def read_log_from_s3():
+    """The active retrain log, the concatenation of its parts, or None if there is no active retrain"""
+    keys = log_part_keys()
+    if not keys:
+        return None
+    return ''.join(s3.Object(TRAINING_BUCKET, key).get()['Body'].read().decode('utf-8') for key in keys)
 
 def download_log_from_s3():
-    s3.Bucket(TRAINING_BUCKET).download_file(ACTIVE_RUN_LOGFILE_NAME, 'retrain_output.log')
+    with open('retrain_output.log', 'w') as fh:
+        fh.write(read_log_from_s3() or '')
 
 def get_training_log_json():
     try:
-        return_value = s3.Object(TRAINING_BUCKET, ACTIVE_RUN_LOGFILE_NAME).get()['Body'].read().decode('utf-8')
+        return_value = read_log_from_s3()
     except ClientError as ex:
-        return_value = 'No model currently running'
-    return return_value
-    
+        return_value = None
+    return return_value if return_value is not None else 'No model currently running'
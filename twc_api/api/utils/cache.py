@@ -0,0 +1,122 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import tempfile
+
+logger = logging.getLogger('twc_logger')
+
+CACHE_SUFFIX = '.pkl'
+
+
+class DiskCache(object):
+    """Size bounded on-disk cache of pickled objects, e.g. DataFrames, under content keys. Keys are hashes of
+    everything the value was built from, so an entry is never stale, it's only evicted. Using an entry marks it as
+    recently used, and the least recently used entries are evicted once the cache holds more than max_bytes.
+    """
+    def __init__(self, directory, max_bytes):
+        """
+
+        :param directory: Directory holding the entries, created if it doesn't exist
+        :param max_bytes: Total size of the entries kept
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        """Hashes the json representation of parts into a key"""
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + CACHE_SUFFIX)
+
+    def get(self, key, name='entry'):
+        """Returns the cached value, or None if there is no entry for the key
+
+        :param key: Key as returned by key
+        :param name: Description of the entry for the log
+        """
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as fh:
+                value = pickle.load(fh)
+        except FileNotFoundError:
+            self.misses += 1
+            logger.info('Cache miss for {} {}'.format(name, key[:12]))
+            return None
+        except Exception as ex:
+            # A partial or unreadable entry is treated as missing
+            logger.warning('Dropping unreadable cache entry {}: {}'.format(key[:12], ex))
+            self.remove(key)
+            self.misses += 1
+            return None
+        os.utime(path)
+        self.hits += 1
+        logger.info('Cache hit for {} {}'.format(name, key[:12]))
+        return value
+
+    def put(self, key, value, name='entry'):
+        """Stores a value, then evicts least recently used entries down to max_bytes. Values larger than max_bytes on
+        their own aren't kept. Caching is best effort, a value which can't be written, e.g. as the disk is full, is
+        logged and not kept rather than failing the caller"""
+        temp_path = None
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'wb') as fh:
+                pickle.dump(value, fh, protocol=pickle.HIGHEST_PROTOCOL)
+            size = os.path.getsize(temp_path)
+            if size > self.max_bytes:
+                os.remove(temp_path)
+                logger.info('Not caching {} {}, {} bytes is over the cache size'.format(name, key[:12], size))
+                return
+            os.replace(temp_path, self.path(key))
+        except OSError as ex:
+            logger.warning('Not caching {} {}: {}'.format(name, key[:12], ex))
+            if temp_path is not None:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+            return
+        logger.info('Cached {} {} ({} bytes)'.format(name, key[:12], size))
+        self.evict()
+
+    def remove(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def entries(self):
+        """Returns (last used time, size, path) of every entry, least recently used first"""
+        entries = []
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith(CACHE_SUFFIX):
+                path = os.path.join(self.directory, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            logger.info('Evicted cache entry {}'.format(os.path.basename(path)[:12]))
@@ -1,6 +1,9 @@
 from scipy.stats import spearmanr
+import numpy as np
 import pandas as pd
 
+from api.model.transformers import week_ending
+
 def get_scores_per_window(actual, predicted, group, threshold=0.50):
     corr = spearmanr(actual, predicted)[0]
     mu_a = actual.groupby(group).mean()
@@ -10,16 +13,71 @@ def get_scores_per_window(actual, predicted, group, threshold=0.50):
     overlap = mu_p_top.index.isin(mu_a_top.index).mean()
     return pd.Series([corr, overlap], index=['spearman', 'overlap'])
 
+def segment_ranks(segments, values):
+    """Ascending ranks of values within each segment, ties given their average rank as pandas and scipy do
+
+    :param segments: Segment number of each value, sorted
+    """
+    order = np.lexsort((values, segments))
+    sorted_segments, sorted_values = segments[order], values[order]
+    starts = np.flatnonzero(np.r_[True, sorted_segments[1:] != sorted_segments[:-1]])
+    sizes = np.diff(np.r_[starts, len(values)])
+    positions = np.arange(len(values)) - np.repeat(starts, sizes) + 1
+    # Runs of equal values within a segment share the mean of their positions
+    tie_starts = np.flatnonzero(np.r_[True, (sorted_segments[1:] != sorted_segments[:-1])
+                                      | (sorted_values[1:] != sorted_values[:-1])])
+    tie_sizes = np.diff(np.r_[tie_starts, len(values)])
+    tie_ranks = np.add.reduceat(positions, tie_starts) / tie_sizes if len(values) else np.zeros(0)
+    ranks = np.empty(len(values))
+    ranks[order] = np.repeat(tie_ranks, tie_sizes)
+    return ranks
+
+def weekly_scores(test_referral_table, y_test, y_pred, threshold):
+    """The spearman correlation of the actual and predicted client mean scores of each week and the overlap of their top
+    threshold proportions, as get_scores_per_window gives for each week's clients, computed for every week at once.
+    Returns a DataFrame indexed by week ending date, with NaN metrics for weeks where they are undefined
+
+    :param test_referral_table: Referral table with the referral_referraltakendate and client_clientid of each row
+    :param y_test: Actual scores of the rows
+    :param y_pred: Predicted scores of the rows
+    :param threshold: Proportion of each week's clients counted as its top cases
+    """
+    if isinstance(y_test, pd.Series) and not y_test.index.equals(test_referral_table.index):
+        y_test = y_test.reindex(test_referral_table.index)
+    if not len(test_referral_table):
+        return pd.DataFrame(columns=['spearman', 'overlap'], dtype=np.float64)
+    # Days since the epoch of the Sunday ending each row's week
+    weeks = week_ending(test_referral_table['referral_referraltakendate']).values.astype('datetime64[D]')
+    weeks = weeks.astype(np.int64)
+    # Mean actual and predicted score of each client's referrals in each week. pandas sums with compensation, so the
+    # means, and which of them tie, are exactly those of a groupby of each week
+    means = pd.DataFrame({'week': weeks, 'client': pd.factorize(test_referral_table['client_clientid'])[0],
+                          'y': np.asarray(y_test, dtype=np.float64), 'pred': np.asarray(y_pred, dtype=np.float64)})\
+              .groupby(['week', 'client'])[['y', 'pred']].mean()
+    mu_a, mu_p = means['y'].values, means['pred'].values
+    pair_weeks = means.index.get_level_values('week').values
+    week_labels, segments = np.unique(pair_weeks, return_inverse=True)
+    sizes = np.bincount(segments).astype(np.float64)
+
+    rank_a, rank_p = segment_ranks(segments, mu_a), segment_ranks(segments, mu_p)
+    # Pearson correlation of the ranks, whose mean within a week is (size + 1) / 2
+    centred_a, centred_p = rank_a - ((sizes + 1) / 2)[segments], rank_p - ((sizes + 1) / 2)[segments]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        spearman = (np.bincount(segments, centred_a * centred_p)
+                    / np.sqrt(np.bincount(segments, centred_a ** 2) * np.bincount(segments, centred_p ** 2)))
+    # Like spearmanr, undefined for weeks with a single client, constant scores or null means
+    has_null = np.bincount(segments, np.isnan(mu_a) | np.isnan(mu_p)) > 0
+    spearman[(sizes < 2) | has_null | ~np.isfinite(spearman)] = np.nan
+    spearman = np.clip(spearman, -1, 1)
+
+    # Descending average ranks are size + 1 minus the ascending ones
+    top_a = (sizes[segments] + 1 - rank_a) / sizes[segments] < threshold
+    top_p = (sizes[segments] + 1 - rank_p) / sizes[segments] < threshold
+    with np.errstate(invalid='ignore', divide='ignore'):
+        overlap = np.bincount(segments, top_a & top_p) / np.bincount(segments, top_p)
+
+    index = pd.DatetimeIndex(week_labels.astype('datetime64[D]'), name='referral_referraltakendate')
+    return pd.DataFrame({'spearman': spearman, 'overlap': overlap}, index=index, columns=['spearman', 'overlap'])
+
 def evaluate_average_weekly_rank_correlation(test_referral_table, y_test, y_pred, threshold):
-    grouped_y = test_referral_table.assign(y=y_test, pred=y_pred)\
-                                    .set_index('referral_referraltakendate')\
-                                    .groupby([pd.Grouper(freq='1W'), 'client_clientid'])['y']\
-                                    .mean()
-    grouped_pred_y = test_referral_table.assign(y=y_test, pred=y_pred)\
-                                        .set_index('referral_referraltakendate')\
-                                        .groupby([pd.Grouper(freq='1W'), 'client_clientid'])['pred']\
-                                        .mean()
-    time_grouped = pd.concat([grouped_y, grouped_pred_y], axis=1)
-    return time_grouped.reset_index()\
-                .groupby(['referral_referraltakendate'])\
-                .apply(lambda k: get_scores_per_window(k['y'], k['pred'], k['client_clientid'], threshold)).dropna().mean()
\ No newline at end of file
+    return weekly_scores(test_referral_table, y_test, y_pred, threshold).dropna().mean()
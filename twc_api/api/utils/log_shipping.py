@@ -0,0 +1,116 @@
+import logging
+import sys
+import threading
+import time
+
+
+class BufferedLogShipper(logging.Handler):
+    """Logging handler which buffers formatted records and uploads them from a background thread as numbered part
+    objects, so that logging never waits on the network and each record is uploaded once. The parts concatenated in
+    order are the log.
+
+    The buffer is shipped as the next part once it holds flush_bytes, flush_interval seconds after the last shipment,
+    when ship_soon is called, e.g. at a milestone of a retrain, and on flush and close. A part which fails to upload is
+    kept and retried with the next one. After a failure the background thread backs off, waiting flush_interval and
+    then twice as long after each further failure up to max_retry_interval, so an outage isn't retried in a tight loop.
+    """
+    def __init__(self, write_part, flush_interval=5.0, flush_bytes=64 * 2 ** 10, first_part=0,
+                 max_retry_interval=60.0):
+        """
+
+        :param write_part: Function taking the part number and the text of a part, which uploads it
+        :param flush_interval: Longest time in seconds a record is buffered for
+        :param flush_bytes: Buffer size which triggers a shipment
+        :param first_part: Number of the first part written, to append to the parts of an earlier run
+        :param max_retry_interval: Longest time in seconds between retries of a failing upload
+        """
+        super().__init__()
+        self.write_part = write_part
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.next_part = first_part
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.shipped_bytes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.max_retry_interval = max_retry_interval
+        self.requested = False
+        self.closed = False
+        self.condition = threading.Condition()
+        # Held while a part is uploaded, so parts are written one at a time and in order
+        self.ship_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name='log-shipper', daemon=True)
+        self.thread.start()
+
+    def emit(self, record):
+        try:
+            message = self.format(record) + '\n'
+        except Exception:
+            self.handleError(record)
+            return
+        with self.condition:
+            self.buffer.append(message)
+            self.buffered_bytes += len(message)
+            if self.buffered_bytes >= self.flush_bytes:
+                self.condition.notify()
+
+    def ship_soon(self):
+        """Wakes the background thread to ship the buffer now, without waiting for the upload"""
+        with self.condition:
+            self.requested = True
+            self.condition.notify()
+
+    def retry_interval(self):
+        return min(self.flush_interval * 2 ** (self.consecutive_failures - 1), self.max_retry_interval)
+
+    def run(self):
+        while True:
+            with self.condition:
+                if self.consecutive_failures:
+                    # Only close cuts a back off short, as a full buffer or a request would retry straight away
+                    deadline = time.time() + self.retry_interval()
+                    while not self.closed and time.time() < deadline:
+                        self.condition.wait(deadline - time.time())
+                elif not (self.closed or self.requested or self.buffered_bytes >= self.flush_bytes):
+                    self.condition.wait(self.flush_interval)
+                self.requested = False
+                if self.closed:
+                    # close ships whatever is left
+                    return
+            self.ship()
+
+    def ship(self):
+        """Uploads the buffered records as the next part, returns False if the upload failed"""
+        with self.ship_lock:
+            with self.condition:
+                part, self.buffer, self.buffered_bytes = ''.join(self.buffer), [], 0
+            if not part:
+                return True
+            try:
+                self.write_part(self.next_part, part)
+            except Exception as ex:
+                with self.condition:
+                    self.buffer.insert(0, part)
+                    self.buffered_bytes += len(part)
+                self.failures += 1
+                self.consecutive_failures += 1
+                sys.stderr.write('Failed to upload log part {}: {}\n'.format(self.next_part, ex))
+                return False
+            self.next_part += 1
+            self.shipped_bytes += len(part)
+            self.consecutive_failures = 0
+            return True
+
+    def flush(self):
+        """Uploads the buffered records, waiting for the upload"""
+        self.ship()
+
+    def close(self):
+        """Stops the background thread and uploads the remaining records"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        self.ship()
+        super().close()
@@ -0,0 +1,137 @@
+import logging
+import pickle
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger('twc_logger')
+
+
+class ByteCounter(object):
+    """File-like object which only counts the bytes written to it"""
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        # Large arrays may be written as buffers of them rather than as bytes
+        self.size += memoryview(data).nbytes
+
+
+# Arrays of a fitted sklearn tree, which are views of its node and value arrays
+TREE_ARRAYS = ['children_left', 'children_right', 'feature', 'threshold', 'impurity', 'n_node_samples',
+               'weighted_n_node_samples', 'value']
+
+
+def pickled_size(obj):
+    counter = ByteCounter()
+    pickle.dump(obj, counter, protocol=pickle.HIGHEST_PROTOCOL)
+    return counter.size
+
+
+def forest_size(forest):
+    """Bytes of the node arrays of a FlatForest or a fitted sklearn forest, read from their nbytes so that memory
+    mapped arrays aren't paged in"""
+    if hasattr(forest, 'children_left'):
+        return sum(array.nbytes for array in [forest.children_left, forest.children_right, forest.feature,
+                                              forest.threshold, forest.value, forest.roots])
+    return sum(getattr(estimator.tree_, name).nbytes for estimator in forest.estimators_ for name in TREE_ARRAYS)
+
+
+def model_size(model):
+    """Approximate memory held by a loaded model, dominated by its tree node arrays. A TWCModel is sized from the
+    arrays of its forest, and of the flat forest built from it if any, plus the pickle of its transformer, so sizing it
+    doesn't serialize the trees. Anything else is sized by its pickle"""
+    if not (hasattr(model, 'transformer') and hasattr(model, 'model')):
+        return pickled_size(model)
+    size = pickled_size(model.transformer) + forest_size(model.model)
+    if getattr(model, '_flat_forest', None) is not None:
+        size += forest_size(model._flat_forest)
+    return size
+
+
+class ModelCache(object):
+    """In-process cache of loaded models keyed by model key, so several versions can be served side by side and
+    switching back to a recently used version doesn't reload it. Using a model marks it as recently used, and the least
+    recently used models are evicted once the loaded models take more than max_bytes. The model just loaded is kept
+    even if it's over the budget on its own.
+
+    A model is loaded once however many requests ask for it at the same time, and requests for models already loaded
+    don't wait for it.
+    """
+    def __init__(self, loader, max_bytes, sizer=model_size):
+        """
+
+        :param loader: Function loading the model of a model key
+        :param max_bytes: Memory budget of the loaded models
+        :param sizer: Function returning the memory a loaded model takes
+        """
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.sizer = sizer
+        self.lock = threading.Lock()
+        # Model key: (model, size), least recently used first
+        self.entries = OrderedDict()
+        self.loading = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            load_lock = self.loading.setdefault(key, threading.Lock())
+        with load_lock:
+            with self.lock:
+                # Loaded by another request while this one waited
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return self.entries[key][0]
+            try:
+                model = self.loader(key)
+                size = self.sizer(model)
+            except Exception:
+                with self.lock:
+                    self.loading.pop(key, None)
+                raise
+            with self.lock:
+                # Cached before the load lock is dropped, so later requests find it either way
+                self.loading.pop(key, None)
+                self.misses += 1
+                self.entries[key] = (model, size)
+                logger.info('Loaded model {} ({} bytes)'.format(key, size))
+                self.evict()
+            return model
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def evict(self):
+        """Evicts least recently used models down to max_bytes, called with the lock held"""
+        total = sum(size for _, size in self.entries.values())
+        while total > self.max_bytes and len(self.entries) > 1:
+            key, (_, size) = self.entries.popitem(last=False)
+            total -= size
+            self.evictions += 1
+            logger.info('Evicted model {} ({} bytes)'.format(key, size))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            models = [{'key': key, 'bytes': size} for key, (_, size) in self.entries.items()]
+        lookups = self.hits + self.misses
+        return {
+            'models': models,
+            'bytes': sum(model['bytes'] for model in models),
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else None
+        }
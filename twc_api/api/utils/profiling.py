@@ -0,0 +1,99 @@
+import cProfile
+import datetime
+import json
+import logging
+import os
+import resource
+import sys
+import time
+
+logger = logging.getLogger('twc_logger')
+
+REPORT_SUFFIX = '.profile.json'
+
+
+def shape_of(data):
+    """Rows and columns of a DataFrame, Series or array, of each table of a dictionary of tables, or of X in the
+    (X, y, referral table) tuple of the aligner. None for anything else, e.g. a fitted estimator"""
+    if isinstance(data, dict):
+        return {name: shape_of(table) for name, table in data.items()}
+    if isinstance(data, tuple):
+        return shape_of(data[0]) if data else None
+    shape = getattr(data, 'shape', None)
+    if shape is None:
+        return None
+    return {'rows': int(shape[0]), 'columns': int(shape[1]) if len(shape) > 1 else 1}
+
+
+def max_rss_mb():
+    """Peak resident set size of the process so far in MB, ru_maxrss is in KB on Linux but bytes on macOS"""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2 ** 20 if sys.platform == 'darwin' else max_rss / 2 ** 10
+
+
+class Profiler(object):
+    """Records the wall time, CPU time, growth of the peak RSS and input and output shapes of each stage of a retrain,
+    e.g. each transformer step, the model fit and the evaluation, for a JSON report.
+
+    The peak RSS only grows when a stage needs more memory than any stage before it, so a stage's peak_rss_delta_mb is
+    how far it raised the process high water mark, 0 for stages which fit in memory already used.
+    """
+    def __init__(self, profile_dir=None, enabled=True):
+        """
+
+        :param profile_dir: Directory to write a cProfile dump of each stage to, none are written if None
+        :param enabled: Whether to record anything, a disabled profiler only calls the stages
+        """
+        self.profile_dir = profile_dir
+        self.enabled = enabled
+        self.stages = []
+        self.created = str(datetime.datetime.now())
+        if enabled and profile_dir is not None:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    def call(self, name, func, *args, **kwargs):
+        """Returns func(*args, **kwargs), recording it as a stage. The input shape is that of the first argument
+
+        :param name: Name of the stage in the report
+        """
+        if not self.enabled:
+            return func(*args, **kwargs)
+        record = {'name': name, 'input': shape_of(args[0]) if args else None}
+        profile = cProfile.Profile() if self.profile_dir is not None else None
+        rss_before = max_rss_mb()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            if profile is not None:
+                profile.disable()
+        record.update({'wall_seconds': time.perf_counter() - wall_start,
+                       'cpu_seconds': time.process_time() - cpu_start,
+                       'peak_rss_delta_mb': max_rss_mb() - rss_before,
+                       'output': shape_of(result)})
+        if profile is not None:
+            record['cprofile'] = os.path.join(self.profile_dir, '{:02d}-{}.prof'.format(len(self.stages), name))
+            profile.dump_stats(record['cprofile'])
+        self.stages.append(record)
+        logger.debug('{name}: {wall_seconds:.2f}s wall, {cpu_seconds:.2f}s CPU, peak RSS +{peak_rss_delta_mb:.1f}MB'
+                     .format(**record))
+        return result
+
+    def record_cached(self, name, output):
+        """Records a stage whose output was taken from a cache rather than computed"""
+        if self.enabled:
+            self.stages.append({'name': name, 'cached': True, 'output': shape_of(output)})
+
+    def report(self):
+        return {'created': self.created,
+                'total_wall_seconds': sum(stage.get('wall_seconds', 0) for stage in self.stages),
+                'total_cpu_seconds': sum(stage.get('cpu_seconds', 0) for stage in self.stages),
+                'peak_rss_mb': max_rss_mb(),
+                'stages': self.stages}
+
+    def save(self, path):
+        with open(path, 'w') as fh:
+            json.dump(self.report(), fh, indent=2)
+        return path
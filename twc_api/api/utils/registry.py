@@ -0,0 +1,315 @@
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import uuid
+
+from botocore.exceptions import ClientError
+
+from api.model.artifact import ARTIFACT_SUFFIX, FORMAT_VERSION as ARTIFACT_FORMAT_VERSION
+from api.utils.profiling import REPORT_SUFFIX
+
+MANIFEST_NAME = 'twc_registry.json'
+MANIFEST_FORMAT_VERSION = 1
+# Prefix of the journal objects, one per registered model and one per live model change
+JOURNAL_PREFIX = 'twc_registry.journal.'
+# UTC time in the journal object keys, which compaction reads their age from
+JOURNAL_TIME_FORMAT = '%Y%m%dT%H%M%S%f'
+# Age after which journal objects merged into the manifest are deleted. It's far longer than any update takes, so no
+# process still holds a manifest read from before they were merged
+JOURNAL_RETENTION = datetime.timedelta(hours=1)
+
+
+def file_sha256(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class S3Storage(object):
+    """Model bucket storage on S3"""
+    def __init__(self, s3, bucket_name):
+        """
+
+        :param s3: boto3 s3 resource
+        :param bucket_name: Name of the model bucket
+        """
+        self.s3 = s3
+        self.bucket_name = bucket_name
+
+    def get(self, key, if_none_match=None):
+        """Returns the object's bytes and ETag, or (None, if_none_match) when if_none_match is given and the object is
+        unchanged. Raises KeyError if there is no such object"""
+        kwargs = {'IfNoneMatch': if_none_match} if if_none_match else {}
+        try:
+            response = self.s3.Object(self.bucket_name, key).get(**kwargs)
+        except ClientError as ex:
+            if ex.response['Error']['Code'] in ('304', 'NotModified'):
+                return None, if_none_match
+            if ex.response['Error']['Code'] == 'NoSuchKey':
+                raise KeyError(key)
+            raise ex
+        return response['Body'].read(), response['ETag']
+
+    def put(self, key, data):
+        """Writes the whole object in a single PUT, which S3 makes visible atomically"""
+        self.s3.Object(self.bucket_name, key).put(Body=data)
+
+    def upload_file(self, file_path, key):
+        self.s3.Bucket(self.bucket_name).upload_file(file_path, key)
+
+    def download_fileobj(self, key, fileobj):
+        self.s3.Bucket(self.bucket_name).download_fileobj(key, fileobj)
+
+    def list(self, prefix=None):
+        """Returns (key, size, last modified) of every object, or of those whose key starts with prefix. Without a
+        prefix this lists the whole bucket"""
+        objects = self.s3.Bucket(self.bucket_name).objects
+        objects = objects.all() if prefix is None else objects.filter(Prefix=prefix)
+        return [(o.key, o.size, str(o.last_modified)) for o in objects]
+
+    def delete(self, key):
+        self.s3.Object(self.bucket_name, key).delete()
+
+
+class LocalStorage(object):
+    """Model bucket storage in a local directory, for running the registry offline"""
+    def __init__(self, root):
+        """
+
+        :param root: Directory holding the objects, created if it doesn't exist
+        """
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def get(self, key, if_none_match=None):
+        path = os.path.join(self.root, key)
+        try:
+            with open(path, 'rb') as fh:
+                data = fh.read()
+        except FileNotFoundError:
+            raise KeyError(key)
+        etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+        if etag == if_none_match:
+            return None, if_none_match
+        return data, etag
+
+    def put(self, key, data):
+        # Write to a temporary file in the same directory and rename it over the target, so readers never see a
+        # partially written object
+        fd, temp_path = tempfile.mkstemp(dir=self.root)
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data)
+        os.replace(temp_path, os.path.join(self.root, key))
+
+    def upload_file(self, file_path, key):
+        with open(file_path, 'rb') as fh:
+            self.put(key, fh.read())
+
+    def download_fileobj(self, key, fileobj):
+        try:
+            with open(os.path.join(self.root, key), 'rb') as fh:
+                shutil.copyfileobj(fh, fileobj)
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def list(self, prefix=None):
+        return [(key, os.path.getsize(os.path.join(self.root, key)),
+                 str(datetime.datetime.fromtimestamp(os.path.getmtime(os.path.join(self.root, key)))))
+                for key in os.listdir(self.root) if prefix is None or key.startswith(prefix)]
+
+    def delete(self, key):
+        # Deleting a missing object isn't an error, as on S3
+        try:
+            os.remove(os.path.join(self.root, key))
+        except FileNotFoundError:
+            pass
+
+
+class ModelRegistry(object):
+    """Keeps a small manifest object of the saved models and the live model history in the model bucket, so listing
+    the models, finding the live model and allocating the next version are a single small read instead of a listing
+    of the whole bucket.
+
+    The manifest has the form
+        {
+            "format_version": 1,
+            "models": {"<version>": {"version", "key", "size", "sha256", "source", "created", "last_modified",
+                                     "artifact": {"key", "size", "sha256", "format_version"}}},
+            "status": [{"current_version", "timestamp"}, ...],
+            "journal": ["<key of a journal object merged into the manifest>", ...]
+        }
+    where status is the live model history previously held in the status file, and artifact, if present, describes the
+    memory mappable model artifact saved next to the pickled model. A bucket without a manifest gets one built from a
+    single listing the first time it is read.
+
+    The registry is updated from several processes, e.g. the retrain Lambda and the API containers, and S3 has no
+    conditional write to make a read-modify-write of the manifest atomic. So every update is first written as its own
+    journal object, under a key made unique by its time and a random uuid, and the manifest is an index of the
+    journal: sync merges the journal objects the manifest is missing into it, and repeats until the manifest it read
+    holds every journal object, so an update lost to a concurrent manifest write is merged back by the writer which
+    lost it. Once merged, journal objects older than JOURNAL_RETENTION are deleted and dropped from the manifest's
+    journal, so the journal listed on every update only holds the recent ones.
+
+    A registered version is never replaced: if two processes register the same version, the first journalled entry is
+    kept and the other register_model raises ValueError.
+    """
+    def __init__(self, storage, model_root_name, status_file_name):
+        """
+
+        :param storage: S3Storage or LocalStorage of the model bucket
+        :param model_root_name: Prefix of model keys, followed by the version number
+        :param status_file_name: Key of the legacy status file, read when building the manifest from a listing
+        """
+        self.storage = storage
+        self.model_root_name = model_root_name
+        self.status_file_name = status_file_name
+
+    def read_manifest(self, if_none_match=None):
+        """Returns the manifest and its ETag, or (None, if_none_match) when the manifest is unchanged"""
+        try:
+            data, etag = self.storage.get(MANIFEST_NAME, if_none_match=if_none_match)
+        except KeyError:
+            self.write_manifest(self.manifest_from_listing())
+            data, etag = self.storage.get(MANIFEST_NAME)
+        if data is None:
+            return None, etag
+        return json.loads(data.decode('utf-8')), etag
+
+    def write_manifest(self, manifest):
+        self.storage.put(MANIFEST_NAME, json.dumps(manifest, indent=1, sort_keys=True).encode('utf-8'))
+
+    def manifest_from_listing(self):
+        models = {}
+        for key, size, last_modified in self.storage.list():
+            version = self.version_from_key(key)
+            if version is not None:
+                models[str(version)] = {'version': version, 'key': key, 'size': size, 'sha256': None,
+                                        'source': None, 'created': last_modified, 'last_modified': last_modified}
+        try:
+            status = json.loads(self.storage.get(self.status_file_name)[0].decode('utf-8'))
+        except (KeyError, ValueError):
+            status = []
+        return {'format_version': MANIFEST_FORMAT_VERSION, 'models': models, 'status': status, 'journal': []}
+
+    def write_journal(self, kind, record):
+        """Writes an update as a journal object of its own, returns its key"""
+        key = '{}{}.{}.{}.json'.format(JOURNAL_PREFIX, kind, datetime.datetime.utcnow().strftime(JOURNAL_TIME_FORMAT),
+                                       uuid.uuid4().hex)
+        self.storage.put(key, json.dumps({'kind': kind, 'record': record}, sort_keys=True).encode('utf-8'))
+        return key
+
+    def sync(self):
+        """Merges the journal objects missing from the manifest into it, returns the manifest holding all of them"""
+        while True:
+            manifest, _ = self.read_manifest()
+            applied = set(manifest.setdefault('journal', []))
+            journal = [key for key, _, _ in self.storage.list(JOURNAL_PREFIX)]
+            # Sorted by kind then time, so models are merged in the order they were journalled
+            missing = sorted(key for key in journal if key not in applied)
+            if not missing:
+                return self.compact(manifest, journal)
+            try:
+                updates = [(key, json.loads(self.storage.get(key)[0].decode('utf-8'))) for key in missing]
+            except KeyError:
+                # Deleted by another process's compaction since the listing, so it's merged in a newer manifest
+                continue
+            for key, update in updates:
+                record = update['record']
+                if update['kind'] == 'model':
+                    manifest['models'].setdefault(str(record['version']), record)
+                else:
+                    manifest['status'].append(record)
+                manifest['journal'].append(key)
+            # Changes journalled concurrently are in timestamp order whichever was merged first
+            manifest['status'].sort(key=lambda change: change['timestamp'])
+            self.write_manifest(manifest)
+
+    def compact(self, manifest, journal):
+        """Deletes the journal objects of a manifest holding all of them which are older than JOURNAL_RETENTION, and
+        drops the deleted ones from its journal, returns the manifest
+
+        :param manifest: Manifest holding every journal object
+        :param journal: Keys of the journal objects
+        """
+        cutoff = datetime.datetime.utcnow() - JOURNAL_RETENTION
+        expired = [key for key in journal
+                   if datetime.datetime.strptime(key[len(JOURNAL_PREFIX):].split('.')[1], JOURNAL_TIME_FORMAT) < cutoff]
+        # The objects are deleted before the manifest is written without them, so an object is never in the listing
+        # without being in the manifest's journal, which would merge it again
+        for key in expired:
+            self.storage.delete(key)
+        remaining = set(journal).difference(expired)
+        if len(manifest['journal']) > len(remaining):
+            manifest['journal'] = [key for key in manifest['journal'] if key in remaining]
+            self.write_manifest(manifest)
+        return manifest
+
+    def version_from_key(self, key):
+        try:
+            version = int(key[len(self.model_root_name):])
+        except ValueError:
+            return None
+        if key.startswith(self.model_root_name) and version > -1:
+            return version
+        return None
+
+    def models(self, manifest=None):
+        """Returns {version: model entry} of every registered model"""
+        if manifest is None:
+            manifest, _ = self.read_manifest()
+        return {int(v): entry for v, entry in manifest['models'].items()}
+
+    def status(self, manifest=None):
+        if manifest is None:
+            manifest, _ = self.read_manifest()
+        return manifest['status']
+
+    def next_version(self):
+        """Returns the version after the highest registered one, including those only journalled so far"""
+        models = self.models(self.sync())
+        return max(models.keys()) + 1 if models else 1
+
+    def register_model(self, file_path, key, source=None, artifact_path=None, report_path=None):
+        """Uploads a model file and adds it to the manifest, raises ValueError if its version is already registered
+
+        :param file_path: Local path of the model file
+        :param key: Key to store the model under, the model root name followed by its version
+        :param source: Name of the training data the model was built from
+        :param artifact_path: Local path of the model's artifact, uploaded under the model key with the artifact suffix
+        :param report_path: Local path of the retrain's profiling report, uploaded under the model key with the report
+        suffix
+        """
+        version = self.version_from_key(key)
+        if version is None:
+            raise ValueError('{} is not a valid model key'.format(key))
+        if str(version) in self.sync()['models']:
+            raise ValueError('Version {} is already registered'.format(version))
+        self.storage.upload_file(file_path, key)
+        now = str(datetime.datetime.now())
+        entry = {'version': version, 'key': key, 'size': os.path.getsize(file_path), 'sha256': file_sha256(file_path),
+                 'source': source, 'created': now, 'last_modified': now}
+        if artifact_path is not None:
+            self.storage.upload_file(artifact_path, key + ARTIFACT_SUFFIX)
+            entry['artifact'] = {'key': key + ARTIFACT_SUFFIX, 'size': os.path.getsize(artifact_path),
+                                 'sha256': file_sha256(artifact_path), 'format_version': ARTIFACT_FORMAT_VERSION}
+        if report_path is not None:
+            self.storage.upload_file(report_path, key + REPORT_SUFFIX)
+            entry['profile'] = {'key': key + REPORT_SUFFIX}
+        self.write_journal('model', entry)
+        if self.sync()['models'][str(version)] != entry:
+            raise ValueError('Version {} was registered concurrently by another process'.format(version))
+        return entry
+
+    def set_current(self, version):
+        """Appends a live model change to the status history, returns False if the version isn't registered"""
+        if str(int(version)) not in self.sync()['models']:
+            return False
+        now = datetime.datetime.now()
+        self.write_journal('status', {'current_version': int(version), 'timestamp': str(now)})
+        self.sync()
+        return True
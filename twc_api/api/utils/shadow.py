@@ -0,0 +1,209 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from api.model.transformers import model_input
+from api.utils.evaluate import get_scores_per_window, weekly_scores
+
+logger = logging.getLogger('twc_logger')
+
+# A record per scored referral, appended to the shadow log as raw little endian rows
+SHADOW_LOG_DTYPE = np.dtype([('scored', '<f8'), ('referralinstanceid', '<i8'), ('clientid', '<i8'),
+                             ('referraltakendate', '<M8[s]'), ('live', '<f8'), ('candidate', '<f8')])
+
+
+def features_fingerprint(transformer):
+    """Identifies the features a fitted TransformerPipeline builds, pipelines with the same one build the same X"""
+    return json.dumps(transformer.fingerprint(), default=str)
+
+
+def frame_bytes(frame):
+    return int(frame.memory_usage(index=True, deep=True).sum())
+
+
+class ShadowRequest(object):
+    """The live scores of a request and what the candidate needs to score it"""
+    def __init__(self, X, referral_table, live, tables=None):
+        self.X = X
+        self.referral_table = referral_table
+        self.live = live
+        self.tables = tables
+        self.size = frame_bytes(referral_table) + (frame_bytes(X) if tables is None else
+                                                   sum(frame_bytes(table) for table in tables.values()))
+
+
+class ShadowScorer(object):
+    """Scores the live requests with a candidate model in a background thread, appending the paired live and candidate
+    scores to a binary log, so the candidate can be compared with the live model on real traffic without adding to the
+    request latency.
+
+    Requests are passed with the live model's features, which the candidate scores directly if its transformer builds
+    the same ones, and otherwise with the request's tables, which it transforms itself. At most max_queue_bytes of them
+    are queued, requests arriving while the queue is full are dropped rather than queued or waited for.
+    """
+    def __init__(self, get_candidate, candidate_key, log_path, max_queue_bytes=64 * 2 ** 20):
+        """
+
+        :param get_candidate: Function returning the candidate TWCModel, called by the background thread
+        :param candidate_key: Model key of the candidate
+        :param log_path: Path of the shadow log, appended to
+        :param max_queue_bytes: Memory the queued requests may take
+        """
+        self.get_candidate = get_candidate
+        self.candidate_key = candidate_key
+        self.log_path = log_path
+        self.max_queue_bytes = max_queue_bytes
+        self.candidate = None
+        # Live model key: whether the candidate builds the same features as it
+        self.same_features = {}
+        self.queue = deque()
+        self.queued_bytes = 0
+        self.submitted = 0
+        self.dropped = 0
+        self.scored_rows = 0
+        self.failures = 0
+        self.scoring = False
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name='shadow-scorer', daemon=True)
+        self.thread.start()
+
+    def needs_tables(self, live_key, live_model):
+        """Whether requests scored by the live model need passing with their tables, because the candidate builds
+        different features. Until the candidate is loaded it's unknown, so they do"""
+        if self.candidate is None:
+            return True
+        if live_key not in self.same_features:
+            self.same_features[live_key] = (features_fingerprint(live_model.transformer)
+                                            == features_fingerprint(self.candidate.transformer))
+        return not self.same_features[live_key]
+
+    def submit(self, X, referral_table, live, tables=None):
+        """Queues a scored request for the candidate, returns False if it was dropped as the queue is full
+
+        :param X: Features of the request built by the live model
+        :param referral_table: Referral table of the request as the live model's transformer returned it
+        :param live: Series of the live scores indexed as X
+        :param tables: Tables of the request, before the live model transformed them, if needs_tables
+        """
+        request = ShadowRequest(X, referral_table, live, tables)
+        with self.condition:
+            self.submitted += 1
+            if self.closed or self.queued_bytes + request.size > self.max_queue_bytes:
+                self.dropped += 1
+                return False
+            self.queue.append(request)
+            self.queued_bytes += request.size
+            self.condition.notify_all()
+        return True
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not (self.queue or self.closed):
+                    self.condition.wait()
+                if self.closed:
+                    return
+                request = self.queue.popleft()
+                self.queued_bytes -= request.size
+                self.scoring = True
+            try:
+                self.score(request)
+            except Exception as ex:
+                self.failures += 1
+                logger.warning('Shadow scoring with {} failed: {}'.format(self.candidate_key, ex))
+            with self.condition:
+                self.scoring = False
+                self.condition.notify_all()
+
+    def drain(self, timeout=None):
+        """Waits until the queued requests are scored, returns False if they weren't within timeout seconds"""
+        with self.condition:
+            return self.condition.wait_for(lambda: not (self.queue or self.scoring) or self.closed, timeout)
+
+    def score(self, request):
+        if self.candidate is None:
+            self.candidate = self.get_candidate()
+        if request.tables is None:
+            X = request.X
+        else:
+            X, _, _ = self.candidate.transformer.transform(request.tables)
+            X = X.loc[request.X.index]
+        candidate = self.candidate.get_predictor().predict(model_input(X))
+        records = np.zeros(len(X), SHADOW_LOG_DTYPE)
+        records['scored'] = time.time()
+        records['referralinstanceid'] = request.X.index.values
+        records['clientid'] = request.referral_table.loc[request.X.index, 'referral_clientid'].values
+        records['referraltakendate'] = request.referral_table.loc[request.X.index, 'referral_referraltakendate'].values
+        records['live'] = request.live.values
+        records['candidate'] = candidate
+        with open(self.log_path, 'ab') as fh:
+            fh.write(records.tobytes())
+        self.scored_rows += len(records)
+
+    def close(self):
+        """Stops the background thread, dropping the queued requests"""
+        with self.condition:
+            self.closed = True
+            self.dropped += len(self.queue)
+            self.queue.clear()
+            self.queued_bytes = 0
+            self.condition.notify_all()
+        self.thread.join()
+
+    def stats(self):
+        with self.condition:
+            return {
+                'candidate': self.candidate_key,
+                'submitted': self.submitted,
+                'dropped': self.dropped,
+                'queued': len(self.queue),
+                'queued_bytes': self.queued_bytes,
+                'scored_rows': self.scored_rows,
+                'failures': self.failures
+            }
+
+
+def read_shadow_log(log_path):
+    """The records of a shadow log as a DataFrame, the latest of each referral's"""
+    if not os.path.exists(log_path):
+        return pd.DataFrame(np.zeros(0, SHADOW_LOG_DTYPE))
+    # A record cut short by a crash mid write is left out
+    count = os.path.getsize(log_path) // SHADOW_LOG_DTYPE.itemsize
+    records = pd.DataFrame(np.fromfile(log_path, SHADOW_LOG_DTYPE, count=count))
+    # Payloads hold the clients' histories, so earlier referrals are scored again with each new one
+    return records.drop_duplicates('referralinstanceid', keep='last').reset_index(drop=True)
+
+
+def shadow_report(log_path, threshold=0.2):
+    """Compares the candidate scores of a shadow log with the live ones, by the spearman correlation of the referral
+    scores and the overlap of the top threshold proportion of clients by mean score, over all the logged referrals and
+    averaged over the weeks they were taken in
+
+    :param threshold: Proportion of clients counted as the top cases
+    """
+    records = read_shadow_log(log_path)
+    report = {'referrals': len(records), 'clients': int(records['clientid'].nunique())}
+    if not len(records):
+        return report
+    overall = get_scores_per_window(records['live'], records['candidate'], records['clientid'], threshold)
+    referral_table = pd.DataFrame({'referral_referraltakendate': records['referraltakendate'],
+                                   'client_clientid': records['clientid']})
+    weekly = weekly_scores(referral_table, records['live'], records['candidate'], threshold).dropna().mean()
+    metrics = {
+        'spearman': overall['spearman'],
+        'overlap': overall['overlap'],
+        'weekly_spearman': weekly['spearman'],
+        'weekly_overlap': weekly['overlap'],
+        'mean_absolute_difference': (records['live'] - records['candidate']).abs().mean()
+    }
+    # Undefined metrics, e.g. the correlation of constant scores, are reported as nulls rather than as NaN, which
+    # isn't json
+    report.update({name: None if pd.isnull(value) else float(value) for name, value in metrics.items()})
+    return report
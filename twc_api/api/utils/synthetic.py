@@ -0,0 +1,151 @@
+"""Synthetic TWC data, for tests and benchmarks which can't use the production dumps. Clients have a heavy tailed number
+of referrals, which arrive in bursts of weekly usage separated by longer breaks, and each referral has a random set
+of issues, benefits, reasons, documents, dietary requirements and domestic circumstances"""
+import numpy as np
+import pandas as pd
+
+# Child table, its item id column, the number of distinct items and the share of referrals with any
+CHILD_TABLES = [('referralissue', 'clientissueid', 12, 0.7), ('referralbenefit', 'benefittypeid', 8, 0.4),
+                ('referralreason', 'referralreasonid', 10, 0.95), ('referraldocument', 'referraldocumentid', 4, 0.2),
+                ('referraldietaryrequirements', 'dietaryrequirementsid', 5, 0.1),
+                ('referraldomesticcircumstances', 'domesticcircumstancesid', 6, 0.3)]
+N_CLIENT_ISSUES = 12
+MAX_REFERRALS_PER_CLIENT = 400
+
+
+def client_sizes(n_referrals, rng):
+    """Heavy tailed numbers of referrals per client, adding up to at least n_referrals"""
+    sizes, total = [], 0
+    while total < n_referrals:
+        batch = np.minimum(rng.pareto(1.2, 4096) * 2 + 1, MAX_REFERRALS_PER_CLIENT).astype(np.int64)
+        sizes.append(batch)
+        total += batch.sum()
+    sizes = np.concatenate(sizes)
+    return sizes[:np.searchsorted(np.cumsum(sizes), n_referrals) + 1]
+
+
+def synthetic_referral_table(n_referrals, seed=0):
+    """Builds a master referral table shaped frame with a heavy tailed number of referrals per client, where each
+    client's referrals arrive in bursts of weekly usage separated by longer breaks
+
+    :param n_referrals: Approximate number of referrals to generate
+    :param seed: Random seed
+    """
+    rng = np.random.RandomState(seed)
+    sizes = client_sizes(n_referrals, rng)
+    client_ids = np.repeat(np.arange(len(sizes)), sizes)
+    n = len(client_ids)
+    # Mostly short gaps within a burst, with the occasional break longer than the 28 day gap definition
+    gaps = np.where(rng.rand(n) < 0.85, rng.randint(1, 15, n), rng.randint(29, 200, n))
+    starts = np.cumsum(sizes) - sizes
+    gaps[starts] = rng.randint(0, 3 * 365, len(sizes))
+    # Each client's days are the running total of its own gaps
+    days = np.cumsum(gaps)
+    days -= np.repeat(days[starts] - gaps[starts], sizes)
+
+    referrals = pd.DataFrame({'referral_clientid': client_ids,
+                              'referral_referraltakendate': pd.Timestamp('2015-01-01')
+                              + pd.to_timedelta(days, unit='D')})
+    referrals['client_clientid'] = referrals['referral_clientid']
+    referrals.index.name = 'referral_referralinstanceid'
+    return referrals.sort_values(['referral_referraltakendate', 'referral_referralinstanceid'])
+
+
+def pick_items(owner_ids, n_items, min_count, max_count, rng):
+    """Distinct random items for each owner, between min_count and max_count of them, as an (owner, item) frame. Repeat
+    draws collapse, so an owner can get fewer items than drawn"""
+    counts = rng.randint(min_count, max_count + 1, len(owner_ids))
+    drawn = np.arange(max_count) < counts[:, np.newaxis]
+    owners = np.broadcast_to(np.asarray(owner_ids)[:, np.newaxis], drawn.shape)[drawn]
+    items = rng.randint(0, n_items, drawn.shape)[drawn]
+    return pd.DataFrame({'owner': owners, 'item': items}).drop_duplicates().reset_index(drop=True)
+
+
+def synthetic_tables(n_referrals, seed=0):
+    """Builds the dictionary of the nine tables which construct_full_tables returns, for a synthetic history of about
+    n_referrals referrals. Dates are datetimes rather than the strings of a json dump, which the pipeline parses to the
+    same values, so that histories of millions of referrals build quickly
+
+    :param n_referrals: Approximate number of referrals to generate
+    :param seed: Random seed
+    """
+    rng = np.random.RandomState(seed)
+    history = synthetic_referral_table(n_referrals, seed)
+    n, n_clients = len(history), int(history['referral_clientid'].max()) + 1
+    # Unique and unrelated to the date order, as the database's ids are
+    referral_ids = 10 ** 6 + rng.permutation(n) * 10 + rng.randint(0, 10, n)
+    referral = pd.DataFrame({
+        'referralinstanceid': referral_ids,
+        'clientid': history['referral_clientid'].values,
+        'statusid': rng.randint(1, 5, n),
+        'referraltakendate': history['referral_referraltakendate'].values,
+        'referralonhold': False,
+        'referralagencyid': rng.randint(1, 200, n),
+        'referralworkerid': rng.randint(1, 50, n),
+        'referralnotes': np.where(rng.rand(n) < 0.5, 'Referred by agency, needs follow up', None),
+        'dietaryextranotes': None,
+        'numberofdependants': rng.poisson(1.5, n),
+    })
+    client = pd.DataFrame({
+        'clientid': np.arange(n_clients),
+        'clientdateofbirth': pd.to_datetime(pd.DataFrame({'year': rng.randint(1940, 1999, n_clients), 'month': 5,
+                                                          'day': 1})),
+        'addresssincedate': pd.Timestamp('2010-01-01'),
+        'clientismale': rng.rand(n_clients) < 0.5,
+        'partnerid': np.where(rng.rand(n_clients) < 0.3, rng.randint(1, 10 ** 6, n_clients), np.nan),
+        'clientcountryid': rng.randint(0, 5, n_clients),
+        'clientaddresstypeid': rng.randint(0, 5, n_clients),
+        'addresslocalityid': rng.randint(0, 30, n_clients),
+        'clientresidencyid': rng.randint(0, 4, n_clients),
+    })
+    tables = {'referral': referral, 'client': client,
+              'clientissue': pick_items(np.arange(n_clients), N_CLIENT_ISSUES, 0, 2, rng)
+                  .rename(columns={'owner': 'clientid', 'item': 'clientissueid'})}
+    for table_name, id_column, n_items, rate in CHILD_TABLES:
+        owners = referral_ids[rng.rand(n) < rate]
+        tables[table_name] = (pick_items(owners, n_items, 1, 3, rng)
+                              .rename(columns={'owner': 'referralinstanceid', 'item': id_column}))
+    return tables
+
+
+def select_referrals(tables, referral_ids):
+    """Restricts the referral and referral child tables of a dictionary of tables to a set of referrals"""
+    selected = {}
+    for name, table in tables.items():
+        if 'referralinstanceid' in table.columns:
+            selected[name] = table[table['referralinstanceid'].isin(referral_ids)].reset_index(drop=True)
+        else:
+            selected[name] = table.copy()
+    return selected
+
+
+def json_rows(table, date_columns):
+    """The rows of a table as json ready dictionaries, with nulls as None and dates as ISO strings"""
+    table = table.copy()
+    for column, unit in date_columns.items():
+        table[column] = np.datetime_as_string(table[column].values, unit=unit)
+    table = table.astype(object).where(table.notnull(), None)
+    return table.to_dict('records')
+
+
+def synthetic_dump(n_referrals, seed=0):
+    """Builds a retrain json dump of the synthetic_tables history, a list of per client records holding each table's
+    rows as construct_full_tables expects
+
+    :param n_referrals: Approximate number of referrals to generate
+    :param seed: Random seed
+    """
+    tables = synthetic_tables(n_referrals, seed)
+    client_of_referral = dict(zip(tables['referral']['referralinstanceid'].tolist(),
+                                  tables['referral']['clientid'].tolist()))
+    records = {}
+    for row in json_rows(tables['client'], {'clientdateofbirth': 'D', 'addresssincedate': 'D'}):
+        records[row['clientid']] = dict({name: [] for name in tables}, client=[row])
+    for row in json_rows(tables['clientissue'], {}):
+        records[row['clientid']]['clientissue'].append(row)
+    for row in json_rows(tables['referral'], {'referraltakendate': 's'}):
+        records[row['clientid']]['referral'].append(row)
+    for table_name, _, _, _ in CHILD_TABLES:
+        for row in json_rows(tables[table_name], {}):
+            records[client_of_referral[row['referralinstanceid']]][table_name].append(row)
+    return [records[client_id] for client_id in sorted(records)]
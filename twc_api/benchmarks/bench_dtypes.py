@@ -0,0 +1,54 @@
+"""Memory report of the feature pipeline with and without the compact dtype policy: the size of the table after each
+step, of X, the array the regressor is given and the referral table, and the peak memory and time of the whole fit,
+checking both build the same X up to float32 rounding"""
+import numpy as np
+
+from api.model.train import build_transformer_pipeline, construct_full_tables
+from api.model.transformers import frame_memory_mb
+from api.utils.synthetic import synthetic_dump
+from benchmarks.common import traced, print_table
+
+N_REFERRALS = 50000
+
+
+def copy_tables(tables):
+    # Consolidation modifies the tables it is given
+    return {name: table.copy() for name, table in tables.items()}
+
+
+def step_sizes(tables, compact):
+    """Size in MB of the output of each step of a pipeline fit"""
+    pipeline = build_transformer_pipeline(compact=compact)
+    data, sizes = copy_tables(tables), {}
+    for step in pipeline.pipeline:
+        data = step.fit_transform(data)
+        sizes[type(step).__name__] = frame_memory_mb(data)
+    X, _, referral_table = pipeline.aligner.fit_transform(data)
+    sizes['X'] = frame_memory_mb(X)
+    # The array the regressor is given, X of mixed dtypes is upcast to float64
+    sizes['X as array'] = X.values.nbytes / 2 ** 20
+    sizes['referral table'] = frame_memory_mb(referral_table)
+    return sizes, X
+
+
+def main(n_referrals=N_REFERRALS):
+    tables = construct_full_tables(synthetic_dump(n_referrals))
+    results = {}
+    for compact in [False, True]:
+        sizes, X = step_sizes(tables, compact)
+        _, fit_time, fit_peak = traced(build_transformer_pipeline(compact=compact).fit_transform,
+                                       copy_tables(tables))
+        sizes['fit peak'] = fit_peak
+        results[compact] = sizes, X, fit_time
+    (before, dense_X, before_time), (after, compact_X, after_time) = results[False], results[True]
+    rows = [{'stage': stage, 'before (MB)': before[stage], 'after (MB)': after[stage],
+             'ratio': before[stage] / after[stage]} for stage in before]
+    rows.append({'stage': 'fit (s)', 'before (MB)': before_time, 'after (MB)': after_time,
+                 'ratio': before_time / after_time})
+    print_table(rows, ['stage', 'before (MB)', 'after (MB)', 'ratio'])
+    print('{} referrals, X identical as float32: {}'.format(
+        len(dense_X), np.array_equal(dense_X.values.astype(np.float32), compact_X.values)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+"""Time of the weekly rank correlation evaluation with a groupby apply per week, as it was computed, against the
+segment-wise weekly_scores, on multi-year test sets, checking both give the same metrics"""
+import numpy as np
+import pandas as pd
+
+from api.utils.evaluate import get_scores_per_window, evaluate_average_weekly_rank_correlation
+from api.utils.synthetic import synthetic_referral_table
+from benchmarks.common import time_call, print_table
+
+SIZES = [20000, 100000, 400000]
+THRESHOLD = 0.2
+
+
+def grouped_evaluation(test_referral_table, y_test, y_pred, threshold):
+    grouped = test_referral_table.assign(y=y_test, pred=y_pred)\
+                                 .set_index('referral_referraltakendate')\
+                                 .groupby([pd.Grouper(freq='1W'), 'client_clientid'])[['y', 'pred']]\
+                                 .mean()
+    return grouped.reset_index()\
+                  .groupby(['referral_referraltakendate'])\
+                  .apply(lambda k: get_scores_per_window(k['y'], k['pred'], k['client_clientid'], threshold))\
+                  .dropna().mean()
+
+
+def main():
+    rows = []
+    rng = np.random.RandomState(0)
+    for size in SIZES:
+        referrals = synthetic_referral_table(size).reset_index()
+        y = pd.Series(rng.rand(len(referrals)), index=referrals.index)
+        pred = (y + rng.normal(0, 0.3, len(referrals))).values
+        before, before_time = time_call(grouped_evaluation, referrals, y, pred, THRESHOLD)
+        after, after_time = time_call(evaluate_average_weekly_rank_correlation, referrals, y, pred, THRESHOLD)
+        weeks = referrals['referral_referraltakendate'].dt.to_period('W').nunique()
+        rows.append({'referrals': len(referrals), 'weeks': weeks, 'groupby (s)': before_time,
+                     'segment-wise (s)': after_time, 'speedup': before_time / after_time,
+                     'identical': bool(np.allclose(before.values, after.values))})
+    print_table(rows, ['referrals', 'weeks', 'groupby (s)', 'segment-wise (s)', 'speedup', 'identical'])
+
+
+if __name__ == '__main__':
+    main()
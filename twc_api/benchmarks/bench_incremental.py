@@ -0,0 +1,75 @@
+"""Wall clock time and peak memory of an incremental retrain, which extends the live model with trees fitted on the
+referrals matured since it was trained, against the full retrain it replaces, with the rank correlation of both on
+the latest matured referrals, which neither is trained on"""
+import copy
+
+import numpy as np
+import pandas as pd
+
+from api.model.models import TWCModel
+from api.model.train import generate_X_y, train_model, incremental_retrain, evaluate_model, matured_cutoff
+from api.utils.synthetic import synthetic_tables
+from benchmarks.common import traced, print_table
+
+N_REFERRALS = 100000
+HYPERPARAMS = {'n_estimators': 100, 'random_state': 0}
+NEW_TREES = 20
+TRAINED_PROPORTION = 0.8
+HELD_OUT_PROPORTION = 0.05
+
+
+def tables_before(tables, date):
+    """The dump as it was on date, with the referrals taken since and their rows in the child tables removed"""
+    referral = tables['referral'][tables['referral']['referraltakendate'] < date]
+    truncated = {}
+    for table_name, table in tables.items():
+        if table_name == 'referral':
+            table = referral
+        elif table_name != 'client' and 'referralinstanceid' in table.columns:
+            table = table[table['referralinstanceid'].isin(referral['referralinstanceid'])]
+        truncated[table_name] = table.reset_index(drop=True)
+    return truncated
+
+
+def copy_tables(tables):
+    return {name: table.copy() for name, table in tables.items()}
+
+
+def fit(tables):
+    X, y, referral_table, transformer = generate_X_y(copy_tables(tables))
+    model = train_model(X, y, HYPERPARAMS)
+    return TWCModel(transformer, model, training_cutoff=referral_table['referral_referraltakendate'].max())
+
+
+def main(n_referrals=N_REFERRALS):
+    tables = synthetic_tables(n_referrals)
+    dates = tables['referral']['referraltakendate']
+    matured = dates[dates <= matured_cutoff(dates)]
+    # The live model was trained when the targets of TRAINED_PROPORTION of the referrals had matured, the retrains
+    # when those of all but the latest HELD_OUT_PROPORTION had, which they're evaluated on
+    since, held_out = matured.quantile(TRAINED_PROPORTION), matured.quantile(1 - HELD_OUT_PROPORTION)
+    live = fit(tables_before(tables, since + pd.Timedelta('365 days')))
+    trained = tables_before(tables, held_out + pd.Timedelta('365 days'))
+
+    (_, _, _, incremental), incremental_seconds, incremental_mb = traced(
+        incremental_retrain, copy_tables(trained), copy.deepcopy(live), NEW_TREES, HYPERPARAMS['n_estimators'])
+    full, full_seconds, full_mb = traced(fit, trained)
+
+    X, y, referral_table, _ = generate_X_y(copy_tables(tables))
+    rows = np.flatnonzero(referral_table['referral_referraltakendate'] > held_out)
+    X_test, y_test, referral_table_test = X.iloc[rows], y.iloc[rows], referral_table.iloc[rows]
+    results = []
+    for name, model, seconds, mb in [('live model', live, '', ''),
+                                     ('incremental retrain', incremental, incremental_seconds, incremental_mb),
+                                     ('full retrain', full, full_seconds, full_mb)]:
+        # The models' schemas hold the features seen in their training data
+        X_model = X_test.reindex(model.transformer.aligner.column_schema, axis=1, fill_value=0)
+        scores = evaluate_model(model.model, X_model, y_test, referral_table_test, 0.2)
+        results.append({'model': name, 'seconds': seconds, 'peak_mb': mb, 'trees': len(model.model.estimators_),
+                        'spearman': scores['spearman'], 'overlap': scores['overlap']})
+    print('{} referrals, {} held out'.format(len(X), len(X_test)))
+    print_table(results, ['model', 'seconds', 'peak_mb', 'trees', 'spearman', 'overlap'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""Compares the peak memory and time of loading a retrain json dump with json.load and construct_full_tables against
+the single pass streaming parser, checking that both build the same tables"""
+import json
+import os
+import tempfile
+
+from api.model.ingest import stream_full_tables
+from api.model.train import construct_full_tables, table_names
+from api.utils.synthetic import synthetic_dump
+from benchmarks.common import traced, print_table
+
+SIZES = [10000, 50000]
+
+
+def load_with_json(path):
+    with open(path, 'r') as fh:
+        return construct_full_tables(json.load(fh))
+
+
+def load_with_stream(path):
+    with open(path, 'rb') as fh:
+        return stream_full_tables(fh, table_names)
+
+
+def main(sizes=SIZES):
+    rows = []
+    for size in sizes:
+        fd, path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(synthetic_dump(size), fh)
+        try:
+            loaded, json_time, json_peak = traced(load_with_json, path)
+            streamed, stream_time, stream_peak = traced(load_with_stream, path)
+            rows.append({'referrals': len(loaded['referral']), 'dump (MB)': os.path.getsize(path) / 2 ** 20,
+                         'json.load peak (MB)': json_peak, 'stream peak (MB)': stream_peak,
+                         'peak reduction': 1 - stream_peak / json_peak, 'json.load (s)': json_time,
+                         'stream (s)': stream_time,
+                         'identical': all(loaded[t].equals(streamed[t]) for t in table_names)})
+        finally:
+            os.remove(path)
+    print_table(rows, ['referrals', 'dump (MB)', 'json.load peak (MB)', 'stream peak (MB)', 'peak reduction',
+                       'json.load (s)', 'stream (s)', 'identical'])
+
+
+if __name__ == '__main__':
+    main()
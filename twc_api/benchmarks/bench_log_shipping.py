@@ -0,0 +1,56 @@
+"""Time the training thread spends logging, and bytes uploaded, when every log call re-uploads the whole log file as
+sync_log_to_s3 used to, against the buffered background shipper, with a simulated upload latency"""
+import logging
+import time
+
+from api.utils.log_shipping import BufferedLogShipper
+from benchmarks.common import time_call, print_table
+
+UPLOAD_LATENCY = 0.02
+LINE = 'Features Matrix generated consisting of 100000 referrals and 180 features (68.7 MB)'
+
+
+class SimulatedBucket(object):
+    def __init__(self):
+        self.uploaded_bytes = 0
+
+    def upload(self, text):
+        time.sleep(UPLOAD_LATENCY)
+        self.uploaded_bytes += len(text)
+
+
+def full_file_uploads(n_records, bucket):
+    log = []
+    for i in range(n_records):
+        log.append('{} {}\n'.format(i, LINE))
+        bucket.upload(''.join(log))
+
+
+def shipped(n_records, bucket):
+    shipper = BufferedLogShipper(lambda index, text: bucket.upload(text), flush_interval=1.0)
+    logger = logging.getLogger('bench_log_shipping')
+    logger.handlers = [shipper]
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    for i in range(n_records):
+        logger.info('{} {}'.format(i, LINE))
+        shipper.ship_soon()
+    return shipper
+
+
+def main():
+    rows = []
+    for n_records in [50, 200, 800]:
+        before = SimulatedBucket()
+        _, before_time = time_call(full_file_uploads, n_records, before)
+        after = SimulatedBucket()
+        shipper, after_time = time_call(shipped, n_records, after)
+        shipper.close()
+        rows.append({'log calls': n_records, 'before (s)': before_time, 'after (s)': after_time,
+                     'before uploaded (KB)': before.uploaded_bytes / 2 ** 10,
+                     'after uploaded (KB)': after.uploaded_bytes / 2 ** 10})
+    print_table(rows, ['log calls', 'before (s)', 'after (s)', 'before uploaded (KB)', 'after uploaded (KB)'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+"""Compares the per referral number loop in AddFutureReferralTargetFeatures.calc_look_ahead_stats with the single pass
+engine, checking that both produce the same targets"""
+import numpy as np
+
+from api.model.transformers import AddFutureReferralTargetFeatures
+from api.utils.synthetic import synthetic_referral_table
+from benchmarks.common import time_call, print_table
+
+SIZES = [1000, 5000, 20000, 50000]
+
+
+def main(sizes=SIZES):
+    transformer = AddFutureReferralTargetFeatures()
+    rows = []
+    for size in sizes:
+        referrals = synthetic_referral_table(size)
+        loop, loop_time = time_call(transformer.calc_look_ahead_stats, referrals)
+        vectorized, vectorized_time = time_call(transformer.calc_look_ahead_stats_vectorized, referrals)
+        columns = AddFutureReferralTargetFeatures.TARGET_COLUMNS
+        identical = np.allclose(loop[columns].values, vectorized[columns].values, equal_nan=True, rtol=0, atol=0)
+        rows.append({'referrals': len(referrals),
+                     'max per client': int(referrals.groupby('referral_clientid').size().max()),
+                     'loop (s)': loop_time, 'vectorized (s)': vectorized_time,
+                     'speedup': loop_time / vectorized_time, 'identical': identical})
+    print_table(rows, ['referrals', 'max per client', 'loop (s)', 'vectorized (s)', 'speedup', 'identical'])
+
+
+if __name__ == '__main__':
+    main()
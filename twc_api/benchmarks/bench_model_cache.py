@@ -0,0 +1,46 @@
+"""Latency of scoring a payload right after switching the live model between two versions, reloading the model on
+each switch as before the model cache against serving both versions from the cache. The loads unpickle the model
+from memory, so they leave out the download from the model bucket"""
+import pickle
+
+from api.model.models import TWCModel, select_clients
+from api.model.train import generate_X_y, train_model
+from api.utils.model_cache import ModelCache
+from api.utils.synthetic import synthetic_tables
+from benchmarks.common import time_call, print_table
+
+N_REFERRALS = 30000
+N_SWITCHES = 10
+
+
+def main(n_referrals=N_REFERRALS, n_switches=N_SWITCHES):
+    tables = synthetic_tables(n_referrals)
+    X, y, _, transformer = generate_X_y({name: table.copy() for name, table in tables.items()})
+    pickles = {}
+    for version, seed in [('twc_model_1', 0), ('twc_model_2', 1)]:
+        model = TWCModel(transformer, train_model(X, y, {'n_estimators': 100, 'random_state': seed}))
+        pickles[version] = pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)
+    payload = select_clients(tables, tables['client']['clientid'].iloc[:1])
+    versions = ['twc_model_1', 'twc_model_2'] * (n_switches // 2)
+
+    def reload_each_switch():
+        for version in versions:
+            pickle.loads(pickles[version]).predict({name: table.copy() for name, table in payload.items()})
+
+    cache = ModelCache(lambda version: pickle.loads(pickles[version]), max_bytes=2 ** 30)
+
+    def cached():
+        for version in versions:
+            cache.get(version).predict({name: table.copy() for name, table in payload.items()})
+
+    _, reload_seconds = time_call(reload_each_switch)
+    _, cached_seconds = time_call(cached)
+    stats = cache.stats()
+    print('{} switches, models of {:.1f}MB'.format(len(versions), stats['bytes'] / len(stats['models']) / 2 ** 20))
+    print_table([{'serving': 'reload on each switch', 'ms_per_request': 1000 * reload_seconds / len(versions)},
+                 {'serving': 'model cache', 'ms_per_request': 1000 * cached_seconds / len(versions)}],
+                ['serving', 'ms_per_request'])
+
+
+if __name__ == '__main__':
+    main()
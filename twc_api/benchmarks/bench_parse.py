@@ -0,0 +1,47 @@
+"""Per request latency of parsing /score payloads into tables with the declared schema against inferring them with
+ParseJSONToTablesTransformer, alone and followed by the transform the parsed tables go through, for payloads of
+clients with short, typical and the longest histories"""
+import copy
+
+import numpy as np
+
+from api.model.schema import SchemaJSONToTablesTransformer
+from api.model.train import construct_full_tables, generate_X_y
+from api.model.transformers import ParseJSONToTablesTransformer
+from api.utils.synthetic import synthetic_dump
+from benchmarks.common import time_call, print_table
+
+N_REFERRALS = 20000
+REPEATS = 20
+
+
+def best_time(func, payload, repeats):
+    # The parsers and transforms don't modify the payload, but the transforms modify the parsed tables
+    return min(time_call(func, copy.deepcopy(payload))[1] for _ in range(repeats))
+
+
+def main(n_referrals=N_REFERRALS, repeats=REPEATS):
+    dump = synthetic_dump(n_referrals)
+    _, _, _, transformer = generate_X_y(construct_full_tables(copy.deepcopy(dump)))
+    by_size = sorted(dump, key=lambda record: len(record['referral']))
+    payloads = [('short', by_size[len(by_size) // 10]), ('median', by_size[len(by_size) // 2]),
+                ('longest', by_size[-1])]
+    parsers = [('inferred', ParseJSONToTablesTransformer()), ('schema', SchemaJSONToTablesTransformer())]
+    rows = []
+    for name, payload in payloads:
+        row = {'payload': name, 'referrals': len(payload['referral'])}
+        for parser_name, parser in parsers:
+            row['{} parse (ms)'.format(parser_name)] = 1000 * best_time(parser.transform, payload, repeats)
+            row['{} + transform (ms)'.format(parser_name)] = 1000 * best_time(
+                lambda p: transformer.transform(parser.transform(p)), payload, repeats)
+        X_inferred = transformer.transform(parsers[0][1].transform(copy.deepcopy(payload)))[0]
+        X_schema = transformer.transform(parsers[1][1].transform(copy.deepcopy(payload)))[0]
+        row['parse speedup'] = row['inferred parse (ms)'] / row['schema parse (ms)']
+        row['identical'] = np.array_equal(X_inferred.values.astype(float), X_schema.values.astype(float))
+        rows.append(row)
+    print_table(rows, ['payload', 'referrals', 'inferred parse (ms)', 'schema parse (ms)', 'parse speedup',
+                       'inferred + transform (ms)', 'schema + transform (ms)', 'identical'])
+
+
+if __name__ == '__main__':
+    main()
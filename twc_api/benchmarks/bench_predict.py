@@ -0,0 +1,46 @@
+"""Compares the per call latency of the sklearn and flat TWCModel prediction engines on a forest shaped like the
+production ExtraTreesRegressor, checking that the flat engine agrees bit for bit with single threaded sklearn"""
+import numpy as np
+from sklearn.ensemble import ExtraTreesRegressor
+
+from api.model.artifact import FlatForest
+from benchmarks.common import time_call, print_table
+
+BATCH_SIZES = [1, 10, 100, 10000]
+N_TRAIN = 20000
+N_FEATURES = 80
+
+
+def training_data(n_rows, n_features, seed=0):
+    """Mostly indicator features with a few counts, like the referral feature matrix"""
+    rng = np.random.RandomState(seed)
+    X = (rng.rand(n_rows, n_features) < 0.1).astype(float)
+    X[:, :5] = rng.poisson(3, (n_rows, 5))
+    y = X[:, :5].sum(axis=1) + X[:, 5:15].sum(axis=1) * 2 + rng.exponential(2, n_rows)
+    return X, y
+
+
+def best_time(func, X, repeats):
+    return min(time_call(func, X)[1] for _ in range(repeats))
+
+
+def main(batch_sizes=BATCH_SIZES):
+    X, y = training_data(N_TRAIN, N_FEATURES)
+    forest = ExtraTreesRegressor(n_jobs=-1, n_estimators=120, random_state=0).fit(X, y)
+    flat = FlatForest.from_sklearn(forest)
+    rows = []
+    for batch_size in batch_sizes:
+        batch = X[:batch_size]
+        repeats = 20 if batch_size < 10000 else 3
+        sklearn_time = best_time(forest.predict, batch, repeats)
+        flat_time = best_time(flat.predict, batch, repeats)
+        forest.set_params(n_jobs=1)
+        identical = np.array_equal(flat.predict(batch), forest.predict(batch))
+        forest.set_params(n_jobs=-1)
+        rows.append({'rows': batch_size, 'sklearn (ms)': sklearn_time * 1000, 'flat (ms)': flat_time * 1000,
+                     'speedup': sklearn_time / flat_time, 'identical': identical})
+    print_table(rows, ['rows', 'sklearn (ms)', 'flat (ms)', 'speedup', 'identical'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""Wall clock time and peak memory of a /retrain, which evaluates a model and then publishes one fitted on all the
+referrals, run as before as a test evaluation followed by a separate full retrain which parses the dump and builds
+the features again, and as the combined evaluate-then-publish run which builds them once"""
+import json
+import os
+import tempfile
+
+from api.model.train import train_model_from_json
+from api.utils.synthetic import synthetic_dump
+from benchmarks.common import traced, print_table
+
+SIZES = [10000, 30000]
+HYPERPARAMS = {'n_estimators': 20}
+
+
+def open_dump(path):
+    return lambda: open(path, 'rb')
+
+
+def separate_runs(path):
+    train_model_from_json(open_dump(path), HYPERPARAMS, test=True)
+    return train_model_from_json(open_dump(path), HYPERPARAMS)
+
+
+def combined_run(path):
+    return train_model_from_json(open_dump(path), HYPERPARAMS, test=True, publish=True)
+
+
+def main():
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in SIZES:
+            path = os.path.join(directory, 'dump_{}.json'.format(size))
+            with open(path, 'w') as fh:
+                json.dump(synthetic_dump(size), fh)
+            _, before_time, before_peak = traced(separate_runs, path)
+            _, after_time, after_peak = traced(combined_run, path)
+            rows.append({'referrals': size, 'before (s)': before_time, 'after (s)': after_time,
+                         'speedup': before_time / after_time, 'before peak (MB)': before_peak,
+                         'after peak (MB)': after_peak})
+    print_table(rows, ['referrals', 'before (s)', 'after (s)', 'speedup', 'before peak (MB)', 'after peak (MB)'])
+
+
+if __name__ == '__main__':
+    main()
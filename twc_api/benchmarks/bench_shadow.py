@@ -0,0 +1,69 @@
+"""Per request latency of scoring with the live model alone, with a candidate model scored inline after it, and with
+the candidate shadow scoring the request in the background, and how many requests the shadow scorer kept up with"""
+import os
+import shutil
+import tempfile
+
+from api.model.models import TWCModel, select_clients
+from api.model.train import generate_X_y, train_model
+from api.utils.shadow import ShadowScorer, shadow_report
+from api.utils.synthetic import synthetic_tables
+from benchmarks.common import time_call, print_table
+
+N_REFERRALS = 30000
+N_REQUESTS = 200
+HYPERPARAMS = {'n_estimators': 100}
+
+
+def copy_tables(tables):
+    return {name: table.copy() for name, table in tables.items()}
+
+
+def main(n_referrals=N_REFERRALS, n_requests=N_REQUESTS):
+    tables = synthetic_tables(n_referrals)
+    X, y, _, transformer = generate_X_y(copy_tables(tables))
+    live = TWCModel(transformer, train_model(X, y, HYPERPARAMS))
+    # Fitted on fewer referrals, so that it scores differently
+    n_rows = int(0.8 * len(X))
+    candidate = TWCModel(transformer, train_model(X.iloc[:n_rows], y.iloc[:n_rows], HYPERPARAMS))
+    # The clients of the latest referrals, which the candidate wasn't fitted on
+    referrals = tables['referral'].sort_values('referraltakendate', ascending=False)
+    client_ids = referrals['clientid'].drop_duplicates().iloc[:n_requests]
+    payloads = [select_clients(tables, [client_id]) for client_id in client_ids]
+    directory = tempfile.mkdtemp()
+    try:
+        scorer = ShadowScorer(lambda: candidate, 'candidate', os.path.join(directory, 'shadow.bin'))
+
+        def live_only():
+            for payload in payloads:
+                live.predict(copy_tables(payload))
+
+        def inline():
+            for payload in payloads:
+                live.predict(copy_tables(payload))
+                candidate.predict(copy_tables(payload))
+
+        def shadowed():
+            for payload in payloads:
+                raw_tables = copy_tables(payload) if scorer.needs_tables('live', live) else None
+                X, referral_table, scores = live.score_tables(copy_tables(payload))
+                scorer.submit(X, referral_table, scores, raw_tables)
+
+        rows = []
+        for name, run in [('live model only', live_only), ('candidate scored inline', inline),
+                          ('candidate shadow scored', shadowed)]:
+            _, seconds = time_call(run)
+            rows.append({'scoring': name, 'ms_per_request': 1000 * seconds / len(payloads)})
+        scorer.drain()
+        stats = scorer.stats()
+        scorer.close()
+        print('{} requests, {} shadow scored, {} dropped'.format(len(payloads), stats['submitted'] - stats['dropped'],
+                                                                 stats['dropped']))
+        print_table(rows, ['scoring', 'ms_per_request'])
+        print(shadow_report(scorer.log_path))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
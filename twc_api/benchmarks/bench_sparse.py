@@ -0,0 +1,46 @@
+"""Compares the dense and sparse feature pipelines on a synthetic full history: peak memory and time of fitting the
+pipeline, the size of X, and the time of transforming a small scoring payload, checking both build the same X"""
+import numpy as np
+
+from api.model.train import build_transformer_pipeline, construct_full_tables
+from api.model.transformers import model_input
+from api.utils.synthetic import synthetic_dump
+from benchmarks.common import traced, time_call, print_table
+
+SIZES = [10000, 50000]
+
+
+def copy_tables(tables):
+    # Consolidation modifies the tables it is given
+    return {name: table.copy() for name, table in tables.items()}
+
+
+def run(tables, payload, sparse):
+    pipeline = build_transformer_pipeline(sparse=sparse)
+    (X, _, _), fit_time, fit_peak = traced(pipeline.fit_transform, copy_tables(tables))
+    _, transform_time = time_call(pipeline.transform, copy_tables(payload))
+    matrix = model_input(X)
+    size = matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes if sparse else X.values.nbytes
+    return X, {'fit peak (MB)': fit_peak, 'fit (s)': fit_time, 'X (MB)': size / 2 ** 20,
+               'payload transform (s)': transform_time}
+
+
+def main(sizes=SIZES):
+    rows = []
+    for size in sizes:
+        dump = synthetic_dump(size)
+        tables = construct_full_tables(dump)
+        payload = construct_full_tables(dump[:1])
+        dense_X, dense = run(tables, payload, sparse=False)
+        sparse_X, sparse = run(tables, payload, sparse=True)
+        identical = (list(dense_X.columns) == list(sparse_X.columns)
+                     and np.array_equal(dense_X.values.astype(float), model_input(sparse_X).toarray()))
+        for name, result in [('dense', dense), ('sparse', sparse)]:
+            rows.append(dict(result, referrals=len(tables['referral']), features=dense_X.shape[1], path=name,
+                             identical=identical))
+    print_table(rows, ['referrals', 'features', 'path', 'fit peak (MB)', 'fit (s)', 'X (MB)', 'payload transform (s)',
+                       'identical'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Wall clock time and peak memory of loading the tables from an sqlite dump with TrainingDataGenerator, against the
+previous loader which read every table whole, joining the child tables to the referrals, and filtered in pandas"""
+import os
+import shutil
+import tempfile
+
+import pandas as pd
+
+from api.model.transformers import TrainingDataGenerator
+from api.utils.synthetic import synthetic_tables
+from benchmarks.common import traced, print_table
+
+N_REFERRALS = 200000
+LEGACY_CHILD_SQL = """SELECT ref_dim.* FROM {} as ref_dim
+LEFT JOIN  referral on referral.referralinstanceid = ref_dim.referralinstanceid;"""
+
+
+def legacy_training_data(con, start_date=None):
+    tables = {}
+    for table_name, table in TrainingDataGenerator.TABLES.items():
+        if table_name in ['referral', 'client', 'clientissue']:
+            tables[table_name] = pd.read_sql('SELECT * FROM {};'.format(table), con=con)
+        else:
+            tables[table_name] = pd.read_sql(LEGACY_CHILD_SQL.format(table), con=con)
+        tables[table_name].columns = [c.lower() for c in tables[table_name].columns]
+    if start_date is not None:
+        tables['referral'] = tables['referral'][tables['referral']['referraltakendate'] >= str(start_date)]
+    return tables
+
+
+def main(n_referrals=N_REFERRALS):
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'dump.sqlite')
+        generator = TrainingDataGenerator(path, create_indexes=True)
+        tables = synthetic_tables(n_referrals)
+        for table_name, table in tables.items():
+            table.to_sql(TrainingDataGenerator.TABLES[table_name], generator.con, index=False)
+        # The last fifth of the referrals
+        start_date = tables['referral']['referraltakendate'].quantile(0.8)
+        del tables
+        rows = []
+        for name, start in [('all referrals', None), ('latest fifth', start_date)]:
+            legacy, legacy_seconds, legacy_mb = traced(legacy_training_data, generator.con, start)
+            loaded, seconds, mb = traced(generator.get_training_data, start_date=start)
+            rows.append({'load': name, 'legacy_seconds': legacy_seconds, 'seconds': seconds,
+                         'legacy_peak_mb': legacy_mb, 'peak_mb': mb,
+                         'legacy_rows': sum(len(t) for t in legacy.values()),
+                         'rows': sum(len(t) for t in loaded.values())})
+            del legacy, loaded
+        print('{} referrals'.format(n_referrals))
+        print_table(rows, ['load', 'legacy_seconds', 'seconds', 'legacy_peak_mb', 'peak_mb', 'legacy_rows', 'rows'])
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
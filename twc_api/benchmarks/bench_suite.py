@@ -0,0 +1,124 @@
+"""Times each transformer step, generate_X_y, train_model and TWCModel.predict on synthetic histories of increasing
+size and saves the results under the current git commit, so a change can be compared against an earlier commit:
+
+    python -m benchmarks.bench_suite
+    python -m benchmarks.bench_suite --sizes 10000 100000 --compare 5acf35b
+
+The 1M and 10M referral histories need several GB of memory and a long fit, --sizes runs a subset
+"""
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import subprocess
+
+import numpy as np
+import pandas as pd
+import sklearn
+
+from api.model.models import TWCModel, select_clients
+from api.model.train import generate_X_y, train_model
+from api.utils.profiling import Profiler
+from api.utils.synthetic import synthetic_tables
+from benchmarks.common import print_table
+
+SIZES = [10000, 100000, 1000000, 10000000]
+N_ESTIMATORS = 30
+BATCH_CLIENTS = 100
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def git_commit():
+    """Short hash of HEAD, suffixed with -dirty if the working tree has changes, or 'unknown' outside a checkout"""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                        stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + '-dirty' if dirty else commit
+
+
+def run_size(n_referrals, n_estimators, seed=0):
+    """Profiles a retrain and scoring on a synthetic history of n_referrals referrals, returning the profiler stages"""
+    tables = synthetic_tables(n_referrals, seed)
+    profiler = Profiler()
+    X, y, _, transformer = profiler.call('generate_X_y', generate_X_y,
+                                         {name: table.copy() for name, table in tables.items()}, profiler=profiler)
+    model = TWCModel(transformer, profiler.call('train_model', train_model, X, y, {'n_estimators': n_estimators}))
+    # The clients with the most referrals make up a worst case scoring request
+    client_ids = tables['referral']['clientid'].value_counts().index
+    profiler.call('predict 1 client', model.predict, select_clients(tables, client_ids[:1]))
+    profiler.call('predict {} clients'.format(BATCH_CLIENTS), model.predict,
+                  select_clients(tables, client_ids[:BATCH_CLIENTS]))
+    return profiler.stages
+
+
+def results_path(commit, results_dir=RESULTS_DIR):
+    return os.path.join(results_dir, '{}.json'.format(commit))
+
+
+def load_results(commit, results_dir=RESULTS_DIR):
+    """Loads the results saved for a commit, or for a prefix of its hash"""
+    paths = sorted(glob.glob(os.path.join(results_dir, '{}*.json'.format(commit))))
+    if not paths:
+        raise SystemExit('No saved results for {} in {}'.format(commit, results_dir))
+    with open(paths[0]) as fh:
+        return json.load(fh)
+
+
+def compare(current, baseline):
+    """Prints the wall time and peak RSS growth of each stage against a baseline run of the same size"""
+    rows = []
+    for size, stages in current['sizes'].items():
+        before = {stage['name']: stage for stage in baseline['sizes'].get(size, [])}
+        for stage in stages:
+            if stage['name'] not in before:
+                continue
+            old = before[stage['name']]
+            rows.append({'referrals': size, 'stage': stage['name'], 'before (s)': old['wall_seconds'],
+                         'after (s)': stage['wall_seconds'],
+                         'speedup': old['wall_seconds'] / stage['wall_seconds'] if stage['wall_seconds'] else 0.0,
+                         'RSS before (MB)': old['peak_rss_delta_mb'], 'RSS after (MB)': stage['peak_rss_delta_mb']})
+    print('{} against {}'.format(current['commit'], baseline['commit']))
+    print_table(rows, ['referrals', 'stage', 'before (s)', 'after (s)', 'speedup', 'RSS before (MB)',
+                       'RSS after (MB)'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='Numbers of referrals to benchmark')
+    parser.add_argument('--n-estimators', type=int, default=N_ESTIMATORS, help='Trees of the fitted model')
+    parser.add_argument('--results-dir', default=RESULTS_DIR, help='Where results are saved, one file per commit')
+    parser.add_argument('--compare', help='Commit whose saved results to compare this run against')
+    args = parser.parse_args()
+
+    # Loaded first, as this run's results replace any saved for the same commit
+    baseline = load_results(args.compare, args.results_dir) if args.compare else None
+    commit = git_commit()
+    results = {'commit': commit, 'created': str(datetime.datetime.now()), 'n_estimators': args.n_estimators,
+               'versions': {'python': platform.python_version(), 'numpy': np.__version__,
+                            'pandas': pd.__version__, 'sklearn': sklearn.__version__},
+               'sizes': {}}
+    rows = []
+    for size in args.sizes:
+        stages = run_size(size, args.n_estimators)
+        results['sizes'][str(size)] = stages
+        rows.extend({'referrals': size, 'stage': stage['name'], 'wall (s)': stage['wall_seconds'],
+                     'cpu (s)': stage['cpu_seconds'], 'peak RSS +(MB)': stage['peak_rss_delta_mb'],
+                     'rows in': (stage['input'] or {}).get('rows', '')} for stage in stages)
+    print_table(rows, ['referrals', 'stage', 'rows in', 'wall (s)', 'cpu (s)', 'peak RSS +(MB)'])
+
+    os.makedirs(args.results_dir, exist_ok=True)
+    with open(results_path(commit, args.results_dir), 'w') as fh:
+        json.dump(results, fh, indent=2)
+    print('Saved results to {}'.format(results_path(commit, args.results_dir)))
+    if baseline is not None:
+        compare(results, baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+"""Compares the grouped apply engine of TimeWindowFeatures with the single pass week binned engine, checking that both
+produce the same window counts"""
+from api.model.transformers import TimeWindowFeatures
+from api.utils.synthetic import synthetic_referral_table
+from benchmarks.common import time_call, print_table
+
+SIZES = [1000, 10000, 50000, 100000]
+WINDOWS = [1, 4, 12]
+
+
+def main(sizes=SIZES):
+    rows = []
+    for size in sizes:
+        referrals = synthetic_referral_table(size)
+        grouped, grouped_time = time_call(TimeWindowFeatures(WINDOWS, vectorized=False).fit_transform,
+                                          referrals.copy())
+        vectorized, vectorized_time = time_call(TimeWindowFeatures(WINDOWS).fit_transform, referrals.copy())
+        rows.append({'referrals': len(referrals), 'grouped apply (s)': grouped_time,
+                     'vectorized (s)': vectorized_time, 'speedup': grouped_time / vectorized_time,
+                     'identical': grouped.equals(vectorized)})
+    print_table(rows, ['referrals', 'grouped apply (s)', 'vectorized (s)', 'speedup', 'identical'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+"""Wall clock time of walk-forward validation with the folds fitted one after another and in a process pool, against a
+single fit on all the referrals, which the pool should take roughly as long as given a core per fold"""
+import os
+
+from api.model.train import generate_X_y, train_model, walk_forward_validation
+from api.utils.synthetic import synthetic_tables
+from benchmarks.common import time_call, print_table
+
+N_REFERRALS = 30000
+N_FOLDS = 4
+HYPERPARAMS = {'n_estimators': 40, 'random_state': 0}
+
+
+def main(n_referrals=N_REFERRALS):
+    X, y, referral_table, _ = generate_X_y(synthetic_tables(n_referrals))
+    _, fit_time = time_call(train_model, X, y, HYPERPARAMS)
+    rows = [{'run': 'single fit on all referrals', 'seconds': fit_time, 'spearman': '', 'overlap': ''}]
+    for workers in [1, min(N_FOLDS, os.cpu_count() or 1)]:
+        metrics, seconds = time_call(walk_forward_validation, X, y, referral_table, N_FOLDS, HYPERPARAMS,
+                                     workers=workers)
+        rows.append({'run': '{} folds, {} worker(s)'.format(N_FOLDS, workers), 'seconds': seconds,
+                     'spearman': metrics['spearman'].mean(), 'overlap': metrics['overlap'].mean()})
+    print('{} referrals, {} cores'.format(len(X), os.cpu_count()))
+    print_table(rows, ['run', 'seconds', 'spearman', 'overlap'])
+
+
+if __name__ == '__main__':
+    main()
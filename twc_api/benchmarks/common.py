@@ -0,0 +1,37 @@
+"""Shared helpers for the benchmark scripts, which are run as modules from the twc_api directory, e.g.
+
+    python -m benchmarks.bench_look_ahead
+"""
+import time
+import tracemalloc
+
+
+def time_call(func, *args, **kwargs):
+    """Returns the result of func(*args, **kwargs) and the wall clock time it took in seconds"""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def traced(func, *args, **kwargs):
+    """Returns the result of func(*args, **kwargs), its wall clock time in seconds and the peak memory it allocated in
+    MB as seen by tracemalloc"""
+    tracemalloc.start()
+    result, seconds = time_call(func, *args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, peak / 2 ** 20
+
+
+def print_table(rows, columns):
+    """Prints a list of dictionaries as a fixed width table"""
+    widths = [max(len(c), *(len(_format(r[c])) for r in rows)) for c in columns]
+    print('  '.join(c.rjust(w) for c, w in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(_format(row[c]).rjust(w) for c, w in zip(columns, widths)))
+
+
+def _format(value):
+    if isinstance(value, float):
+        return '{:.4f}'.format(value)
+    return str(value)